@@ -0,0 +1,544 @@
+import os
+import sys
+import json
+import math
+import random
+import shutil
+import socket
+import secrets
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+from optparse import OptionParser
+import paramiko
+import sync
+from metrics import RunMetrics
+from walker import walk_tree
+from hashing import file_digest, supported_algo
+
+# Banc d'essai de sync.py sur des arborescences synthétiques.
+# Les chemins local et distant sont mesurés, le serveur distant est remplacé par un serveur SFTP
+# paramiko démarré dans ce processus sur localhost, qui exécute aussi sync_rmt.py -A.
+# Les résultats sont comparés à ceux d'une exécution précédente conservée comme référence.
+
+# Global constant
+FANOUT = 4  # Nombre de sous-dossiers par dossier
+REJECT_RATIO = 0.05  # Proportion des fichiers ayant une extension rejetée
+RATES = ('files_per_sec', 'mb_per_sec', 'db_rows_per_sec')
+STAND_IN_LOG = 'benchmark.stand_in'  # Les sessions fermées par le client ne sont pas des erreurs
+WORDS = ('le', 'la', 'les', 'de', 'des', 'un', 'une', 'et', 'fichier', 'dossier', 'copie', 'serveur', 'photo',
+         'musique', 'livre', 'page', 'chapitre', 'sauvegarde', 'distant', 'local', 'grosseur', 'date')
+
+# parms
+# --files:     Nombre de fichiers générés
+# --sizes:     Grosseurs minimale et maximale des fichiers, distribution log-uniforme
+# --depth:     Profondeur maximale des dossiers
+# --dup-ratio: Proportion des fichiers qui sont des doublons d'un fichier précédent
+# --seed:      Graine du générateur, pour des arborescences identiques d'une exécution à l'autre
+# --work-dir:  Dossier de travail ou None pour un dossier temporaire
+# --remote:    True, False
+# --sessions:  Nombre de sessions SFTP pour les copies distantes
+# --baseline:  Résultats de référence (json) ou None
+# --output:    Fichier des résultats (json) ou None
+# --tolerance: Baisse de débit tolérée avant de signaler une régression
+# --algorithms: Algorithmes de checksum mesurés, ou None
+# --text-ratio: Proportion des fichiers, hors extensions STORE_EXT, dont le contenu est du texte compressible
+parm = {'files': 1000, 'sizes': (1024, 1024 * 1024), 'depth': 3, 'dup_ratio': 0.1, 'seed': 1, 'work_dir': None,
+        'remote': False, 'sessions': 1, 'baseline': None, 'output': None, 'tolerance': 0.2,
+        'algorithms': None, 'text_ratio': 0.0}
+
+
+class StandInHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class StandInSFTP(paramiko.SFTPServerInterface):
+    """
+    The SFTP operations used by sync.py, served from the local file system.
+    """
+    def list_folder(self, path):
+        try:
+            result = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StandInHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, old_path, new_path):
+        try:
+            os.rename(old_path, new_path)
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, old_path, new_path):
+        try:
+            os.replace(old_path, new_path)
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mtime is not None:
+                os.utime(path, (attr.st_atime, attr.st_mtime))
+        except OSError as x:
+            return paramiko.SFTPServer.convert_errno(x.errno)
+        return paramiko.SFTP_OK
+
+
+class StandInServer(paramiko.ServerInterface):
+    """
+    Accept the password of the run and run the exec requests with the local shell, like sshd.
+    :param password: The random password generated for the run by start_stand_in
+    """
+    def __init__(self, password):
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if secrets.compare_digest(password, self.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_command, args=(channel, command.decode('utf-8')), daemon=True).start()
+        return True
+
+
+def run_command(channel, command):
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+
+    def pump_stdin():
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+        except (EOFError, OSError):
+            pass
+
+    threading.Thread(target=pump_stdin, daemon=True).start()
+    try:
+        while True:
+            data = process.stdout.read1(65536)
+            if not data:
+                break
+            channel.sendall(data)
+        channel.send_exit_status(process.wait())
+        channel.close()
+    except (EOFError, OSError):
+        # The client closed the session first, at the end of the scenario
+        process.kill()
+
+
+def start_stand_in():
+    """
+    Start the SFTP stand-in on a free localhost port. It only accepts a random password, to keep
+    the other local users from running commands through it.
+    :return: (port, password)
+    """
+    password = secrets.token_urlsafe(16)
+    host_key = paramiko.RSAKey.generate(2048)
+    sync.logging.getLogger(STAND_IN_LOG).setLevel(sync.logging.CRITICAL)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(50)
+
+    def serve():
+        while True:
+            client, address = sock.accept()
+            transport = paramiko.Transport(client)
+            transport.set_log_channel(STAND_IN_LOG)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StandInSFTP)
+            transport.start_server(server=StandInServer(password))
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1], password
+
+
+def parse_options():
+    # Use optparse to get parms
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-f", "--files", dest="files", action="store", type="int", default=parm['files'],
+                      help="Nombre de fichiers générés.")
+    parser.add_option("-s", "--sizes", dest="sizes", action="store", default="%i,%i" % parm['sizes'],
+                      help="Grosseurs minimale et maximale des fichiers en bytes, distribuées log-uniformément.")
+    parser.add_option("-D", "--depth", dest="depth", action="store", type="int", default=parm['depth'],
+                      help="Profondeur maximale des dossiers.")
+    parser.add_option("-u", "--dup-ratio", dest="dup_ratio", action="store", type="float",
+                      default=parm['dup_ratio'], help="Proportion des fichiers qui sont des doublons.")
+    parser.add_option("-S", "--seed", dest="seed", action="store", type="int", default=parm['seed'],
+                      help="Graine du générateur des arborescences.")
+    parser.add_option("-w", "--work-dir", dest="work_dir", action="store", default=None,
+                      help="Dossier de travail. Par défaut, un dossier temporaire effacé à la fin.")
+    parser.add_option("-r", "--remote", dest="remote", action="store_true", default=False,
+                      help="Mesure aussi le chemin distant, avec un serveur SFTP local.")
+    parser.add_option("-n", "--sessions", dest="sessions", action="store", type="int", default=parm['sessions'],
+                      help="Nombre de sessions SFTP pour les copies distantes.")
+    parser.add_option("-b", "--baseline", dest="baseline", action="store", default=None,
+                      help="Résultats de référence, produits par l'option -o d'une exécution précédente.")
+    parser.add_option("-o", "--output", dest="output", action="store", default=None,
+                      help="Les résultats sont écrits dans ce fichier json.")
+    parser.add_option("-t", "--tolerance", dest="tolerance", action="store", type="float",
+                      default=parm['tolerance'], help="Baisse de débit tolérée par rapport à la référence.")
+    parser.add_option("-a", "--algorithms", dest="algorithms", action="store", default=None,
+                      help="Mesure le débit de ces algorithmes de checksum, séparés par des virgules, "
+                           "par exemple md5,sha256,blake2b.")
+    parser.add_option("-x", "--text-ratio", dest="text_ratio", action="store", type="float",
+                      default=parm['text_ratio'],
+                      help="Proportion des fichiers, hors extensions STORE_EXT, dont le contenu est du texte. "
+                           "Les autres sont aléatoires, donc incompressibles.")
+    (options, args) = parser.parse_args()
+    try:
+        sizes = tuple(int(size) for size in options.sizes.split(','))
+    except ValueError:
+        sizes = ()
+    if len(sizes) != 2 or sizes[0] < 1 or sizes[0] > sizes[1]:
+        parser.error("Les grosseurs doivent être min,max avec 0 < min <= max")
+    if options.files < 1:
+        parser.error("Le nombre de fichiers doit être plus grand que 0")
+    if not 0 <= options.dup_ratio < 1:
+        parser.error("La proportion de doublons doit être entre 0 et 1")
+    if not 0 <= options.text_ratio <= 1:
+        parser.error("La proportion de fichiers texte doit être entre 0 et 1")
+    if options.algorithms is not None:
+        for algo in options.algorithms.split(','):
+            if not supported_algo(algo):
+                parser.error("Algorithme de checksum invalide: %s" % algo)
+    return options, sizes
+
+
+def generate_text(rng, size):
+    words = rng.choices(WORDS, k=size // 4 + 1)
+    return ' '.join(words).encode('ascii')[:size]
+
+
+def generate_tree(root_dir, accept_list, reject_list, store_list=()):
+    """
+    Write a synthetic directory structure. The same parms always produce the same tree.
+    :param store_list: The extensions of the files never generated as text
+    :return: (files, bytes) written
+    """
+    rng = random.Random(parm['seed'])
+    log_min = math.log(parm['sizes'][0])
+    log_max = math.log(parm['sizes'][1])
+    written = []
+    count_bytes = 0
+    for i in range(parm['files']):
+        depth = rng.randint(0, parm['depth'])
+        dir_name = os.path.join(root_dir, *["d%i" % rng.randrange(FANOUT) for level in range(depth)])
+        if rng.random() < REJECT_RATIO:
+            ext = rng.choice(reject_list)
+        else:
+            ext = rng.choice(accept_list)
+        if written and rng.random() < parm['dup_ratio']:
+            data = None
+            source_path = rng.choice(written)
+        else:
+            size = int(math.exp(rng.uniform(log_min, log_max)))
+            # Without text, the generator is called as before and the trees stay the same
+            if parm['text_ratio'] > 0 and ext not in store_list and rng.random() < parm['text_ratio']:
+                data = generate_text(rng, size)
+            else:
+                data = rng.randbytes(size)
+            source_path = None
+        os.makedirs(dir_name, exist_ok=True)
+        file_path = os.path.join(dir_name, "f%06i%s" % (i, ext))
+        if data is None:
+            shutil.copyfile(source_path, file_path)
+        else:
+            with open(file_path, 'wb') as file:
+                file.write(data)
+            written.append(file_path)
+        count_bytes += os.path.getsize(file_path)
+    return parm['files'], count_bytes
+
+
+def run_scenario(steps):
+    """
+    Run the steps of a scenario, each one in its own phase, with fresh metrics.
+    :param steps: list of (phase, function)
+    :return: the phases of the metrics report, with the DB rate added
+    """
+    sync.run_metrics = RunMetrics()
+    for phase, function in steps:
+        with sync.run_metrics.phase(phase):
+            function()
+    phases = sync.run_metrics.report()['phases']
+    phases.pop('other', None)
+    for phase in phases.values():
+        if phase['seconds'] > 0:
+            phase['db_rows_per_sec'] = round(phase['db_rows'] / phase['seconds'], 1)
+    return phases
+
+
+def reset_sync(db_path):
+    sync.parm.update({'copy': True, 'remote': None, 'incremental': False, 'jobs': 1, 'sessions': 1,
+                      'delta': False, 'compress': False, 'progress': 0})
+    sync.file_buffer[:] = []
+    sync.rmt_dirs.clear()
+    sync.conn = sync.db_connect(db_path)
+    sync.db_create_tables(sync.conn)
+
+
+def hash_scenario(source_dir):
+    """
+    Hash the whole tree once with each algorithm. The first pass also warms the OS cache.
+    """
+    entries = list(walk_tree(source_dir))
+    for entry in entries:
+        file_digest(os.path.join(entry.dir_name, entry.file_name), 'md5')
+
+    def hash_tree(algo):
+        for entry in entries:
+            file_digest(os.path.join(entry.dir_name, entry.file_name), algo)
+            sync.run_metrics.add('files')
+            sync.run_metrics.add('bytes_read', entry.size)
+            sync.run_metrics.add('bytes_hashed', entry.size)
+
+    return run_scenario([('hash_' + algo, lambda algo=algo: hash_tree(algo))
+                         for algo in parm['algorithms'].split(',')])
+
+
+def local_scenario(work_dir, source_dir):
+    target_dir = os.path.join(work_dir, 'local')
+    os.makedirs(target_dir)
+    reset_sync(os.path.join(work_dir, 'local.db'))
+
+    def incremental():
+        sync.parm['incremental'] = True
+        sync.scan_dir(sync.conn, source_dir)
+
+    def pipeline():
+        # Scan, diff and copy to another target at the same time, to compare with scan_source + diff_copy
+        sync.parm.update({'mode': 'C', 'scan_target': False, 'incremental': False})
+        sync.xfer_pool_start()
+        sync.sync_pipeline(sync.conn, os.path.join(work_dir, 'local.db'), source_dir,
+                           os.path.join(work_dir, 'pipeline'))
+        sync.xfer_pool_stop()
+        sync.parm['mode'] = 'S'
+
+    steps = [('scan_source', lambda: sync.scan_dir(sync.conn, source_dir)),
+             ('diff_copy', lambda: sync.find_missing_files(sync.conn, source_dir, target_dir)),
+             ('pipeline', pipeline),
+             ('scan_target', lambda: sync.scan_dir(sync.conn, target_dir)),
+             ('scan_incremental', incremental),
+             ('diff_nothing', lambda: sync.find_missing_files(sync.conn, source_dir, target_dir)),
+             ('dup', lambda: sync.list_dup(sync.conn, source_dir))]
+    phases = run_scenario(steps)
+    sync.conn.close()
+    return phases
+
+
+def remote_scenario(work_dir, source_dir):
+    target_dir = os.path.join(work_dir, 'remote')
+    reset_sync(os.path.join(work_dir, 'remote.db'))
+    sync.parm['remote'] = 'stand-in'
+    sync.parm['sessions'] = parm['sessions']
+    port, password = start_stand_in()
+    sync.cred.update({'host': '127.0.0.1', 'port': port, 'user': 'bench', 'pswd': password})
+    sync.RMT_SCRIPT = '"%s" "%s"' % (sys.executable, os.path.abspath('sync_rmt.py'))
+    sync.connect_ssh()
+    sync.agent_start()
+    sync.os_sep_rmt = sync.get_os_sep_rmt()
+    sync.check_target_dir_rmt(target_dir)
+    sync.check_target_dir_rmt(target_dir + '_z')
+    transfers = {}
+
+    def diff_copy(phase, target, compress):
+        # The bytes read and sent are counted in the copy phase, the difference is kept for this step
+        sync.parm['compress'] = compress
+        with sync.run_metrics.lock:
+            before = sync.run_metrics.get('copy')['bytes_read'], sync.run_metrics.get('copy')['bytes_sent']
+        sync.xfer_pool_start()
+        sync.find_missing_files(sync.conn, source_dir, target)
+        sync.xfer_pool_stop()
+        with sync.run_metrics.lock:
+            after = sync.run_metrics.get('copy')['bytes_read'], sync.run_metrics.get('copy')['bytes_sent']
+        transfers[phase] = (after[0] - before[0], after[1] - before[1])
+        sync.parm['compress'] = False
+
+    steps = [('scan_source', lambda: sync.scan_dir(sync.conn, source_dir)),
+             ('diff_copy_rmt', lambda: diff_copy('diff_copy_rmt', target_dir, False)),
+             ('diff_copy_rmt_z', lambda: diff_copy('diff_copy_rmt_z', target_dir + '_z', True)),
+             ('scan_target_rmt', lambda: sync.scan_dir_rmt(sync.conn, target_dir)),
+             ('diff_nothing_rmt', lambda: sync.find_missing_files(sync.conn, source_dir, target_dir))]
+    phases = run_scenario(steps)
+    for phase, (logical_bytes, wire_bytes) in transfers.items():
+        phases[phase]['logical_bytes'] = logical_bytes
+        phases[phase]['wire_bytes'] = wire_bytes
+        if logical_bytes > 0:
+            phases[phase]['wire_ratio'] = round(wire_bytes / logical_bytes, 3)
+    sync.conn.close()
+    sync.agent_stop()
+    sync.disconnect_ssh()
+    return phases
+
+
+def compare_baseline(results, baseline):
+    """
+    Compare the rates of each phase with the baseline.
+    :return: the number of rates below the baseline by more than the tolerance
+    """
+    regressions = 0
+    sync.print_log('I', 0, msg="Comparaison avec la référence", val=parm['baseline'])
+    for scenario, phases in results['scenarios'].items():
+        for phase_name, phase in phases.items():
+            base = baseline.get('scenarios', {}).get(scenario, {}).get(phase_name)
+            if base is None:
+                continue
+            for rate in RATES:
+                if not base.get(rate) or rate not in phase:
+                    continue
+                ratio = phase[rate] / base[rate]
+                if ratio < 1 - parm['tolerance']:
+                    regressions += 1
+                    sync.print_log('W', 1, msg="Régression %s %s %s" % (scenario, phase_name, rate),
+                                   val="%s / %s (%.0f%%)" % (phase[rate], base[rate], ratio * 100))
+                else:
+                    sync.print_log('I', 1, msg="%s %s %s" % (scenario, phase_name, rate),
+                                   val="%.0f%%" % (ratio * 100))
+    return regressions
+
+
+def main():
+    (options, sizes) = parse_options()
+    parm['files'] = options.files
+    parm['sizes'] = sizes
+    parm['depth'] = options.depth
+    parm['dup_ratio'] = options.dup_ratio
+    parm['seed'] = options.seed
+    parm['work_dir'] = options.work_dir
+    parm['remote'] = options.remote
+    parm['sessions'] = options.sessions
+    parm['baseline'] = options.baseline
+    parm['output'] = options.output
+    parm['tolerance'] = options.tolerance
+    parm['algorithms'] = options.algorithms
+    parm['text_ratio'] = options.text_ratio
+    sync.setup_logging('INFO')
+    sync.config = sync.parse_configs()
+    sync.parm['algo'] = sync.config['hash_algo']
+    sync.parm['verbose'] = False
+
+    if parm['work_dir'] is None:
+        work_dir = tempfile.mkdtemp(prefix='sync-bench-')
+    else:
+        work_dir = os.path.abspath(parm['work_dir'])
+        if os.path.exists(work_dir):
+            sync.print_log('E', 0, msg="Le dossier de travail existe déjà: ", val=work_dir, dotted=False)
+            return 8
+    source_dir = os.path.join(work_dir, 'source')
+    sync.print_log('I', 0, msg="Génération de l'arborescence", val=source_dir)
+    count_files, count_bytes = generate_tree(source_dir, sync.config['accept_list'], sync.config['reject_list'],
+                                             sync.config['store_list'])
+    sync.print_log('I', 1, msg="Fichiers", val=str(count_files))
+    sync.print_log('I', 1, msg="Bytes", val=str(count_bytes))
+
+    # The log lines of sync.py are not part of the measures
+    sync.logging.getLogger().setLevel(sync.logging.WARNING)
+    results = OrderedDict([('parms', dict(parm, sizes=list(parm['sizes']))),
+                           ('tree', {'files': count_files, 'bytes': count_bytes}),
+                           ('scenarios', OrderedDict())])
+    try:
+        if parm['algorithms'] is not None:
+            results['scenarios']['hash'] = hash_scenario(source_dir)
+        results['scenarios']['local'] = local_scenario(work_dir, source_dir)
+        if parm['remote']:
+            results['scenarios']['remote'] = remote_scenario(work_dir, source_dir)
+    finally:
+        sync.logging.getLogger().setLevel(sync.logging.INFO)
+        if parm['work_dir'] is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    for scenario, phases in results['scenarios'].items():
+        sync.print_log('I', 0, msg="Scénario " + scenario)
+        for phase_name, phase in phases.items():
+            sync.print_log('I', 1, msg=phase_name,
+                           val="%.3f s, %s fichiers/s, %s MB/s, %s rangées/s" %
+                               (phase['seconds'], phase.get('files_per_sec', '-'), phase.get('mb_per_sec', '-'),
+                                phase.get('db_rows_per_sec', '-')))
+            if 'wire_bytes' in phase:
+                sync.print_log('I', 2, msg="Bytes des fichiers / envoyés",
+                               val="%i / %i (%s)" % (phase['logical_bytes'], phase['wire_bytes'],
+                                                     phase.get('wire_ratio', '-')))
+
+    if parm['output'] is not None:
+        with open(parm['output'], 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+            output.write('\n')
+        sync.print_log('I', 0, msg="Résultats", val=parm['output'])
+
+    regressions = 0
+    if parm['baseline'] is not None:
+        with open(parm['baseline'], encoding='utf-8') as baseline:
+            regressions = compare_baseline(results, json.load(baseline))
+        sync.print_log('I', 0, msg="Régressions", val=str(regressions))
+    if regressions > 0:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
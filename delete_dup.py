@@ -8,8 +8,10 @@ import logging
 from optparse import OptionParser
 from sync import scan_dir
 from sync import parse_configs
+from sync import parm as sync_parm
 from sync import db_create_tables
 from sync import db_remove_deleted
+from dupfind import find_duplicates, walk_files, DupReport
 
 logging.basicConfig(level=logging.INFO, format=' %(asctime)s - %(levelname)s - %(message)s')
 
@@ -23,7 +25,7 @@ CONFIG_FILE = 'data' + os.sep + 'sync.cfg'
 
 
 # parms
-parm = {'delete': False, 'scan': False}
+parm = {'delete': False, 'scan': False, 'fast': False, 'verify': False, 'output': None}
 
 
 class File(object):
@@ -45,6 +47,12 @@ def parse_options():
                       help="Delete the duplicate files that are not in the keep directory.")
     parser.add_option("-s", "--scan", dest="scan", action="store_true", default=False,
                       help="Scan the scope directory. The default is to use the existing DB.")
+    parser.add_option("-f", "--fast", dest="fast", action="store_true", default=False,
+                      help="Find the duplicates on disk, by size then partial and full checksums, without the DB.")
+    parser.add_option("-v", "--verify", dest="verify", action="store_true", default=False,
+                      help="With -f, compare the duplicates byte by byte.")
+    parser.add_option("-o", "--output", dest="output", action="store", default=None,
+                      help="Write the duplicates to this file, as json lines or as csv if its name ends with .csv.")
     (options, args) = parser.parse_args()
     return options, args  # options: copy, rejects; args: source_dir
 
@@ -60,62 +68,108 @@ def db_get_name(dir_name):
     return db_name
 
 
-def list_dup(db_h, root_dir):
-
-    sel_md5 = \
-        '''
-        select file_md5, count(*)
-          from file
-         where file_md5 in (select file_md5 from file where dir_name = ?)
-         group by file_md5
-        having count(*) > 1
-        '''
+def list_dup(db_h, root_dir, report=None):
+    # One ordered pass on the file table: the groups of duplicates having a file in root_dir
     sel_dup = \
         '''
-        select dir_name, file_name, file_size, file_mtime
-          from file
-         where file_md5 = ?
+        select file_md5, dir_name, file_name, file_size, file_mtime
+          from (select file_md5, file_algo, dir_name, file_name, file_size, file_mtime,
+                       count(*) over w as dup_count,
+                       max(dir_name = ?) over w as in_dir
+                  from file
+                window w as (partition by file_algo, file_md5))
+         where dup_count > 1
+           and in_dir = 1
+         order by file_algo, file_md5, dir_name, file_name
        '''
 
+    def write_group():
+        stats['groups'] += 1
+        stats['reclaimable'] += files[0][1] * (len(files) - 1)
+        if report is not None:
+            report.write_group(root_dir, group_md5, files)
+            return
+        logging.info("Possible duplicates: %s" % group_md5)
+        for file_path, file_size, file_mtime in files:
+            logging.info("    Fichier......: %s" % file_path)
+            logging.info("        Size.....: %i" % file_size)
+            logging.info("        MTime....: %s" % file_mtime)
+        logging.info(" ")
+
+    stats = {'groups': 0, 'reclaimable': 0}
+    group_md5 = None
+    files = []
     try:
-        cur_md5 = db_h.cursor()
         cur_dup = db_h.cursor()
-        for row_md5 in cur_md5.execute(sel_md5, [root_dir]):
-            file_md5 = row_md5[0]
-            logging.info("Possible duplicates: %s" % file_md5)
-            for row_dup in cur_dup.execute(sel_dup, [file_md5]):
-                dir_name = row_dup[0]
-                file_name = row_dup[1]
-                file_size = row_dup[2]
-                file_mtime = row_dup[3]
-                logging.info("    Fichier......: %s" % dir_name + os.sep + file_name)
-                logging.info("        Size.....: %i" % file_size)
-                logging.info("        MTime....: %s" % file_mtime)
-            logging.info(" ")
+        for (file_md5, dir_name, file_name, file_size, file_mtime) in cur_dup.execute(sel_dup, [root_dir]):
+            if file_md5 != group_md5:
+                if files:
+                    write_group()
+                group_md5 = file_md5
+                files = []
+            files.append((dir_name + os.sep + file_name, file_size, file_mtime))
+        if files:
+            write_group()
     except sqlite3.Error as x:
         logging.error("SQL Error: \n" + str(x))
+    logging.info("Statistiques:")
+    logging.info("    Groupes de doublons..........................: %i" % stats['groups'])
+    logging.info("    Bytes récupérables...........................: %i" % stats['reclaimable'])
+
+
+def list_dup_fast(root_dir, keep_dir, report=None):
+    groups, stats = find_duplicates(walk_files(root_dir, config['path_filter']), parm['verify'],
+                                    config['hash_algo'])
+    for group in groups:
+        if report is not None:
+            report.write_group(root_dir, group['md5'], [(file_path, group['size'], None)
+                                                        for file_path in group['paths']])
+            continue
+        logging.info("Possible duplicates: %s" % group['md5'])
+        for file_path in group['paths']:
+            if os.path.dirname(file_path) == keep_dir:
+                logging.info("    Fichier......: %s (à conserver)" % file_path)
+            else:
+                logging.info("    Fichier......: %s" % file_path)
+        logging.info("        Size.....: %i" % group['size'])
+        logging.info(" ")
+    logging.info("Statistiques:")
+    logging.info("    Fichiers.....................................: %i" % stats['files'])
+    logging.info("    Candidats après la grosseur..................: %i" % stats['size'])
+    logging.info("    Candidats après le checksum partiel..........: %i" % stats['partial'])
+    logging.info("    Doublons après le checksum complet...........: %i" % stats['full'])
+    if parm['verify']:
+        logging.info("    Doublons après la comparaison................: %i" % stats['verified'])
+    logging.info("    Groupes de doublons..........................: %i" % len(groups))
+    reclaimable = sum(group['size'] * (len(group['paths']) - 1) for group in groups)
+    logging.info("    Bytes récupérables...........................: %i" % reclaimable)
+    logging.info("    Bytes des fichiers...........................: %i" % stats['bytes_total'])
+    logging.info("    Bytes lus....................................: %i" % stats['bytes_read'])
+    return groups
 
 
 def delete_dup(db_h, keep_dir):
     sel_md5 = \
         '''
-        select file_md5, count(*)
+        select file_algo, file_md5, count(*)
           from file
-         where file_md5 in (select file_md5 from file where dir_name = ?)
-         group by file_md5
+         where (file_algo, file_md5) in (select file_algo, file_md5 from file where dir_name = ?)
+         group by file_algo, file_md5
         having count(*) > 1
         '''
     sel_dup = \
         '''
         select dir_name, file_name
           from file
-         where file_md5 = ?
+         where file_algo = ?
+           and file_md5  = ?
            and dir_name <> ?
         '''
     del_dup = \
         '''
         delete from file
-         where file_md5 = ?
+         where file_algo = ?
+           and file_md5  = ?
            and dir_name <> ?
        '''
 
@@ -123,9 +177,10 @@ def delete_dup(db_h, keep_dir):
         cur_md5 = db_h.cursor()
         cur_dup = db_h.cursor()
         for row_md5 in cur_md5.execute(sel_md5, [keep_dir]):
-            file_md5 = row_md5[0]
-            logging.info("Possible duplicates: %s" % file_md5)
-            for row_dup in cur_dup.execute(sel_dup, [file_md5, keep_dir]):
+            file_algo = row_md5[0]
+            file_md5 = row_md5[1]
+            logging.info("Possible duplicates: %s:%s" % (file_algo, file_md5))
+            for row_dup in cur_dup.execute(sel_dup, [file_algo, file_md5, keep_dir]):
                 dir_name = row_dup[0]
                 file_name = row_dup[1]
                 logging.info("    Ce fichier sera effacé: %s" % dir_name + os.sep + file_name)
@@ -135,12 +190,18 @@ def delete_dup(db_h, keep_dir):
                     logging.error("    Ce fichier ne peut pas être effacé. " +
                                   " Il n'existe pas dans le répertoire à conserver.")
             logging.info(" ")
-            cur_dup.execute(del_dup, [file_md5, keep_dir])
+            cur_dup.execute(del_dup, [file_algo, file_md5, keep_dir])
 
     except sqlite3.Error as x:
         logging.error("SQL Error: \n" + str(x))
 
 
+def close_report(report):
+    if report is not None:
+        report.close()
+        logging.info("Rapport des doublons...........................: %s" % parm['output'])
+
+
 def main():
     global parm, config, conn
     logging.info('Début du programme ' + sys.argv[0])
@@ -149,6 +210,9 @@ def main():
     (options, args) = parse_options()
     parm["delete"] = options.delete
     parm["scan"] = options.scan
+    parm["fast"] = options.fast or options.verify
+    parm["verify"] = options.verify
+    parm["output"] = options.output
     if len(args) < 2:
         logging.error("Ce programme a besoin de deux arguments, le dossier source et le dossier à protéger.")
         return 8
@@ -187,6 +251,18 @@ def main():
         logging.info("    Accepted extension...........................: %s" % ext)
     for ext in config['reject_list']:
         logging.info("    Rejected extension...........................: %s" % ext)
+    logging.info("    Algorithme des checksums.....................: %s" % config['hash_algo'])
+    sync_parm['algo'] = config['hash_algo']
+
+    report = None
+    if parm['output'] is not None:
+        report = DupReport(parm['output'])
+
+    if parm['fast']:
+        list_dup_fast(source_dir, protec_dir, report)
+        close_report(report)
+        logging.info('Fin du programme ' + sys.argv[0])
+        return 0
 
     db_name = db_get_name(source_dir)
     db_path = source_dir + os.sep + db_name
@@ -202,7 +278,8 @@ def main():
     #    delete_dup(conn, protec_dir)
     #    db_remove_deleted(conn)       # Remove deleted files from db
     # else:
-    list_dup(conn, source_dir)
+    list_dup(conn, source_dir, report)
+    close_report(report)
 
     conn.commit()
     conn.close()
@@ -0,0 +1,145 @@
+import hashlib
+import itertools
+
+# Ce module est utilisé par sync.py et sync_rmt.py pour les transferts différentiels, à la rsync.
+# Il doit être copié à côté de sync_rmt.py sur le serveur distant.
+
+# Global constant
+BLOCK_MIN_SZ = 4096
+BLOCK_MAX_SZ = 128 * 1024
+READ_SZ = 1024 * 1024    # Grosseur des lectures du nouveau fichier
+LITERAL_MAX = 256 * 1024  # Grosseur maximale d'une donnée littérale
+PROBE_SZ = 4 * 1024 * 1024  # Après cette portion du fichier, la part littérale est vérifiée
+LITERAL_SHARE_MAX = 0.5  # Au-delà de cette part littérale, le transfert différentiel est abandonné
+MOD = 1 << 16
+
+
+def block_size(file_size):
+    """
+    Choose the block size from the size of the file, about its square root like rsync.
+    """
+    size = BLOCK_MIN_SZ
+    while size < BLOCK_MAX_SZ and size * size < file_size:
+        size *= 2
+    return size
+
+
+def weak_checksum(data):
+    """
+    The rolling checksum of a block.
+    :return: (a, b), the two halves of the checksum
+    """
+    a = sum(data) % MOD
+    b = sum(itertools.accumulate(data)) % MOD
+    return a, b
+
+
+def block_signatures(file_path, block_sz):
+    """
+    Compute the signature of each block of the file: the weak rolling checksum and the md5.
+    :return: a list of [weak, strong]
+    """
+    signatures = []
+    with open(file_path, "rb") as file:
+        while True:
+            block = file.read(block_sz)
+            if not block:
+                break
+            a, b = weak_checksum(block)
+            signatures.append([a | (b << 16), hashlib.md5(block).hexdigest()])
+    return signatures
+
+
+def compute_delta(file_path, signatures, block_sz, probe_sz=PROBE_SZ):
+    """
+    Compare the new version of a file with the signatures of the old one.
+    The rolling search is slow when few blocks match: once probe_sz bytes are compared, ValueError
+    is raised if the literal data is more than LITERAL_SHARE_MAX of them, a full copy is faster.
+    :return: a generator of ops, the index (int) of an old block to reuse or literal data (bytes)
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, []).append((index, strong))
+
+    literal = bytearray()
+    literal_sz = 0
+    matched_sz = 0
+    probed = False
+    buf = bytearray()
+    pos = 0
+    eof = False
+    a = b = None
+    with open(file_path, "rb") as file:
+        while True:
+            if len(buf) - pos < block_sz and not eof:
+                del buf[:pos]
+                pos = 0
+                chunk = file.read(READ_SZ)
+                if chunk:
+                    buf += chunk
+                else:
+                    eof = True
+                continue
+            n = min(block_sz, len(buf) - pos)
+            if n == 0:
+                break
+            if not probed and literal_sz + matched_sz >= probe_sz:
+                probed = True
+                if literal_sz > LITERAL_SHARE_MAX * (literal_sz + matched_sz):
+                    raise ValueError("Too few matching blocks: %i literal bytes of %i"
+                                     % (literal_sz, literal_sz + matched_sz))
+            if a is None:
+                a, b = weak_checksum(buf[pos:pos + n])
+            match = None
+            candidates = table.get(a | (b << 16))
+            if candidates is not None:
+                strong = hashlib.md5(buf[pos:pos + n]).hexdigest()
+                for index, sig_strong in candidates:
+                    if sig_strong == strong:
+                        match = index
+                        break
+            if match is not None:
+                if literal:
+                    yield bytes(literal)
+                    literal = bytearray()
+                yield match
+                matched_sz += n
+                pos += n
+                a = None
+                continue
+            if n < block_sz:
+                # The end of the file, shorter than a block, is sent as is
+                literal += buf[pos:pos + n]
+                break
+            # Roll the window by one byte
+            out_byte = buf[pos]
+            literal.append(out_byte)
+            literal_sz += 1
+            if len(literal) >= LITERAL_MAX:
+                yield bytes(literal)
+                literal = bytearray()
+            if pos + n < len(buf):
+                in_byte = buf[pos + n]
+                a = (a - out_byte + in_byte) % MOD
+                b = (b - n * out_byte + a) % MOD
+            else:
+                a = None
+            pos += 1
+    if literal:
+        yield bytes(literal)
+
+
+def apply_delta(base_path, out_file, ops, block_sz):
+    """
+    Write the new version of a file from the old one and the ops of compute_delta.
+    :param base_path: The old version of the file
+    :param out_file: The file object receiving the new version
+    :param ops: The indexes of the old blocks and the literal data
+    """
+    with open(base_path, "rb") as base:
+        for op in ops:
+            if isinstance(op, int):
+                base.seek(op * block_sz)
+                out_file.write(base.read(block_sz))
+            else:
+                out_file.write(op)
@@ -0,0 +1,176 @@
+import os
+import csv
+import json
+import hashlib
+from hashing import file_digest, CHUNK_SZ
+from walker import walk_tree
+from pathfilter import ACCEPTED
+
+# Recherche des doublons par étapes, utilisée par sync.py et delete_dup.py.
+# Seuls les fichiers qui restent candidats à la fin d'une étape sont lus par l'étape suivante:
+#   1. Grosseur
+#   2. Checksum partiel, du premier et du dernier bloc
+#   3. Checksum complet
+#   4. Comparaison byte par byte (optionnelle)
+
+# Global constant
+PARTIAL_SZ = 4096
+
+
+def walk_files(root_dir, path_filter):
+    """
+    List the files of a directory structure accepted by the filter. The excluded directories are not listed.
+    :param path_filter: PathFilter
+    :return: a generator of (file_path, file_size)
+    """
+    for entry in walk_tree(root_dir, path_filter.accept, path_filter.prune):
+        if path_filter.classify(entry.rel_path, entry.file_name, entry.ext) == ACCEPTED:
+            yield os.path.join(entry.dir_name, entry.file_name), entry.size
+
+
+def partial_md5(file_path, file_size, stats, algo='md5'):
+    """
+    The checksum of the first and last blocks. For a file not bigger than two blocks, it is the checksum of the file.
+    """
+    with open(file_path, "rb") as file:
+        if file_size <= 2 * PARTIAL_SZ:
+            data = file.read()
+        else:
+            data = file.read(PARTIAL_SZ)
+            file.seek(file_size - PARTIAL_SZ)
+            data += file.read(PARTIAL_SZ)
+    stats['bytes_read'] += len(data)
+    return hashlib.new(algo, data).hexdigest()
+
+
+def same_content(path_a, path_b, stats):
+    with open(path_a, "rb") as file_a, open(path_b, "rb") as file_b:
+        while True:
+            chunk_a = file_a.read(CHUNK_SZ)
+            chunk_b = file_b.read(CHUNK_SZ)
+            stats['bytes_read'] += len(chunk_a) + len(chunk_b)
+            if chunk_a != chunk_b:
+                return False
+            if not chunk_a:
+                return True
+
+
+def split_identical(paths, stats):
+    """
+    Split a group of files by their content, comparing them byte by byte.
+    """
+    groups = []
+    for path in paths:
+        for group in groups:
+            if same_content(group[0], path, stats):
+                group.append(path)
+                break
+        else:
+            groups.append([path])
+    return [group for group in groups if len(group) > 1]
+
+
+def regroup(groups, key_function):
+    """
+    Split each group of files by the key computed for each file. The files alone with their key are dropped.
+    :return: a list of (key, group)
+    """
+    result = []
+    for group in groups:
+        by_key = {}
+        for item in group:
+            try:
+                key = key_function(item)
+            except OSError:
+                continue
+            by_key.setdefault(key, []).append(item)
+        result.extend([(key, candidates) for key, candidates in by_key.items() if len(candidates) > 1])
+    return result
+
+
+def find_duplicates(files, verify=False, algo='md5'):
+    """
+    Find the groups of identical files.
+    :param files: iterable of (file_path, file_size)
+    :param verify: Compare the files of each group byte by byte after the full checksum
+    :param algo: The hashlib algorithm of the checksums
+    :return: (groups, stats). Each group is a dict with the size, the checksum (md5 key) and the paths of the files.
+             stats has the counts of candidates after each step, the total bytes and the bytes read.
+    """
+    stats = {'files': 0, 'bytes_total': 0, 'bytes_read': 0, 'size': 0, 'partial': 0, 'full': 0, 'verified': 0}
+
+    # 1. Size. The empty files are ignored, there is nothing to reclaim
+    by_size = {}
+    for file_path, file_size in files:
+        stats['files'] += 1
+        stats['bytes_total'] += file_size
+        if file_size > 0:
+            by_size.setdefault(file_size, []).append((file_path, file_size))
+    groups = [candidates for candidates in by_size.values() if len(candidates) > 1]
+    stats['size'] = sum(len(group) for group in groups)
+
+    # 2. First and last blocks
+    groups = regroup(groups, lambda item: partial_md5(item[0], item[1], stats, algo))
+    stats['partial'] = sum(len(group) for key, group in groups)
+
+    # 3. Full checksum. For the small files, the partial checksum is already the full checksum
+    result = []
+    for partial, group in groups:
+        file_size = group[0][1]
+        if file_size <= 2 * PARTIAL_SZ:
+            full_groups = [(partial, group)]
+        else:
+            stats['bytes_read'] += file_size * len(group)
+            full_groups = regroup([group], lambda item: file_digest(item[0], algo))
+        for file_md5, full_group in full_groups:
+            result.append({'size': file_size, 'md5': file_md5, 'paths': sorted([item[0] for item in full_group])})
+    stats['full'] = sum(len(group['paths']) for group in result)
+
+    # 4. Byte by byte
+    if verify:
+        verified = []
+        for group in result:
+            for paths in split_identical(group['paths'], stats):
+                verified.append({'size': group['size'], 'md5': group['md5'], 'paths': paths})
+        result = verified
+        stats['verified'] = sum(len(group['paths']) for group in result)
+
+    result.sort(key=lambda group: group['paths'][0])
+    return result, stats
+
+
+class DupReport(object):
+    """
+    Write the groups of duplicates to a file, one json object per group
+    or, when the file name ends with .csv, one csv row per file.
+    Each group has its number of files and the bytes reclaimable by keeping only one of them.
+    """
+    def __init__(self, report_path):
+        self.as_csv = report_path.lower().endswith('.csv')
+        self.file = open(report_path, 'w', newline='', encoding='utf-8')
+        self.groups = 0
+        self.files = 0
+        self.reclaimable = 0
+        if self.as_csv:
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['root_dir', 'md5', 'group_size', 'reclaimable', 'path', 'size', 'mtime'])
+
+    def write_group(self, root_dir, file_md5, files):
+        """
+        :param files: list of (file_path, file_size, file_mtime)
+        """
+        reclaimable = files[0][1] * (len(files) - 1)
+        self.groups += 1
+        self.files += len(files)
+        self.reclaimable += reclaimable
+        if self.as_csv:
+            for file_path, file_size, file_mtime in files:
+                self.writer.writerow([root_dir, file_md5, len(files), reclaimable, file_path, file_size, file_mtime])
+        else:
+            self.file.write(json.dumps({'root_dir': root_dir, 'md5': file_md5, 'group_size': len(files),
+                                        'reclaimable': reclaimable,
+                                        'files': [{'path': file_path, 'size': file_size, 'mtime': file_mtime}
+                                                  for file_path, file_size, file_mtime in files]}) + '\n')
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,78 @@
+import hashlib
+import mmap
+import os
+
+# Ce module est utilisé par sync.py, sha256.py et sync_rmt.py.
+# Il doit être copié à côté de sync_rmt.py sur le serveur distant.
+
+# Global constant
+CHUNK_SZ = 1024 * 1024     # Grosseur des blocs lus, la mémoire utilisée ne dépend pas de la grosseur du fichier
+MMAP_MIN_SZ = 64 * 1024    # En bas de cette grosseur, mmap ne vaut pas la peine
+# Algorithmes permis pour les checksums des fichiers, sans les variantes à longueur variable (shake)
+ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'blake2s', 'sha3_256')
+
+
+def hash_file(file_path, algos=('md5',), use_mmap=False, chunk_sz=CHUNK_SZ):
+    """
+    Compute one or many digests of a file in a single pass, reading it by fixed size chunks.
+    :param file_path: The file to hash
+    :param algos: The hashlib algorithm names, e.g. ('md5', 'sha256')
+    :param use_mmap: Map the file in memory instead of reading it. The pages are released by the OS as needed.
+    :param chunk_sz: The number of bytes fed to the digests at a time
+    :return: a dict of hex digests keyed by algorithm name
+    """
+    digests = [(algo, hashlib.new(algo)) for algo in algos]
+    with open(file_path, "rb") as file_to_check:
+        file_size = os.fstat(file_to_check.fileno()).st_size
+        if use_mmap and file_size >= MMAP_MIN_SZ:
+            with mmap.mmap(file_to_check.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                view = memoryview(data)
+                try:
+                    for offset in range(0, file_size, chunk_sz):
+                        chunk = view[offset:offset + chunk_sz]
+                        for algo, digest in digests:
+                            digest.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(chunk_sz)
+            view = memoryview(buffer)
+            while True:
+                size = file_to_check.readinto(buffer)
+                if size == 0:
+                    break
+                for algo, digest in digests:
+                    digest.update(view[:size])
+    result = {}
+    for algo, digest in digests:
+        result[algo] = digest.hexdigest()
+    return result
+
+
+def file_digest(file_path, algo='md5', use_mmap=False):
+    """
+    Compute the checksum of a file with one algorithm.
+    :param file_path: The file to hash
+    :param algo: The hashlib algorithm name, see ALGORITHMS
+    :param use_mmap: See hash_file
+    :return: the hex digest
+    """
+    return hash_file(file_path, (algo,), use_mmap)[algo]
+
+
+def supported_algo(algo):
+    """
+    :return: True if the algorithm can be used for the checksums of the files
+    """
+    return algo in ALGORITHMS and algo in hashlib.algorithms_available
+
+
+def md5_file(file_path, use_mmap=False):
+    """
+    Compute the MD5 checksum of a file without loading it in memory.
+    :param file_path: The file to hash
+    :param use_mmap: See hash_file
+    :return: the hex digest
+    """
+    return hash_file(file_path, ('md5',), use_mmap)['md5']
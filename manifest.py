@@ -0,0 +1,150 @@
+import os
+import sys
+import re
+import heapq
+import tempfile
+
+# Manifestes triés des fichiers d'une arborescence, utilisés par sync.py en mode manifeste (-m M)
+# et produits par sync_rmt.py -s -M. Il doit être copié à côté de sync_rmt.py sur le serveur distant.
+# Une ligne par fichier: chemin relatif, nom, grosseur, date de modification et checksum, séparés par
+# des tabulations. Les caractères de contrôle et le \ sont échappés, la tabulation est donc le plus petit
+# caractère d'une ligne et l'ordre des lignes est celui des clés (chemin relatif, nom).
+# La première ligne est l'entête: version, algorithme des checksums et racine.
+
+# Global constant
+MANIFEST_VERSION = '1'
+RUN_LINES = 500000  # Nombre de lignes triées en mémoire avant d'être écrites dans un fichier temporaire
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'  # Les noms de fichiers non décodables sont conservés tels quels
+ESCAPE_RE = re.compile(r'[\x00-\x1f\\]')
+UNESCAPE_RE = re.compile(r'\\(\\|x[0-9a-f]{2})')
+
+
+def escape(value):
+    return ESCAPE_RE.sub(lambda match: '\\\\' if match.group() == '\\' else '\\x%02x' % ord(match.group()), value)
+
+
+def unescape(value):
+    return UNESCAPE_RE.sub(lambda match: '\\' if match.group(1) == '\\' else chr(int(match.group(1)[1:], 16)), value)
+
+
+class ManifestWriter(object):
+    """
+    Write a sorted manifest. The lines are sorted in memory by runs of RUN_LINES, written to temporary
+    files, then merged when the manifest is closed. The memory used does not depend on the number of files.
+    :param manifest_path: The manifest file, - for stdout
+    :param algo: The algorithm of the checksums
+    :param root_dir: The root of the tree, kept in the header
+    """
+    def __init__(self, manifest_path, algo, root_dir):
+        self.manifest_path = manifest_path
+        self.header = '\t'.join(['#manifest', MANIFEST_VERSION, algo, escape(root_dir)]) + '\n'
+        if manifest_path == '-':
+            self.tmp_dir = None
+        else:
+            self.tmp_dir = os.path.dirname(os.path.abspath(manifest_path))
+        self.lines = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, rel_path, file_name, file_size, file_mtime, file_md5):
+        """
+        :param rel_path: The relative path of the directory, with / as separator, '.' for the root
+        """
+        self.lines.append('\t'.join([escape(rel_path), escape(file_name), str(file_size), file_mtime,
+                                     file_md5 or '']) + '\n')
+        self.count += 1
+        if len(self.lines) >= RUN_LINES:
+            self.write_run()
+
+    def write_run(self):
+        self.lines.sort()
+        run = tempfile.TemporaryFile(mode='w+', encoding=ENCODING, errors=ERRORS, dir=self.tmp_dir)
+        run.writelines(self.lines)
+        run.seek(0)
+        self.runs.append(run)
+        self.lines = []
+
+    def close(self):
+        self.lines.sort()
+        if self.manifest_path == '-':
+            out_file = open(sys.stdout.fileno(), 'w', encoding=ENCODING, errors=ERRORS, closefd=False)
+        else:
+            out_file = open(self.manifest_path, 'w', encoding=ENCODING, errors=ERRORS)
+        try:
+            out_file.write(self.header)
+            if self.runs:
+                out_file.writelines(heapq.merge(self.lines, *self.runs))
+            else:
+                out_file.writelines(self.lines)
+        finally:
+            for run in self.runs:
+                run.close()
+            self.lines = []
+            self.runs = []
+            out_file.close()
+
+
+def read_header(manifest_file):
+    """
+    :return: (algo, root_dir) of the manifest
+    """
+    return parse_header(manifest_file.readline())
+
+
+def parse_header(line):
+    """
+    :return: (algo, root_dir) of the first line of a manifest
+    """
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) != 4 or fields[0] != '#manifest' or fields[1] != MANIFEST_VERSION:
+        raise ValueError("Invalid manifest header")
+    return fields[2], unescape(fields[3])
+
+
+def read_records(manifest_file):
+    """
+    Read the lines of a manifest after its header.
+    :return: a generator of (key, rel_path, file_name, file_size, file_mtime, file_md5).
+             The keys are in increasing order, the same order for all the manifests.
+    """
+    for line in manifest_file:
+        rel_path, file_name, file_size, file_mtime, file_md5 = line.rstrip('\n').split('\t')
+        yield rel_path + '\t' + file_name, unescape(rel_path), unescape(file_name), int(file_size), file_mtime, \
+            file_md5 or None
+
+
+def merge_join(source_records, target_records):
+    """
+    Left join of two sorted manifests, in a single pass and constant memory.
+    Each source file is classified like find_missing_files does: N(ew), S(ame checksum),
+    U(pdated, the source is newer) or O(lder, the target is newer).
+    :return: a generator of (diff, source record, target record or None)
+    """
+    target = next(target_records, None)
+    for source in source_records:
+        while target is not None and target[0] < source[0]:
+            target = next(target_records, None)
+        if target is None or target[0] != source[0]:
+            yield 'N', source, None
+        elif source[5] is not None and source[5] == target[5]:
+            yield 'S', source, target
+        elif source[4] > target[4]:
+            yield 'U', source, target
+        else:
+            yield 'O', source, target
+
+
+def join_manifests(source_path, target_path):
+    """
+    Open two manifests and join them with merge_join. Their checksums must use the same algorithm.
+    :return: a generator of (diff, source record, target record or None)
+    """
+    with open(source_path, encoding=ENCODING, errors=ERRORS) as source_file, \
+            open(target_path, encoding=ENCODING, errors=ERRORS) as target_file:
+        source_algo = read_header(source_file)[0]
+        target_algo = read_header(target_file)[0]
+        if source_algo != target_algo:
+            raise ValueError("The manifests use different algorithms: %s and %s" % (source_algo, target_algo))
+        for row in merge_join(read_records(source_file), read_records(target_file)):
+            yield row
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Mesures de performance par phase, utilisées par sync.py pour le rapport d'exécution.
+# Chaque phase a sa durée et ses compteurs. Les compteurs sont ajoutés à la phase courante
+# du thread qui les mesure, les threads des copies ont leur propre phase.
+
+# Global constant
+COUNTERS = ('files', 'bytes_read', 'bytes_hashed', 'bytes_sent', 'db_rows', 'round_trips')
+OTHER = 'other'  # Phase des mesures prises en dehors de toute phase
+
+
+class Phase(object):
+    """
+    The context manager returned by RunMetrics.phase.
+    """
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.metrics.stack().append(self.name)
+        self.metrics.begin(self.name, self.start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.stack().pop()
+        self.metrics.end(self.name, self.start, time.time())
+        return False
+
+
+class RunMetrics(object):
+    """
+    Wall time and counters of the phases of a run.
+    A phase can be entered many times and by many threads. Its wall time goes from its first start
+    to its last end, its busy time is the sum of the time spent in it by all the threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = OrderedDict()
+        self.start = time.time()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def get(self, name):
+        if name not in self.phases:
+            values = OrderedDict([('start', None), ('end', None), ('busy', 0.0)])
+            for counter in COUNTERS:
+                values[counter] = 0
+            self.phases[name] = values
+        return self.phases[name]
+
+    def phase(self, name):
+        """
+        :return: a context manager measuring the time spent in the phase by the calling thread
+        """
+        return Phase(self, name)
+
+    def current(self):
+        stack = self.stack()
+        if stack:
+            return stack[-1]
+        return OTHER
+
+    def begin(self, name, start):
+        with self.lock:
+            values = self.get(name)
+            if values['start'] is None:
+                values['start'] = start
+
+    def end(self, name, start, end):
+        with self.lock:
+            values = self.get(name)
+            values['end'] = end
+            values['busy'] += end - start
+
+    def add(self, counter, value=1, phase=None):
+        """
+        Add to a counter of a phase, by default the current phase of the calling thread.
+        """
+        if phase is None:
+            phase = self.current()
+        with self.lock:
+            self.get(phase)[counter] += value
+
+    def report(self, **info):
+        """
+        :param info: Other values of the run, added to the report as is
+        :return: the report as a dict: the run times, the phases and the totals
+        """
+        end = time.time()
+        report = OrderedDict()
+        report['start'] = time.strftime("%Y-%m-%d-%H.%M.%S", time.localtime(self.start))
+        report['end'] = time.strftime("%Y-%m-%d-%H.%M.%S", time.localtime(end))
+        report['seconds'] = round(end - self.start, 3)
+        report.update(info)
+        phases = OrderedDict()
+        totals = OrderedDict([(counter, 0) for counter in COUNTERS])
+        with self.lock:
+            for name, values in self.phases.items():
+                if values['start'] is None:
+                    seconds = 0.0
+                else:
+                    seconds = (values['end'] or end) - values['start']
+                phase = OrderedDict([('seconds', round(seconds, 3)), ('busy_seconds', round(values['busy'], 3))])
+                for counter in COUNTERS:
+                    phase[counter] = values[counter]
+                    totals[counter] += values[counter]
+                if seconds > 0:
+                    phase['files_per_sec'] = round(values['files'] / seconds, 1)
+                    phase['mb_per_sec'] = round(max(values['bytes_read'], values['bytes_sent']) / seconds
+                                                / 1024 / 1024, 2)
+                phases[name] = phase
+        report['phases'] = phases
+        report['totals'] = totals
+        return report
@@ -0,0 +1,101 @@
+import os
+import re
+import fnmatch
+
+# Filtre des fichiers et des dossiers, utilisé par sync.py, delete_dup.py et sync_rmt.py.
+# Il doit être copié à côté de sync_rmt.py sur le serveur distant.
+# Les extensions sont dans des ensembles, les globs et les regex de chaque liste sont compilés
+# en une seule regex. Les chemins sont relatifs à la racine, avec / comme séparateur.
+# Un dossier exclu n'est jamais listé: son nom ou son chemin relatif correspond à EXCLUDE_DIRS.
+
+# Global constant
+FILTER_KEYS = ('exclude_dirs', 'exclude_dirs_re', 'include_paths', 'include_paths_re',
+               'exclude_paths', 'exclude_paths_re')
+
+# Classes of the files
+ACCEPTED = 'A'
+REJECTED = 'R'  # Rejected extension
+EXCLUDED = 'X'  # Accepted extension, excluded by a path pattern
+OTHER = 'O'  # Unknown extension
+
+
+def compile_patterns(globs=(), regexes=()):
+    """
+    Compile the globs and the regexes in a single regex.
+    :return: the compiled regex, or None if there are no patterns
+    """
+    parts = [fnmatch.translate(glob) for glob in globs if glob]
+    parts += ['(?:%s)\\Z' % regex for regex in regexes if regex]
+    if not parts:
+        return None
+    return re.compile('|'.join(parts))
+
+
+class PathFilter(object):
+    """
+    Classify the files by extension and path, and tell the walker which directories to prune.
+    :param accept_list: The accepted extensions, in lower case
+    :param reject_list: The rejected extensions, in lower case
+    :param filters: dict of lists keyed by FILTER_KEYS. The dirs patterns match the name or the
+                    relative path of a directory, the paths patterns the relative path of a file.
+    """
+    def __init__(self, accept_list, reject_list, filters=None):
+        if filters is None:
+            filters = {}
+        self.accept = frozenset(accept_list)
+        self.reject = frozenset(reject_list)
+        self.filters = dict((key, list(filters.get(key, []))) for key in FILTER_KEYS)
+        self.exclude_dirs = compile_patterns(self.filters['exclude_dirs'], self.filters['exclude_dirs_re'])
+        self.include_paths = compile_patterns(self.filters['include_paths'], self.filters['include_paths_re'])
+        self.exclude_paths = compile_patterns(self.filters['exclude_paths'], self.filters['exclude_paths_re'])
+
+    def prune(self, rel_dir, dir_name):
+        """
+        :param rel_dir: The path of the directory relative to the root
+        :param dir_name: The name of the directory
+        :return: True if the directory and its subtree are excluded
+        """
+        if self.exclude_dirs is None:
+            return False
+        if os.sep != '/':
+            rel_dir = rel_dir.replace(os.sep, '/')
+        return self.exclude_dirs.match(dir_name) is not None or self.exclude_dirs.match(rel_dir) is not None
+
+    def classify(self, rel_dir, file_name, ext):
+        """
+        :param rel_dir: The path of the directory of the file relative to the root, '.' for the root
+        :return: ACCEPTED, REJECTED, EXCLUDED or OTHER
+        """
+        if ext in self.accept:
+            if self.include_paths is None and self.exclude_paths is None:
+                return ACCEPTED
+            if rel_dir == '.':
+                rel_path = file_name
+            else:
+                rel_path = rel_dir.replace(os.sep, '/') + '/' + file_name
+            if self.include_paths is not None and self.include_paths.match(rel_path) is None:
+                return EXCLUDED
+            if self.exclude_paths is not None and self.exclude_paths.match(rel_path) is not None:
+                return EXCLUDED
+            return ACCEPTED
+        if ext in self.reject:
+            return REJECTED
+        return OTHER
+
+
+def read_filters(cfg_parser):
+    """
+    Read the [filters] section of the configuration. The globs are separated by commas,
+    the regexes are one per line.
+    :return: dict of lists keyed by FILTER_KEYS
+    """
+    filters = {}
+    for key in FILTER_KEYS:
+        value = ''
+        if cfg_parser.has_section('filters'):
+            value = cfg_parser['filters'].get(key.upper(), '')
+        if key.endswith('_re'):
+            filters[key] = [line.strip() for line in value.splitlines() if line.strip()]
+        else:
+            filters[key] = [glob.strip() for glob in value.split(',') if glob.strip()]
+    return filters
@@ -1,11 +1,11 @@
-import hashlib
+import sys
+from hashing import hash_file
 
-# Open,close, read file and calculate MD5 on its contents
-with open(r"C:\Users\Jean\Downloads\Python\python-2.7.11.amd64.msi", "rb") as file_to_check:
-    # read contents of the file
-    data = file_to_check.read()
-    # pipe contents of the file through
-    file_sha256 = hashlib.sha256(data).hexdigest()
-    print("SHA-256..: " + file_sha256)
-    file_md5 = hashlib.md5(data).hexdigest()
-    print("MD5......: " + file_md5)
\ No newline at end of file
+# Read the file by chunks and calculate SHA-256 and MD5 on its contents in a single pass
+if len(sys.argv) > 1:
+    file_path = sys.argv[1]
+else:
+    file_path = r"C:\Users\Jean\Downloads\Python\python-2.7.11.amd64.msi"
+digests = hash_file(file_path, ('sha256', 'md5'))
+print("SHA-256..: " + digests['sha256'])
+print("MD5......: " + digests['md5'])
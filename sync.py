@@ -1,14 +1,34 @@
 import os
 import sys
+import stat
 import time
 import configparser
 import sqlite3
 import hashlib
 import logging
+import logging.handlers
 import shutil
 import paramiko
 import json
+import base64
+import zlib
+import subprocess
+import threading
+import queue
+import tempfile
+from collections import deque
+from itertools import groupby
+from operator import itemgetter, attrgetter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from optparse import OptionParser
+from hashing import file_digest, supported_algo
+from delta import block_size, compute_delta
+from dupfind import find_duplicates, walk_files, DupReport
+from metrics import RunMetrics
+from walker import walk_tree
+from pathfilter import PathFilter, read_filters, ACCEPTED, REJECTED, EXCLUDED
+import manifest
+from manifest import ManifestWriter, join_manifests
 
 # Global variable
 config = {}
@@ -17,23 +37,81 @@ conn = None  # DB handle
 ssh_client = None
 ftp_client = None
 os_sep_rmt = '/'
+agent = None  # Session avec l'agent sync_rmt.py -A
+xfer_pool = None  # Sessions SFTP parallèles pour les copies
+rmt_dirs = set()  # Dossiers distants dont l'existence est connue
+xfer_done = deque()  # Copies terminées, réussies ou non, à noter dans la BD
+xfer_resume = {}  # Copies à reprendre: source_path: (grosseur, date) de la version de la source dans le .part
+delta_stats = {'files': 0, 'bytes': 0, 'sent': 0, 'received': 0}
+# Copies distantes avec --compress: fichiers compressés ou non, bytes lus et bytes envoyés
+compress_stats = {'compressed': 0, 'stored_ext': 0, 'stored_sample': 0, 'bytes': 0, 'wire': 0}
+log_buffer = None  # Tampon des messages du log
+progress_state = {'last': 0.0, 'start': {}}  # Heure du dernier message de progression et du début de chaque phase
+run_metrics = RunMetrics()  # Durées et compteurs de chaque phase, pour le rapport d'exécution
+hash_counts = {'computed': 0, 'skipped': 0, 'migrated': 0}
+filter_counts = {'excluded': 0, 'pruned': 0}  # Fichiers et dossiers exclus par les filtres
+hash_pool = None  # Pool de calcul des checksums
+file_buffer = []  # Fichiers en attente d'écriture dans la BD
 
 # Global constant
 CONFIG_FILE = 'data' + os.sep + 'sync.cfg'
+RMT_SCRIPT = '/home/jean/sync_rmt.py'
+AGENT_BATCH_SZ = 100  # Nombre de chemins par requête à l'agent
+AGENT_WINDOW = 4  # Nombre de requêtes envoyées à l'agent avant de lire les réponses
+XFER_ATTEMPTS = 3  # Nombre d'essais pour une copie
+MANIFEST_CHUNK_SZ = 1024 * 1024  # Grosseur des blocs du manifeste distant lus par SSH
+MKDIR_BATCH_SZ = 50  # Nombre de dossiers par commande mkdir distante
+XFER_CHUNK_SZ = 1024 * 1024  # Grosseur des blocs envoyés par SFTP
+PART_SFX = '.part'  # Suffixe du fichier distant pendant la copie
+DELTA_MIN_SZ = 1024 * 1024  # En bas de cette grosseur, le fichier est copié au complet
+DELTA_REQUEST_SZ = 1024 * 1024  # Grosseur des requêtes patch envoyées à l'agent
+COMPRESS_MIN_SZ = 8 * 1024  # En bas de cette grosseur, le fichier est copié sans compression
+COMPRESS_SAMPLE_SZ = 64 * 1024  # Grosseur de l'échantillon compressé pour décider de la compression
+COMPRESS_LEVEL = 6  # Niveau de compression zlib des copies
+COMPRESS_REQUEST_SZ = 1024 * 1024  # Bytes du fichier compressés par requête zwrite envoyée à l'agent
+COMPRESS_RATIO = 0.8  # Ratio maximal, après base64, de l'échantillon compressé sur l'échantillon
+LOG_BUFFER_SZ = 1000  # Nombre de messages gardés en mémoire avant d'être écrits
+PROGRESS_SEC = 10  # Délai entre deux messages de progression
+LOG_LEVELS = {'C': logging.CRITICAL, 'E': logging.ERROR, 'W': logging.WARNING, 'I': logging.INFO, 'D': logging.DEBUG}
+LOG_PREFIX = {'C': "", 'E': "   ", 'W': " ", 'I': "    ", 'D': "   "}
 INDENT_SZ = 4
 MSG_LGT = 60
+POOL_QUEUE_SZ = 4  # Nombre de fichiers en attente par processus du pool
+PIPELINE_QUEUE_SZ = 1000  # Nombre de fichiers en attente entre l'inspection et la comparaison du mode C
+PIPELINE_WAIT_SEC = 1  # Délai entre deux vérifications de l'arrêt des étapes du mode C
+DB_BATCH_SZ = 5000  # Nombre de fichiers écrits par transaction
+DB_CACHE_KB = 65536  # Grosseur de la cache de sqlite
 
 # parms
 # --copie:   True, False
 # --dup:     S(ource), C(ible) or T(ous)
 # --remote:  Fichier de connection ou None
-# --mode:    (P)rogressif ou (S)tandard
+# --mode:    (P)rogressif, (S)tandard, (M)anifeste ou (C)ontinu
 # --logging: DEBUG, INFO, WARNING, ERROR ou CRITICAL
-parm = {'copy': False, 'dup': 'N', 'remote': None, 'mode': 'S', 'log': 'INFO'}
+# --incremental: True, False
+# --mmap:    True, False
+# --jobs:    Nombre de processus pour le calcul des checksums
+# --pool:    (P)rocessus ou (T)hreads
+# --sessions: Nombre de sessions SFTP pour les copies
+# --delta:   True, False
+# --fast-dup: True, False
+# --verify-dup: True, False
+# --dup-report: Fichier du rapport des doublons (json lines ou .csv) ou None
+# --verbose: True, False
+# --progress: Délai en secondes entre les messages de progression, 0 pour aucun
+# --report:  Fichier json du rapport d'exécution ou None
+# --manifest-dir: Dossier des manifestes du mode M
+# --fix-dates: True, False
+# algo:      Algorithme des checksums, de la configuration puis négocié avec l'agent distant
+parm = {'copy': False, 'dup': 'N', 'remote': None, 'mode': 'S', 'log': 'INFO', 'incremental': False, 'mmap': False,
+        'jobs': 1, 'pool': 'T', 'sessions': 1, 'delta': False, 'compress': False, 'fast_dup': False,
+        'verify_dup': False, 'dup_report': None, 'verbose': False, 'progress': PROGRESS_SEC, 'report': None,
+        'manifest_dir': None, 'fix_dates': False, 'algo': 'md5'}
 
 
 class File(object):
-    def __init__(self, file_name, file_md5, file_mtime, file_size, dir_name, root_dir, rel_path, local_rmt):
+    def __init__(self, file_name, file_md5, file_mtime, file_size, dir_name, root_dir, rel_path, local_rmt,
+                 file_fprint='', file_algo=None):
         self.file_name = file_name
         self.file_md5 = file_md5
         self.file_mtime = file_mtime
@@ -42,13 +120,208 @@ class File(object):
         self.root_dir = root_dir
         self.rel_path = rel_path
         self.local_rmt = local_rmt
+        self.file_fprint = file_fprint  # inode et ctime, pour le mode incrémental
+        if file_algo is None:
+            file_algo = parm['algo']
+        self.file_algo = file_algo  # Algorithme du checksum file_md5
 
     def __str__(self):
-        return "File:\nDir: " + self.dir_name + "\nFile: " + self.file_name + "\nMD5: " + self.file_md5 + \
+        return "File:\nDir: " + self.dir_name + "\nFile: " + self.file_name + \
+               "\nChecksum: " + self.file_algo + ":" + self.file_md5 + \
                "\nMTime: " + self.file_mtime + " Size: " + str(self.file_size) + " Local/Remote: " + self.local_rmt + \
                "\nRoot dir: " + self.root_dir + "\nRelative Path: " + self.rel_path
 
 
+class AgentSession(object):
+    """
+    Client of the sync_rmt.py agent (-A) over a single channel.
+    The requests are json lines written on the agent stdin, the responses are read from its stdout
+    in the same order. Many requests can be sent before reading the responses.
+    """
+    def __init__(self, stdin, stdout, process=None):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.process = process
+        self.next_id = 0
+        self.responses = {}
+        self.algo = 'md5'  # Algorithme des checksums de l'agent, négocié par negotiate_algo
+
+    def send(self, op, **args):
+        self.next_id += 1
+        args['id'] = self.next_id
+        args['op'] = op
+        self.stdin.write(json.dumps(args) + '\n')
+        run_metrics.add('round_trips')
+        return self.next_id
+
+    def recv(self, req_id):
+        self.stdin.flush()
+        while req_id not in self.responses:
+            line = self.stdout.readline()
+            if not line:
+                raise IOError("The agent closed the session.")
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            response = json.loads(line)
+            self.responses[response['id']] = response
+        response = self.responses.pop(req_id)
+        if not response['ok']:
+            print_log('E', 0, msg="Agent Error: ", val=response['error'], dotted=False)
+            return None
+        return response['result']
+
+    def call(self, op, **args):
+        return self.recv(self.send(op, **args))
+
+    def call_many(self, op, paths):
+        """
+        Send the paths by batches of AGENT_BATCH_SZ, with at most AGENT_WINDOW batches in flight.
+        :return: the list of results, in the order of the paths
+        """
+        results = []
+        pending = deque()
+        for i in range(0, len(paths), AGENT_BATCH_SZ):
+            if len(pending) >= AGENT_WINDOW:
+                results.extend(self.recv_batch(pending.popleft()))
+            pending.append((self.send(op, paths=paths[i:i + AGENT_BATCH_SZ]), min(AGENT_BATCH_SZ, len(paths) - i)))
+        while pending:
+            results.extend(self.recv_batch(pending.popleft()))
+        return results
+
+    def recv_batch(self, request):
+        req_id, count = request
+        result = self.recv(req_id)
+        if result is None:
+            return [None] * count
+        return result
+
+    def close(self):
+        try:
+            self.send('quit')
+            self.stdin.flush()
+            self.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process is not None:
+            self.process.wait()
+
+
+class CopyJob(object):
+    def __init__(self, source_path, target_path, file=None, kind=None, delta=False):
+        self.source_path = source_path
+        self.target_path = target_path
+        self.file = file  # File to store in the DB when the copy is done
+        self.kind = kind  # Counter to increment when the copy is done
+        self.rc = None
+        self.size = 0
+        self.error = None
+        self.mtime = None  # Date of the source when the copy started
+        self.resumed = 0  # Bytes already on the remote host when the copy started
+        self.delta = delta  # The target exists, only the differences can be sent
+        self.sent = 0  # Bytes sent to the remote host
+        self.received = 0  # With delta, bytes of the signatures received from the remote host
+        self.compress = None  # With --compress: compressed, stored_ext or stored_sample
+
+
+class TransferPool(object):
+    """
+    Copy the files to the remote host with many SSH/SFTP sessions, or to the local target with many threads.
+    Each worker thread owns its session. After an error, a worker reconnects its own session
+    and retries the job without disturbing the other workers.
+    """
+    def __init__(self, sessions):
+        self.jobs = queue.Queue(maxsize=sessions * POOL_QUEUE_SZ)
+        self.done = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'errors': 0, 'retries': 0}
+        self.start = time.time()
+        self.workers = []
+        for i in range(sessions):
+            worker = threading.Thread(target=self.worker, name="sftp-%i" % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def worker(self):
+        ssh, sftp = None, None
+        session_agent = None
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            job.rc = 8
+            for attempt in range(XFER_ATTEMPTS):
+                try:
+                    if parm['remote'] is None:
+                        with run_metrics.phase('copy'):
+                            put_local(job)
+                        job.rc = 0
+                        break
+                    if sftp is None:
+                        ssh, sftp = connect_session()
+                        session_agent = agent_open(ssh)
+                    with run_metrics.phase('copy'):
+                        put_file(sftp, job, session_agent)
+                    job.rc = 0
+                    break
+                except Exception as x:
+                    print_log('E', 0, msg="SSH Error: ", val=str(x), dotted=False)
+                    job.error = str(x)
+                    if attempt < XFER_ATTEMPTS - 1:
+                        with self.lock:
+                            self.stats['retries'] += 1
+                    disconnect_session(ssh, sftp)
+                    ssh, sftp, session_agent = None, None, None
+            with self.lock:
+                if job.rc == 0:
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += job.size
+                else:
+                    self.stats['errors'] += 1
+                    print_log('E', 1, "La copie a échoué %i fois: " % XFER_ATTEMPTS, val=job.source_path,
+                              dotted=False)
+            self.done.put(job)
+            self.jobs.task_done()
+        disconnect_session(ssh, sftp)
+
+    def completed(self):
+        """
+        :return: a generator of the finished jobs, without waiting for the others
+        """
+        while True:
+            try:
+                yield self.done.get_nowait()
+            except queue.Empty:
+                return
+
+    def join(self):
+        self.jobs.join()
+
+    def close(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        print_log('I', 0, msg="Statistiques pour les transferts:")
+        if parm['remote'] is None:
+            print_log('I', 1, msg="Threads de copie", val=str(len(self.workers)))
+        else:
+            print_log('I', 1, msg="Sessions SFTP", val=str(len(self.workers)))
+        print_log('I', 1, msg="Fichiers transférés", val=str(self.stats['files']))
+        print_log('I', 1, msg="Bytes transférés", val=str(self.stats['bytes']))
+        print_log('I', 1, msg="Essais repris", val=str(self.stats['retries']))
+        print_log('I', 1, msg="Copies échouées", val=str(self.stats['errors']))
+        if elapsed > 0:
+            print_log('I', 1, msg="Débit (MB/s)", val="%.2f" % (self.stats['bytes'] / elapsed / 1024 / 1024))
+        print_log('I', 0)
+
+
 def parse_options():
     # Use optparse to get parms
     usage = "usage: %prog [options] source cible"
@@ -60,18 +333,66 @@ def parse_options():
     parser.add_option("-r", "--remote", dest="remote", action="store", default=None,
                       help="Fichier pour les paramètres de connection pour les cibles distantes.")
     parser.add_option("-m", "--mode", dest="mode", action="store", default='S',
-                      help="Mode (P)rogressif(un fichier par un) ou (S)tandard(scan source et cible puis compare.")
+                      help="Mode (P)rogressif(un fichier par un), (S)tandard(scan source et cible puis compare) "
+                           "(M)anifeste(comme S, sans BD: les inventaires sont des manifestes triés) "
+                           "ou (C)ontinu(comme S, les copies commencent pendant l'inspection de la source).")
     parser.add_option("-l", "--logging", dest="log", action="store", default='INFO',
                       help="Niveau de logging, DEBUG, INFO, WARNING, ERROR, CRITICAL,...")
     parser.add_option("-t", "--scan-target", dest="scan_target", action="store_true", default=False,
                       help="La destination est inspectée. Par défaut elle ne l'est pas.")
+    parser.add_option("-i", "--incremental", dest="incremental", action="store_true", default=False,
+                      help="Le checksum n'est pas recalculé si la grosseur, la date et l'inode sont inchangés.")
+    parser.add_option("--mmap", dest="mmap", action="store_true", default=False,
+                      help="Les fichiers sont lus avec mmap pour calculer le checksum.")
+    parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+                      help="Nombre de processus pour le calcul des checksums.")
+    parser.add_option("-p", "--pool", dest="pool", action="store", default='T',
+                      help="Pool de calcul des checksums: (P)rocessus pour le CPU ou (T)hreads pour les E/S.")
+    parser.add_option("-n", "--sessions", dest="sessions", action="store", type="int", default=1,
+                      help="Nombre de sessions SFTP utilisées en parallèle pour les copies.")
+    parser.add_option("--delta", dest="delta", action="store_true", default=False,
+                      help="Seules les différences des fichiers modifiés sont envoyées au serveur distant.")
+    parser.add_option("-z", "--compress", dest="compress", action="store_true", default=False,
+                      help="Les fichiers sont compressés pendant la copie au serveur distant, sauf les extensions "
+                           "STORE_EXT de la configuration et ceux dont un échantillon se compresse mal.")
+    parser.add_option("-f", "--fast-dup", dest="fast_dup", action="store_true", default=False,
+                      help="Les doublons de la cible locale non inspectée (sans -t) sont cherchés sur le disque, "
+                           "par grosseur puis checksum partiel et complet. Ceux des arborescences inspectées "
+                           "sont lus dans la BD.")
+    parser.add_option("--verify-dup", dest="verify_dup", action="store_true", default=False,
+                      help="Avec -f, les doublons sont comparés byte par byte.")
+    parser.add_option("--dup-report", dest="dup_report", action="store", default=None,
+                      help="Les doublons sont écrits dans ce fichier, en json lines ou en csv si le nom finit "
+                           "par .csv.")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="Une ligne INFO est écrite pour chaque fichier. Par défaut, seule la progression l'est.")
+    parser.add_option("--progress", dest="progress", action="store", type="int", default=PROGRESS_SEC,
+                      help="Délai en secondes entre les messages de progression, avec l'heure de fin estimée. "
+                           "0 pour aucun message.")
+    parser.add_option("--report", dest="report", action="store", default=None,
+                      help="Le rapport d'exécution est écrit dans ce fichier json: durée, fichiers, bytes lus, "
+                           "calculés et transférés, rangées de la BD et appels distants de chaque phase.")
+    parser.add_option("--manifest-dir", dest="manifest_dir", action="store", default=None,
+                      help="Dossier des manifestes du mode M. Par défaut, le dossier temporaire du système.")
+    parser.add_option("--fix-dates", dest="fix_dates", action="store_true", default=False,
+                      help="Mode P: une cible de même grosseur mais d'une autre date est comparée par checksum et "
+                           "prend la date de la source si le checksum est le même, au lieu d'être copiée. "
+                           "Pour la première exécution après une version qui ne conservait pas les dates.")
     (options, args) = parser.parse_args()
     if len(args) < 2:
         parser.error("Ce programme a besoin de deux arguments, le dossier source et le dossier cible.")
     if options.log.upper() not in ['INFO', 'DEBUG', 'WARNING', 'ERROR', 'CRITICAL']:
         parser.error("Option de logging invalide: %s" % options.log)
-    if options.mode.upper() not in ['P', 'S']:
-        parser.error("Le mode doit être P pour Progressif ou S pour Standard")
+    if options.mode.upper() not in ['P', 'S', 'M', 'C']:
+        parser.error("Le mode doit être P pour Progressif, S pour Standard, M pour Manifeste ou C pour Continu")
+    if options.jobs < 1:
+        parser.error("Le nombre de processus doit être plus grand que 0")
+    if options.sessions < 1:
+        parser.error("Le nombre de sessions doit être plus grand que 0")
+    if options.progress < 0:
+        parser.error("Le délai de progression doit être 0 ou plus")
+    if options.pool.upper() not in ['P', 'T']:
+        parser.error("Le pool doit être P pour Processus ou T pour Threads")
 
     return options, args  # options: copy, rejects; args: source_dir target_dir
 
@@ -86,6 +407,21 @@ def parse_configs():
         config['accept_list'] = config['accept_ext'].lower().split(',')
         config['reject_ext'] = cfg_parser['extensions']['REJECT_EXT']
         config['reject_list'] = config['reject_ext'].lower().split(',')
+        config['filters'] = read_filters(cfg_parser)
+        config['path_filter'] = PathFilter(config['accept_list'], config['reject_list'], config['filters'])
+        config['hash_algo'] = 'md5'
+        if cfg_parser.has_section('hash'):
+            config['hash_algo'] = cfg_parser['hash'].get('ALGORITHM', 'md5').strip().lower()
+        if not supported_algo(config['hash_algo']):
+            print_log('E', 0, msg="Algorithme de checksum invalide, md5 est utilisé: ", val=config['hash_algo'],
+                      dotted=False)
+            config['hash_algo'] = 'md5'
+        config['store_list'] = []
+        config['compress_ratio'] = COMPRESS_RATIO
+        if cfg_parser.has_section('compression'):
+            store_ext = cfg_parser['compression'].get('STORE_EXT', '').strip()
+            config['store_list'] = [ext.strip() for ext in store_ext.lower().split(',') if ext.strip()]
+            config['compress_ratio'] = cfg_parser['compression'].getfloat('MAX_RATIO', COMPRESS_RATIO)
     except Exception as x:
         print_log('E', 0, msg="Could not read the configuration file", val=CONFIG_FILE)
         print_log('E', 0, val=str(x))
@@ -113,7 +449,28 @@ def parse_host_info(host_file):
     return
 
 
+def setup_logging(level_name):
+    """
+    Send the log records to stderr through a buffer. The buffer is written when it is full,
+    on an error and at the end of the program.
+    """
+    global log_buffer
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(' %(asctime)s - %(levelname)s - %(message)s'))
+    log_buffer = logging.handlers.MemoryHandler(LOG_BUFFER_SZ, flushLevel=logging.ERROR, target=stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(log_buffer)
+    root_logger.setLevel(getattr(logging, level_name))
+
+
 def print_log(lvl, indent, msg=None, val=None, dotted=True):
+    # The message is only built when its level is enabled.
+    # F is for the lines logged for each file: INFO with --verbose, DEBUG otherwise.
+    if lvl == 'F':
+        lvl = 'I' if parm['verbose'] else 'D'
+    level = LOG_LEVELS.get(lvl, logging.INFO)
+    if not logging.getLogger().isEnabledFor(level):
+        return
     if msg is None:
         if val is None:
             message = " "
@@ -127,19 +484,63 @@ def print_log(lvl, indent, msg=None, val=None, dotted=True):
                 message = indent * INDENT_SZ * " " + msg.ljust(MSG_LGT - indent * INDENT_SZ, '.') + ": %s" % val
             else:
                 message = indent * INDENT_SZ * " " + msg + "%s" % val
-    if lvl == 'C':
-        logging.critical("" + message)
-    elif lvl == 'E':
-        logging.error("   " + message)
-    elif lvl == 'W':
-        logging.warning(" " + message)
-    elif lvl == 'D':
-        logging.debug("   " + message)
-    else:  # Catches lvl = I and whatever else
-        logging.info("    " + message)
+    logging.log(level, "%s%s", LOG_PREFIX.get(lvl, "    "), message)
+
+
+def progress_start(phase):
+    """
+    Note the start of a phase, for the rate and the estimated time to the end of its progress messages.
+    Called at the start of each scan and comparison, the same phase can run many times.
+    """
+    progress_state['start'][phase] = time.time()
+
+
+def progress(phase, count, total=None, force=False):
+    """
+    Log the progress of a phase at most once every --progress seconds.
+    When the total is known, the rate and the estimated time to the end are added.
+    :param phase: The name of the phase
+    :param count: The number of files processed
+    :param total: The number of files expected, or None
+    :param force: Log even if the last progress line is recent
+    """
+    now = time.time()
+    start = progress_state['start'].setdefault(phase, now)
+    if parm['progress'] == 0 or (not force and now - progress_state['last'] < parm['progress']):
+        return
+    progress_state['last'] = now
+    if total is None or total < count:
+        print_log('I', 0, msg="Progression " + phase, val="%i fichiers" % count)
+    else:
+        elapsed = now - start
+        message = "%i/%i fichiers" % (count, total)
+        if elapsed > 0 and count > 0:
+            rate = count / elapsed
+            message += ", %.1f fichiers/s, fin dans %s" % (rate, time.strftime("%H:%M:%S",
+                                                                               time.gmtime((total - count) / rate)))
+        print_log('I', 0, msg="Progression " + phase, val=message)
+    if log_buffer is not None:
+        log_buffer.flush()
 
 
 def check_target_dir_rmt(target_dir):
+    if target_dir in rmt_dirs:
+        return 0
+    rc = check_target_dir_rmt_nocache(target_dir)
+    if rc == 0:
+        rmt_dirs.add(target_dir)
+    return rc
+
+
+def check_target_dir_rmt_nocache(target_dir):
+    if agent is not None:
+        created = agent.call('mkdir', path=target_dir)
+        if created is None:
+            print_log('I', 0, msg="The mkdir failed")
+            return 8
+        if created:
+            print_log('I', 2, msg="Le dossier cible n'existait pas. Il a été créé.")
+        return 0
     ssh_command = 'ls "' + target_dir.replace('"', '\\"') + '"'
     rc = ssh_command_with_rc(ssh_command)
     if rc == 0:
@@ -151,9 +552,46 @@ def check_target_dir_rmt(target_dir):
     return rc
 
 
+def prepare_target_dirs_rmt(dir_list):
+    """
+    Create in bulk the remote directories not already known to exist.
+    The directories created are added to the cache used by check_target_dir_rmt.
+    :param dir_list: The remote directories
+    """
+    missing = sorted(set(dir_list) - rmt_dirs)
+    if len(missing) == 0:
+        return
+    print_log('I', 0, msg="Vérification des dossiers distants", val=str(len(missing)))
+    if agent is not None:
+        results = agent.call_many('mkdir', missing)
+        for tgt_dir, created in zip(missing, results):
+            if created is not None:
+                rmt_dirs.add(tgt_dir)
+        return
+    for i in range(0, len(missing), MKDIR_BATCH_SZ):
+        batch = missing[i:i + MKDIR_BATCH_SZ]
+        rc = ssh_command_with_rc('mkdir -m 750 -p ' +
+                                 ' '.join(['"' + tgt_dir.replace('"', '\\"') + '"' for tgt_dir in batch]))
+        if rc == 0:
+            rmt_dirs.update(batch)
+        else:
+            print_log('W', 0, msg="The mkdir failed", val="RC=%i" % rc)
+
+
+def target_dir_rmt(target_dir, rel_path):
+    if os.sep in rel_path:
+        rel_path = rel_path.replace(os.sep, os_sep_rmt)
+    if rel_path == '.':
+        return target_dir
+    return target_dir + os_sep_rmt + rel_path
+
+
 def get_os_sep_rmt():
-    command = "/home/jean/sync_rmt.py -o"
+    if agent is not None:
+        return agent.call('os_sep')
+    command = RMT_SCRIPT + " -o"
     stdin, stdout, stderr = ssh_client.exec_command(command)
+    run_metrics.add('round_trips')
     data = stdout.read().decode('utf-8')
     os_sep = data[0:1]
     return os_sep
@@ -195,7 +633,9 @@ create table if not exists file (
   file_size  int       not null,
   root_dir   text      not null,
   rel_path   text      not null,
-  local_rmt  text      not null
+  local_rmt  text      not null,
+  file_fprint text,
+  file_algo  text      not null default 'md5'
   )
 ;
         ''',
@@ -217,6 +657,70 @@ create index if not exists ix_file_02
         '''
 create index if not exists ix_file_03
   on file(root_dir, rel_path, file_name)
+;
+        ''',
+        '''
+create table if not exists dir (
+  root_dir   text      not null,
+  rel_path   text      not null,
+  files_hash text,
+  tree_hash  text,
+  file_count int       not null,
+  tree_count int       not null,
+  primary key (root_dir, rel_path)
+  )
+;
+        ''',
+        '''
+create table if not exists dir_dirty (
+  root_dir   text      not null,
+  rel_path   text      not null,
+  primary key (root_dir, rel_path)
+  )
+;
+        ''',
+        # Les dossiers des fichiers ajoutés, modifiés ou effacés, pour db_update_dirs.
+        # Pas de "insert or ignore": le "on conflict" de la requête sur file aurait préséance.
+        '''
+create trigger if not exists tr_file_01 after insert on file
+begin
+  insert into dir_dirty(root_dir, rel_path)
+    select new.root_dir, new.rel_path
+     where not exists (select 1 from dir_dirty where root_dir = new.root_dir and rel_path = new.rel_path);
+end
+;
+        ''',
+        '''
+create trigger if not exists tr_file_02 after update on file
+begin
+  insert into dir_dirty(root_dir, rel_path)
+    select old.root_dir, old.rel_path
+     where not exists (select 1 from dir_dirty where root_dir = old.root_dir and rel_path = old.rel_path);
+  insert into dir_dirty(root_dir, rel_path)
+    select new.root_dir, new.rel_path
+     where not exists (select 1 from dir_dirty where root_dir = new.root_dir and rel_path = new.rel_path);
+end
+;
+        ''',
+        '''
+create trigger if not exists tr_file_03 after delete on file
+begin
+  insert into dir_dirty(root_dir, rel_path)
+    select old.root_dir, old.rel_path
+     where not exists (select 1 from dir_dirty where root_dir = old.root_dir and rel_path = old.rel_path);
+end
+;
+        ''',
+        '''
+create table if not exists xfer_failed (
+  source_path text      not null primary key,
+  target_path text      not null,
+  attempts    int       not null,
+  last_error  text,
+  failed_ts   timestamp not null,
+  source_size int,
+  source_mtime real
+  )
 ;
         ''']
 
@@ -224,64 +728,406 @@ create index if not exists ix_file_03
         c = db_h.cursor()
         for stmt in ddl:
             c.execute(stmt)
+        # Migration des BD créées avant l'ajout de la colonne file_fprint
+        columns = [row[1] for row in c.execute("pragma table_info(file)")]
+        if 'file_fprint' not in columns:
+            print_log('I', 0, msg="Ajout de la colonne file_fprint à la table file.")
+            c.execute("alter table file add column file_fprint text")
+        # Les checksums des BD créées avant l'ajout de la colonne file_algo sont des md5.
+        # Ils sont recalculés avec l'algorithme configuré quand le fichier est inspecté de nouveau.
+        if 'file_algo' not in columns:
+            print_log('I', 0, msg="Ajout de la colonne file_algo à la table file.")
+            c.execute("alter table file add column file_algo text not null default 'md5'")
+        # Les copies interrompues notées sans la version de la source ne sont pas reprises
+        columns = [row[1] for row in c.execute("pragma table_info(xfer_failed)")]
+        if 'source_size' not in columns:
+            print_log('I', 0, msg="Ajout des colonnes source_size et source_mtime à la table xfer_failed.")
+            c.execute("alter table xfer_failed add column source_size int")
+            c.execute("alter table xfer_failed add column source_mtime real")
     except sqlite3.Error as x:
         print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
 
 
-def db_store_file(db_h, file):
-    insert = \
+def db_get_file(db_h, dir_name, file_name, local_rmt):
+    """
+    Read the stored attributes of a file.
+    :param db_h: DB handle
+    :return: (file_md5, file_mtime, file_size, file_fprint, file_algo) or None if the file is not in the table
+    """
+    select = \
         '''
-        insert into file(dir_name, file_name, file_md5, file_mtime, file_size, root_dir, rel_path, local_rmt)
-            values(?, ?, ?, ?, ?, ?, ?, ?)
+        select file_md5, file_mtime, file_size, file_fprint, file_algo
+          from file
+         where dir_name  = ?
+           and file_name = ?
+           and local_rmt = ?
         '''
-    update = \
+
+    try:
+        cur = db_h.cursor()
+        cur.execute(select, [dir_name, file_name, local_rmt])
+        return cur.fetchone()
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+    return None
+
+
+def db_get_target(db_h, root_dir, rel_path, file_name):
+    """
+    Read the stored attributes of the target of a source file, as joined by find_missing_files.
+    :param db_h: DB handle
+    :return: (file_md5, file_mtime, file_algo, dir_name) or None if the file is not in the table
+    """
+    select = \
         '''
-        update file
-           set file_md5   = ?,
-               file_mtime = ?,
-               file_size  = ?
-         where dir_name   = ?
-           and file_name  = ?
-           and local_rmt  = ?
+        select file_md5, file_mtime, file_algo, dir_name
+          from file
+         where root_dir  = ?
+           and rel_path  = ?
+           and file_name = ?
         '''
 
+    try:
+        cur = db_h.cursor()
+        cur.execute(select, [root_dir, rel_path, file_name])
+        return cur.fetchone()
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+    return None
+
+
+def db_count_files(db_h, root_dir):
+    """
+    :param db_h: DB handle
+    :return: the number of files of a root directory in the file table, or None on error
+    """
     select = \
         '''
-        select file_md5, file_mtime, file_size
+        select count(*)
           from file
-         where dir_name  = ?
-           and file_name = ?
-           and local_rmt = ?
+         where root_dir = ?
+        '''
+
+    try:
+        cur = db_h.cursor()
+        cur.execute(select, [root_dir])
+        return cur.fetchone()[0]
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+    return None
+
+
+def parent_dir(rel_path):
+    """
+    :param rel_path: A relative path with / as separator, other than '.'
+    :return: the relative path of the parent directory
+    """
+    if '/' in rel_path:
+        return rel_path.rsplit('/', 1)[0]
+    return '.'
+
+
+def dir_files_hash(files):
+    """
+    Hash of the files of a directory, from their names, sizes and checksums.
+    :param files: (file_name, file_size, file_md5, file_algo) of the files, sorted by name
+    :return: the hash, or None if a checksum is missing
+    """
+    m = hashlib.md5()
+    for file_name, file_size, file_md5, file_algo in files:
+        if file_md5 is None:
+            return None
+        m.update(('%s\0%i\0%s:%s\n' % (file_name, file_size, file_algo, file_md5)).encode('utf-8', 'surrogateescape'))
+    return m.hexdigest()
+
+
+def db_update_dirs(db_h, root_dir, sep):
+    """
+    Compute the hashes of the directories of a root from the file table and store them in the dir table.
+    The files_hash of a directory covers its files. Its tree_hash covers also the names and the tree_hash
+    of its sub directories. The paths of the dir table use / as separator.
+    Only the directories noted in dir_dirty by the triggers of the file table, and their parents,
+    are computed again. All of them are computed when the root is not yet in the dir table.
+    :param db_h: DB handle
+    :param sep: The separator of the rel_path of the files of the root
+    """
+    select_all = \
+        '''
+        select rel_path, file_name, file_size, file_md5, file_algo
+          from file
+         where root_dir = ?
+         order by rel_path, file_name
+        '''
+    select_dir = \
+        '''
+        select rel_path, file_name, file_size, file_md5, file_algo
+          from file
+         where root_dir = ?
+           and rel_path = ?
+         order by file_name
+        '''
+    insert = \
+        '''
+        insert or replace into dir(root_dir, rel_path, files_hash, tree_hash, file_count, tree_count)
+            values(?, ?, ?, ?, ?, ?)
         '''
 
     try:
         cur = db_h.cursor()
-        cur.execute(select, [file.dir_name, file.file_name, file.local_rmt])
-        row = cur.fetchone()
-        ins = db_h.cursor()
-        if row is None:
-            print_log('D', 0, msg="The file is NOT in the database.")
-            ins.execute(insert, [file.dir_name, file.file_name, file.file_md5, file.file_mtime, file.file_size,
-                                 file.root_dir, file.rel_path, file.local_rmt])
+        dirs = dict((rel_path, list(values)) for rel_path, values in db_get_dirs(db_h, root_dir).items())
+        changed = {}  # rel_path: [files_hash, tree_hash, file_count, tree_count]
+        if '.' not in dirs:
+            cur.execute("delete from dir where root_dir = ?", [root_dir])
+            dirs = {}
+            for rel_path, rows in groupby(cur.execute(select_all, [root_dir]), key=itemgetter(0)):
+                rows = [row[1:] for row in rows]
+                changed[rel_path.replace(sep, '/')] = [dir_files_hash(rows), None, len(rows), 0]
         else:
-            print_log('D', 0, msg="The file is already in the database.")
-            print_log('D', 0, msg="Comparing the md5/mtime/size.")
-            if row[0] == file.file_md5 and row[1] == file.file_mtime and row[2] == file.file_size:
-                print_log('D', 0, msg="Same file")
-            else:
-                print_log('D', 0, msg="Updating file md5, mtime and size.")
-                upd = db_h.cursor()
-                upd.execute(update, [file.file_md5, file.file_mtime, file.file_size, file.dir_name, file.file_name,
-                                     file.local_rmt])
+            dirty = [row[0] for row in cur.execute("select rel_path from dir_dirty where root_dir = ?", [root_dir])]
+            for rel_path in dirty:
+                rows = [row[1:] for row in cur.execute(select_dir, [root_dir, rel_path])]
+                changed[rel_path.replace(sep, '/')] = [dir_files_hash(rows), None, len(rows), 0]
+        # The parents, up to the root, whose tree_hash changes with their sub directories
+        for rel_path in list(changed):
+            while rel_path != '.':
+                rel_path = parent_dir(rel_path)
+                if rel_path in changed:
+                    break
+                files = [row[1:] for row in cur.execute(select_dir, [root_dir, rel_path.replace('/', sep)])]
+                changed[rel_path] = [dir_files_hash(files), None, len(files), 0]
+        dirs.update(changed)
+        children = {}
+        for rel_path in dirs:
+            if rel_path != '.':
+                children.setdefault(parent_dir(rel_path), set()).add(rel_path)
+        # Bottom-up, the deepest directories first. The directories left without files are removed.
+        removed = []
+        for rel_path in sorted(changed, key=lambda path: -1 if path == '.' else path.count('/'), reverse=True):
+            values = changed[rel_path]
+            sub_dirs = sorted(children.get(rel_path, []))
+            if values[2] == 0 and not sub_dirs:
+                removed.append(rel_path)
+                del dirs[rel_path]
+                if rel_path != '.':
+                    children[parent_dir(rel_path)].discard(rel_path)
+                continue
+            values[3] = values[2] + sum(dirs[child][3] for child in sub_dirs)
+            values[1] = None
+            if values[0] is None or None in [dirs[child][1] for child in sub_dirs]:
+                continue
+            m = hashlib.md5(values[0].encode('ascii'))
+            for child in sub_dirs:
+                m.update(('%s\0%s\n' % (child.rsplit('/', 1)[-1], dirs[child][1])).encode('utf-8', 'surrogateescape'))
+            values[1] = m.hexdigest()
+        cur.executemany("delete from dir where root_dir = ? and rel_path = ?",
+                        [[root_dir, rel_path] for rel_path in removed])
+        cur.executemany(insert, [[root_dir, rel_path] + values for rel_path, values in changed.items()
+                                 if rel_path in dirs])
+        cur.execute("delete from dir_dirty where root_dir = ?", [root_dir])
+        db_h.commit()
+        run_metrics.add('db_rows', len(changed))
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+        db_h.rollback()
+
+
+def db_get_dirs(db_h, root_dir):
+    """
+    :param db_h: DB handle
+    :return: dict of the directories of a root in the dir table, rel_path: (files_hash, tree_hash, file_count,
+             tree_count)
+    """
+    select = \
+        '''
+        select rel_path, files_hash, tree_hash, file_count, tree_count
+          from dir
+         where root_dir = ?
+        '''
+
+    try:
+        cur = db_h.cursor()
+        return dict((row[0], row[1:]) for row in cur.execute(select, [root_dir]))
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+    return {}
+
+
+def db_changed_dirs(db_h, source_dir, target_dir):
+    """
+    Descend the source directories from the root. A subtree with the same tree_hash on the target is skipped,
+    and so are the files of a directory with the same files_hash.
+    :param db_h: DB handle
+    :return: (the directories whose files must be compared, the number of subtrees skipped,
+              the number of files skipped)
+    """
+    src_dirs = db_get_dirs(db_h, source_dir)
+    tgt_dirs = db_get_dirs(db_h, target_dir)
+    children = {}
+    for rel_path in src_dirs:
+        if rel_path != '.':
+            children.setdefault(parent_dir(rel_path), []).append(rel_path)
+    changed = []
+    skipped_dirs = 0
+    skipped_files = 0
+    stack = [rel_path for rel_path in ['.'] if rel_path in src_dirs]
+    while stack:
+        rel_path = stack.pop()
+        files_hash, tree_hash, file_count, tree_count = src_dirs[rel_path]
+        tgt = tgt_dirs.get(rel_path)
+        if tgt is not None and tree_hash is not None and tree_hash == tgt[1]:
+            skipped_dirs += 1
+            skipped_files += tree_count
+            continue
+        if tgt is not None and files_hash is not None and files_hash == tgt[0]:
+            skipped_files += file_count
+        elif file_count > 0:
+            changed.append(rel_path)
+        stack.extend(children.get(rel_path, []))
+    return changed, skipped_dirs, skipped_files
+
+
+def db_connect(db_path):
+    """
+    Open the DB with the pragma profile used for the scans:
+    WAL journal, synchronous=NORMAL and a bigger page cache.
+    :param db_path: The DB file
+    :return: DB handle
+    """
+    db_h = sqlite3.connect(db_path)
+    try:
+        c = db_h.cursor()
+        c.execute("pragma journal_mode = WAL")
+        c.execute("pragma synchronous = NORMAL")
+        c.execute("pragma cache_size = -%i" % DB_CACHE_KB)
+        c.execute("pragma temp_store = MEMORY")
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+    return db_h
+
+
+def db_store_file(db_h, file):
+    """
+    Buffer a File for the file table. The buffer is written by db_flush every DB_BATCH_SZ files.
+    :param db_h: DB handle
+    :param file: The File to insert or update
+    """
+    file_buffer.append((file.dir_name, file.file_name, file.file_md5, file.file_mtime, file.file_size,
+                        file.root_dir, file.rel_path, file.local_rmt, file.file_fprint, file.file_algo))
+    if len(file_buffer) >= DB_BATCH_SZ:
+        db_flush(db_h)
+
+
+def db_flush(db_h):
+    """
+    Write the buffered files in one transaction.
+    The rows are inserted, or updated on pk_file when md5, mtime, size or fingerprint changed.
+    :param db_h: DB handle
+    """
+    upsert = \
+        '''
+        insert into file(dir_name, file_name, file_md5, file_mtime, file_size, root_dir, rel_path, local_rmt,
+                         file_fprint, file_algo)
+            values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            on conflict(dir_name, file_name) do update
+           set file_md5    = excluded.file_md5,
+               file_mtime  = excluded.file_mtime,
+               file_size   = excluded.file_size,
+               file_fprint = excluded.file_fprint,
+               file_algo   = excluded.file_algo
+         where file_md5    <>     excluded.file_md5
+            or file_mtime  <>     excluded.file_mtime
+            or file_size   <>     excluded.file_size
+            or file_fprint is not excluded.file_fprint
+            or file_algo   <>     excluded.file_algo
+        '''
+
+    if len(file_buffer) == 0:
+        return
+    print_log('D', 0, msg="Écriture des fichiers dans la BD", val=str(len(file_buffer)))
+    try:
+        cur = db_h.cursor()
+        cur.executemany(upsert, file_buffer)
+        db_h.commit()
+        run_metrics.add('db_rows', max(cur.rowcount, 0))
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+        db_h.rollback()
+    del file_buffer[:]
+
+
+def db_record_copy(db_h, job):
+    """
+    Keep the failed copies in the xfer_failed table, with the size and the date of the source.
+    A successful copy removes its entry. The partial remote file is kept, the next run resumes
+    the copy where it stopped if the source did not change.
+    :param db_h: DB handle
+    :param job: CopyJob
+    """
+    upsert = \
+        '''
+        insert into xfer_failed(source_path, target_path, attempts, last_error, failed_ts, source_size,
+                                source_mtime)
+            values(?, ?, 1, ?, ?, ?, ?)
+            on conflict(source_path) do update
+           set target_path  = excluded.target_path,
+               attempts     = attempts + 1,
+               last_error   = excluded.last_error,
+               failed_ts    = excluded.failed_ts,
+               source_size  = excluded.source_size,
+               source_mtime = excluded.source_mtime
+        '''
+    delete = \
+        '''
+        delete from xfer_failed
+         where source_path = ?
+        '''
+
+    try:
+        cur = db_h.cursor()
+        if job.rc == 0:
+            cur.execute(delete, [job.source_path])
+        else:
+            cur.execute(upsert, [job.source_path, job.target_path, job.error,
+                                 time.strftime("%Y-%m-%d-%H.%M.%S", time.localtime()), job.size, job.mtime])
+        run_metrics.add('db_rows', max(cur.rowcount, 0))
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+
+
+def db_list_failed(db_h):
+    """
+    Report the copies that failed in the previous runs. They are resumed by this run, from the partial
+    remote file, if the size and the date of the source are the same.
+    :param db_h: DB handle
+    """
+    select = \
+        '''
+        select source_path, attempts, last_error, source_size, source_mtime
+          from xfer_failed
+         order by source_path
+        '''
+
+    try:
+        cur = db_h.cursor()
+        for row in cur.execute(select, []):
+            if row[3] is not None:
+                xfer_resume[row[0]] = (row[3], row[4])
+            print_log('W', 0, msg="Copie interrompue à reprendre: ", val=row[0], dotted=False)
+            print_log('W', 1, msg="Essais", val=str(row[1]))
+            print_log('W', 1, msg="Erreur", val=str(row[2]))
     except sqlite3.Error as x:
         print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
 
 
-def db_remove_deleted(db_h):
+def db_remove_deleted(db_h, roots=None):
     """
-    Verifies that every file in the file table really exists on the filesystem.
-    If not the entry is deleted from the table.
+    Remove from the file table the files that do not exist anymore.
+    Each root directory is listed once, locally or with a single remote call, streamed into a temporary table.
+    The files are keyed by their path relative to the root, with / as separator, so that the roots given
+    with a trailing separator match too. The rows of the file table missing from the listing are then
+    deleted in bulk.
     :param db_h: DB handle
+    :param roots: The root directories to verify. By default, all the roots of the table.
     :return: Nothing
     """
 
@@ -289,50 +1135,74 @@ def db_remove_deleted(db_h):
     count_found = 0
     count_notfound = 0
 
-    select = \
+    sel_roots = \
         '''
-        select dir_name, file_name, local_rmt
+        select root_dir, local_rmt, count(*)
           from file
-         order by dir_name, file_name
+         group by root_dir, local_rmt
+         order by root_dir, local_rmt
+        '''
+    sel_missing = \
+        '''
+        select dir_name, file_name
+          from file
+         where root_dir  = ?
+           and local_rmt = ?
+           and not exists (select 1
+                             from seen
+                            where seen.rel_path  = replace(replace(file.rel_path, ?, '/'), ?, '/')
+                              and seen.file_name = file.file_name)
         '''
-
     delete = \
         '''
         delete from file
-         where dir_name  = ?
-           and file_name = ?
+         where root_dir  = ?
            and local_rmt = ?
+           and not exists (select 1
+                             from seen
+                            where seen.rel_path  = replace(replace(file.rel_path, ?, '/'), ?, '/')
+                              and seen.file_name = file.file_name)
         '''
 
     try:
         cur = db_h.cursor()
-        for row in cur.execute(select, []):
-            dir_name = row[0]
-            file_name = row[1]
-            local_rmt = row[2]
-            file_path = dir_name + os.sep + file_name
+        cur.execute("drop table if exists temp.seen")
+        cur.execute("create temp table seen (rel_path text, file_name text, primary key (rel_path, file_name))")
+        for root_dir, local_rmt, count_rows in cur.execute(sel_roots).fetchall():
+            if roots is not None and root_dir not in roots:
+                continue
             if local_rmt == 'L':
-                if os.path.isfile(file_path):
-                    count_found += 1
-                    print_log('D', 1, msg="Fichier existant.....: ", val=file_path, dotted=False)
-                else:
-                    count_notfound += 1
-                    print_log('I', 1, msg="Fichier non-existant.: ", val=file_path, dotted=False)
-                    dlt = db_h.cursor()
-                    dlt.execute(delete, [dir_name, file_name, local_rmt])
-            else:   # local_rmt == 'R'
-                if os.sep in dir_name:
-                    dir_name = dir_name.replace(os.sep, os_sep_rmt)
-                file_path = dir_name + os_sep_rmt + file_name
-                rc = ssh_command_with_rc('ls "' + file_path.replace('"', '\\"') + '"')
-                if rc == 0:
-                    count_found += 1
-                    print_log('D', 1, msg="Fichier existant.....: ", val=file_path, dotted=False)
-                else:
-                    count_notfound += 1
-                    print_log('I', 1, msg="Fichier non-existant.: ", val=file_path, dotted=False)
-                    dlt = db_h.cursor()
-                    dlt.execute(delete, [dir_name, file_name, local_rmt])
+                listing = list_root(root_dir)
+                sep_rmt = os.sep
+            else:
+                listing = list_root_rmt(root_dir)
+                sep_rmt = os_sep_rmt
+            if listing is None:
+                print_log('W', 1, msg="Le dossier ne peut pas être listé. Il n'est pas nettoyé: ", val=root_dir,
+                          dotted=False)
+                count_found += count_rows
+                continue
+            cur.execute("delete from seen")
+            try:
+                cur.executemany("insert or ignore into seen(rel_path, file_name) values(?, ?)", listing)
+            except (IOError, OSError, ValueError) as x:
+                # The listing stopped before its end, the files not listed are not missing
+                print_log('W', 1, msg="Le listage a échoué. Le dossier n'est pas nettoyé: ", val=str(x),
+                          dotted=False)
+                count_found += count_rows
+                continue
+            parms = [root_dir, local_rmt, os.sep, sep_rmt]
+            count_missing = 0
+            for dir_name, file_name in cur.execute(sel_missing, parms).fetchall():
+                count_missing += 1
+                print_log('I', 1, msg="Fichier non-existant.: ", val=dir_name + os.sep + file_name, dotted=False)
+            cur.execute(delete, parms)
+            run_metrics.add('db_rows', max(cur.rowcount, 0))
+            run_metrics.add('files', count_rows)
+            count_notfound += count_missing
+            count_found += count_rows - count_missing
+        cur.execute("delete from seen")
+        db_h.commit()
     except sqlite3.Error as x:
         print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
 
@@ -342,111 +1212,360 @@ def db_remove_deleted(db_h):
     print_log('I', 0)
 
 
-def list_dup(db_h, root_dir):
+def list_root(root_dir):
+    """
+    :return: a generator of (rel_path, file_name) of a local directory structure, with / as separator
+             in rel_path, or None if it does not exist
+    """
+    if not os.path.isdir(root_dir):
+        return None
+    return ((entry.rel_path.replace(os.sep, '/'), entry.file_name)
+            for entry in walk_tree(root_dir, [], config['path_filter'].prune))
 
-    sel_md5 = \
-        '''
-        select file_md5, count(*)
-          from file
-         where root_dir = ?
-         group by file_md5
-        having count(*) > 1
-        '''
+
+def rmt_scan_args(root_dir):
+    """
+    :return: the arguments of a sync_rmt.py -s command: the directory, the accepted and rejected extensions
+             and the [filters], like the scan op of the agent. The filters are json encoded in base64,
+             to go through the remote shell as is.
+    """
+    filters = base64.b64encode(json.dumps(config['filters']).encode('utf-8')).decode('ascii')
+    return ' -d "' + root_dir.replace('"', '\\"') + '" -a "' + ",".join(config['accept_list']) + \
+           '" -r "' + ",".join(config['reject_list']) + '" -F ' + filters
+
+
+def list_root_rmt(root_dir):
+    """
+    List a remote directory structure in a single call. Without the agent, sync_rmt.py sends
+    a manifest, read line by line as it arrives.
+    :return: a generator of (rel_path, file_name) of the accepted files, with / as separator in rel_path,
+             or None if the listing failed. The generator raises IOError if the listing stops before its end.
+    """
+    try:
+        if agent is not None:
+            files = agent.call('scan', dir=root_dir, accept=config['accept_list'], reject=config['reject_list'],
+                               filters=config['filters'])
+            if files is None:
+                return None
+            return ((item['rel_path'].replace(os_sep_rmt, '/'), item['name']) for item in files)
+        if ssh_client is None:
+            return None
+        command = RMT_SCRIPT + ' -s -M -' + rmt_scan_args(root_dir)
+        stdin, stdout, stderr = ssh_client.exec_command(command)
+        run_metrics.add('round_trips')
+    except Exception as x:
+        print_log('E', 0, msg="SSH Error: ", val=str(x), dotted=False)
+        return None
+    return read_listing_rmt(stdout.channel)
+
+
+def read_listing_rmt(channel):
+    """
+    Read the manifest of a remote listing from an SSH channel.
+    :return: a generator of (rel_path, file_name)
+    """
+    try:
+        lines = (line.decode(manifest.ENCODING, manifest.ERRORS) for line in channel.makefile('rb'))
+        manifest.parse_header(next(lines, ''))
+        for record in manifest.read_records(lines):
+            yield record[1], record[2]
+        rc = channel.recv_exit_status()
+    except Exception as x:
+        raise IOError(str(x))
+    if rc != 0:
+        raise IOError("sync_rmt.py rc %i" % rc)
+
+
+def list_dup(db_h, root_dir, report=None):
+    """
+    List the duplicates of a root directory with a single ordered query.
+    :param db_h: DB handle
+    :param root_dir: The root directory
+    :param report: DupReport receiving the groups. Without it, the groups are logged.
+    """
     sel_dup = \
         '''
-        select dir_name, file_name, file_size, file_mtime
-          from file
-         where file_md5 = ?
-           and root_dir = ?
-       '''
+        select file_md5, dup_count, dir_name, file_name, file_size, file_mtime
+          from (select file_md5, file_algo, dir_name, file_name, file_size, file_mtime,
+                       count(*) over (partition by file_algo, file_md5) as dup_count
+                  from file
+                 where root_dir = ?)
+         where dup_count > 1
+         order by file_algo, file_md5, dir_name, file_name
+        '''
 
+    def write_group():
+        if report is not None:
+            report.write_group(root_dir, group_md5, files)
+            return
+        print_log('I', 0, "Doublons possibles", val=group_md5)
+        for file_path, file_size, file_mtime in files:
+            print_log('I', 1, msg="Fichier......: ", val=file_path, dotted=False)
+            print_log('I', 2, msg="Size.....: ", val=str(file_size), dotted=False)
+            print_log('I', 2, msg="MTime....: ", val=file_mtime, dotted=False)
+        print_log('I', 0)
+
+    count_groups = 0
+    reclaimable = 0
+    group_md5 = None
+    files = []
     try:
-        cur_md5 = db_h.cursor()
         cur_dup = db_h.cursor()
-        for row_md5 in cur_md5.execute(sel_md5, [root_dir]):
-            file_md5 = row_md5[0]
-            print_log('I', 0, "Doublons possibles", val=file_md5)
-            for row_dup in cur_dup.execute(sel_dup, [file_md5, root_dir]):
-                dir_name = row_dup[0]
-                file_name = row_dup[1]
-                file_size = row_dup[2]
-                file_mtime = row_dup[3]
-                print_log('I', 1, msg="Fichier......: ", val=dir_name + os.sep + file_name, dotted=False)
-                print_log('I', 2, msg="Size.....: ", val=str(file_size), dotted=False)
-                print_log('I', 2, msg="MTime....: ", val=file_mtime, dotted=False)
-            print_log('I', 0)
+        for (file_md5, dup_count, dir_name, file_name, file_size, file_mtime) in cur_dup.execute(sel_dup,
+                                                                                                   [root_dir]):
+            if file_md5 != group_md5:
+                if files:
+                    write_group()
+                group_md5 = file_md5
+                files = []
+                count_groups += 1
+                reclaimable += file_size * (dup_count - 1)
+            files.append((dir_name + os.sep + file_name, file_size, file_mtime))
+            run_metrics.add('files')
+        if files:
+            write_group()
     except sqlite3.Error as x:
         print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
 
+    print_log('I', 0, msg="Doublons pour ", val=root_dir, dotted=False)
+    print_log('I', 1, msg="Groupes de doublons", val=str(count_groups))
+    print_log('I', 1, msg="Bytes récupérables", val=str(reclaimable))
+    print_log('I', 0)
+
+
+def list_dup_db(db_h, root_dir, report=None):
+    """
+    List the duplicates of a directory structure whose checksums were just stored in the DB by its scan.
+    The query is then free, the search on disk of --fast-dup would read the files again.
+    Only the byte comparison of --verify-dup needs the disk.
+    """
+    if parm['verify_dup']:
+        list_dup_fast(root_dir, report)
+    else:
+        list_dup(db_h, root_dir, report)
+
+
+def list_dup_fast(root_dir, report=None):
+    """
+    List the duplicates of a local directory structure without the DB.
+    The files are compared by size, then by the checksum of their first and last blocks,
+    and only the remaining candidates are read in full.
+    """
+    print_log('I', 0, msg="Recherche des doublons dans ", val=root_dir, dotted=False)
+    groups, stats = find_duplicates(walk_files(root_dir, config['path_filter']), parm['verify_dup'], parm['algo'])
+    run_metrics.add('files', stats['files'])
+    run_metrics.add('bytes_read', stats['bytes_read'])
+    for group in groups:
+        if report is not None:
+            report.write_group(root_dir, group['md5'], [(file_path, group['size'], None)
+                                                        for file_path in group['paths']])
+            continue
+        print_log('I', 0, "Doublons possibles", val=group['md5'])
+        for file_path in group['paths']:
+            print_log('I', 1, msg="Fichier......: ", val=file_path, dotted=False)
+        print_log('I', 2, msg="Size.....: ", val=str(group['size']), dotted=False)
+        print_log('I', 0)
+    print_log('I', 0, msg="Statistiques pour les doublons:")
+    print_log('I', 1, msg="Fichiers", val=str(stats['files']))
+    print_log('I', 1, msg="Candidats après la grosseur", val=str(stats['size']))
+    print_log('I', 1, msg="Candidats après le checksum partiel", val=str(stats['partial']))
+    print_log('I', 1, msg="Doublons après le checksum complet", val=str(stats['full']))
+    if parm['verify_dup']:
+        print_log('I', 1, msg="Doublons après la comparaison", val=str(stats['verified']))
+    print_log('I', 1, msg="Groupes de doublons", val=str(len(groups)))
+    print_log('I', 1, msg="Bytes des fichiers", val=str(stats['bytes_total']))
+    print_log('I', 1, msg="Bytes lus", val=str(stats['bytes_read']))
+    print_log('I', 0)
+    return groups
+
 
 def find_missing_files(db_h, source_dir, target_dir):
-    counts = {'copy': 0, 'compare': 0, 'kept': 0, 'newer': 0, 'older': 0}
+    counts = {'copy': 0, 'compare': 0, 'kept': 0, 'newer': 0, 'older': 0, 'dirs': 0, 'skipped': 0}
 
-    sel_src = \
+    # Source and target are compared in a single query. Each source file is classified:
+    # N(ew), S(ame md5), U(pdated, the source is newer), O(lder, the target is newer)
+    # or H(ash of the target computed with another algorithm)
+    sel_diff = \
         '''
-        select dir_name, file_name, file_md5, file_size, file_mtime, rel_path
-          from file
-         where root_dir = ?
-         order by dir_name, file_name
+        select src.dir_name, src.file_name, src.file_md5, src.file_size, src.file_mtime, src.rel_path,
+               case
+                   when tgt.file_name is null          then 'N'
+                   when src.file_algo <> tgt.file_algo then 'H'
+                   when src.file_md5 = tgt.file_md5     then 'S'
+                   when src.file_mtime > tgt.file_mtime then 'U'
+                   else 'O'
+               end,
+               tgt.dir_name, tgt.file_mtime
+          from file src
+          left join file tgt
+            on tgt.root_dir  = ?
+           and tgt.rel_path  = src.rel_path
+           and tgt.file_name = src.file_name
+         where src.root_dir = ?
+           and src.rel_path in (select rel_path from diff_dir)
+         order by src.dir_name, src.file_name
         '''
-    sel_tgt = \
+
+    # The directories of the files to copy, created on the remote host before the copies
+    sel_dirs = \
         '''
-        select file_md5, file_mtime
-          from file
-         where root_dir  = ?
-           and rel_path  = ?
-           and file_name = ?
+        select distinct src.rel_path
+          from file src
+          left join file tgt
+            on tgt.root_dir  = ?
+           and tgt.rel_path  = src.rel_path
+           and tgt.file_name = src.file_name
+         where src.root_dir = ?
+           and src.rel_path in (select rel_path from diff_dir)
+           and (tgt.file_name is null
+                or (src.file_md5 <> tgt.file_md5 and src.file_mtime > tgt.file_mtime))
         '''
 
+    if parm['remote'] is None:
+        local_rmt = 'L'
+    else:
+        local_rmt = 'R'
     try:
-        cur_src = db_h.cursor()
-        cur_tgt = db_h.cursor()
-        for row_src in cur_src.execute(sel_src, [source_dir]):
-            dir_name = row_src[0]
-            file_name = row_src[1]
-            file_md5_src = row_src[2]
-            file_size_src = row_src[3]
-            file_mtime_src = row_src[4]
-            rel_path = row_src[5]
-            cur_tgt.execute(sel_tgt, [target_dir, rel_path, file_name])
-            row_tgt = cur_tgt.fetchone()
+        # Only the directories whose hash differs from the target are compared file by file
+        db_update_dirs(db_h, source_dir, os.sep)
+        if parm['remote'] is None:
+            db_update_dirs(db_h, target_dir, os.sep)
+        else:
+            db_update_dirs(db_h, target_dir, os_sep_rmt)
+        changed, counts['dirs'], counts['skipped'] = db_changed_dirs(db_h, source_dir, target_dir)
+        counts['compare'] += counts['skipped']
+        counts['kept'] += counts['skipped']
+        cur = db_h.cursor()
+        cur.execute("create temp table if not exists diff_dir (rel_path text primary key)")
+        cur.execute("delete from diff_dir")
+        cur.executemany("insert into diff_dir(rel_path) values(?)",
+                        [[rel_path.replace('/', os.sep)] for rel_path in changed])
+        if parm['remote'] is not None and parm['copy']:
+            cur_dirs = db_h.cursor()
+            prepare_target_dirs_rmt([target_dir_rmt(target_dir, row[0])
+                                     for row in cur_dirs.execute(sel_dirs, [target_dir, source_dir])])
+        total_rows = db_count_files(db_h, source_dir)
+        if total_rows is not None:
+            total_rows -= counts['skipped']
+        progress_start("de la comparaison")
+        cur_diff = db_h.cursor()
+        count_rows = 0
+        for row in cur_diff.execute(sel_diff, [target_dir, source_dir]):
+            (dir_name, file_name, file_md5_src, file_size_src, file_mtime_src, rel_path, diff,
+             dir_name_tgt, file_mtime_tgt) = row
+            count_rows += 1
+            run_metrics.add('files')
+            progress("de la comparaison", count_rows, total_rows)
+            if diff == 'H':
+                # The checksum of the target is migrated to the algorithm of the source, then compared
+                if rehash_target(db_h, dir_name_tgt, file_name) == file_md5_src:
+                    diff = 'S'
+                elif file_mtime_src > file_mtime_tgt:
+                    diff = 'U'
+                else:
+                    diff = 'O'
+            if diff == 'S':
+                print_log('D', 0, msg="Le fichier n'a pas à être copié.")
+                counts['compare'] += 1
+                counts['kept'] += 1
+                continue
+            if diff == 'O':
+                print_log('D', 0, msg="Le fichier sur la cible est plus récent. Il ne sera pas écrasé.")
+                counts['compare'] += 1
+                counts['older'] += 1
+                continue
             if rel_path == '.':
                 dir_name_tgt = target_dir
             else:
                 dir_name_tgt = target_dir + os.sep + rel_path
-            if parm['remote'] is None:
-                local_rmt = 'L'
-            else:
-                local_rmt = 'R'
             new_file = File(file_name, file_md5_src, file_mtime_src, file_size_src, dir_name_tgt,
                             target_dir, rel_path, local_rmt)
-            if row_tgt is None:
+            if diff == 'N':
                 # Copy
-                rc = copy_file(dir_name, file_name, target_dir, rel_path)
+                rc = copy_file(dir_name, file_name, target_dir, rel_path, new_file, 'copy')
                 if rc == 0:
                     db_store_file(db_h, new_file)
                     counts['copy'] += 1
             else:
                 counts['compare'] += 1
-                file_md5_tgt = row_tgt[0]
-                file_mtime_tgt = row_tgt[1]
-                # Compare
-                if file_md5_src == file_md5_tgt:
-                    print_log('D', 0, msg="Le fichier n'a pas à être copié.")
-                    counts['kept'] += 1
-                else:
-                    if file_mtime_src > file_mtime_tgt:
-                        print_log('D', 0, msg="Le fichier est plus récent et doit être copié.")
-                        rc = copy_file(dir_name, file_name, target_dir, rel_path)
-                        if rc == 0:
-                            db_store_file(db_h, new_file)
-                            counts['newer'] += 1
-                    else:
-                        print_log('D', 0, msg="Le fichier sur la cible est plus récent. Il ne sera pas écrasé.")
-                        counts['older'] += 1
+                print_log('D', 0, msg="Le fichier est plus récent et doit être copié.")
+                rc = copy_file(dir_name, file_name, target_dir, rel_path, new_file, 'newer', delta=True)
+                if rc == 0:
+                    db_store_file(db_h, new_file)
+                    counts['newer'] += 1
+            copy_done(db_h, counts)
+        copy_done(db_h, counts, wait=True)
     except sqlite3.Error as x:
         print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
 
+    db_flush(db_h)
+
+    print_log('I', 0, msg="Statistiques pour les copies:")
+    print_log('I', 1, msg="Fichiers copiés", val=str(counts['copy']))
+    print_log('I', 1, msg="Comparaison requises", val=str(counts['compare']))
+    print_log('I', 2, msg="Copies évitées (même checksum)", val=str(counts['kept']))
+    print_log('I', 2, msg="Fichiers remplacés par un plus récent", val=str(counts['newer']))
+    print_log('I', 2, msg="Fichiers cibles plus récents conservés", val=str(counts['older']))
+    print_log('I', 1, msg="Sous-dossiers inchangés ignorés", val=str(counts['dirs']))
+    print_log('I', 1, msg="Fichiers des dossiers inchangés", val=str(counts['skipped']))
+    print_log('I', 1, msg="Checksums de la cible recalculés (" + parm['algo'] + ")", val=str(hash_counts['migrated']))
+    print_log('I', 0)
+    return counts['copy'] + counts['newer']
+
+
+def find_missing_manifest(source_manifest, target_manifest, source_dir, target_dir):
+    """
+    Same copy plan as find_missing_files, from the sorted manifests of the source and the target.
+    The manifests are read once, side by side, and nothing is kept in memory but the directories to create.
+    """
+    counts = {'copy': 0, 'compare': 0, 'kept': 0, 'newer': 0, 'older': 0}
+
+    try:
+        if parm['remote'] is not None and parm['copy']:
+            # The directories of the files to copy, created on the remote host before the copies
+            rel_paths = set()
+            for diff, source, target in join_manifests(source_manifest, target_manifest):
+                if diff in 'NU':
+                    rel_paths.add(source[1])
+            prepare_target_dirs_rmt([target_dir_rmt(target_dir, rel_path) for rel_path in sorted(rel_paths)])
+        progress_start("de la comparaison")
+        count_rows = 0
+        for diff, source, target in join_manifests(source_manifest, target_manifest):
+            key, rel_path, file_name, file_size, file_mtime, file_md5 = source
+            count_rows += 1
+            run_metrics.add('files')
+            progress("de la comparaison", count_rows)
+            if diff == 'S':
+                print_log('D', 0, msg="Le fichier n'a pas à être copié.")
+                counts['compare'] += 1
+                counts['kept'] += 1
+                continue
+            if diff == 'O':
+                print_log('D', 0, msg="Le fichier sur la cible est plus récent. Il ne sera pas écrasé.")
+                counts['compare'] += 1
+                counts['older'] += 1
+                continue
+            if rel_path == '.':
+                dir_name = source_dir
+            else:
+                rel_path = rel_path.replace('/', os.sep)
+                dir_name = source_dir + os.sep + rel_path
+            if diff == 'N':
+                # Copy
+                rc = copy_file(dir_name, file_name, target_dir, rel_path, None, 'copy')
+                if rc == 0:
+                    counts['copy'] += 1
+            else:
+                counts['compare'] += 1
+                print_log('D', 0, msg="Le fichier est plus récent et doit être copié.")
+                rc = copy_file(dir_name, file_name, target_dir, rel_path, None, 'newer', delta=True)
+                if rc == 0:
+                    counts['newer'] += 1
+            copy_done(None, counts)
+        copy_done(None, counts, wait=True)
+    except (OSError, ValueError) as x:
+        print_log('E', 0, msg="Erreur de lecture des manifestes: ", val=str(x), dotted=False)
+
     print_log('I', 0, msg="Statistiques pour les copies:")
     print_log('I', 1, msg="Fichiers copiés", val=str(counts['copy']))
     print_log('I', 1, msg="Comparaison requises", val=str(counts['compare']))
@@ -457,7 +1576,214 @@ def find_missing_files(db_h, source_dir, target_dir):
     return counts['copy'] + counts['newer']
 
 
-def copy_file(dir_name, file_name, target_dir, rel_path):
+def sync_pipeline(db_h, db_path, source_dir, target_dir):
+    """
+    Mode C: the source is inspected, compared and copied at the same time, by stages linked with bounded queues.
+    - The calling thread walks the source, with the hash pool, and is the only one writing to the DB.
+    - The diff thread classifies each source file like find_missing_files and queues the copies.
+      The target is read from its own DB connection, or with -t, from the inventory of the target thread.
+    - The transfer pool copies the files.
+    A full queue holds back the stages before it. The end of the source is a None in the queue.
+    After an error in a stage, no new file is taken and the copies already queued are finished.
+    :return: 0, or 8 if a stage failed
+    """
+    counts = {'copy': 0, 'compare': 0, 'kept': 0, 'newer': 0, 'older': 0}
+    files_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SZ)
+    stop = threading.Event()
+    target_ready = threading.Event()
+    target = {'files': None}  # Inventory of the target thread: (rel_path, file_name): File
+    deferred = []  # Files whose target was hashed with another algorithm, compared by the calling thread
+    if parm['remote'] is None:
+        local_rmt = 'L'
+    else:
+        local_rmt = 'R'
+
+    def scan_target():
+        try:
+            with run_metrics.phase('scan_target'):
+                if parm['remote'] is None:
+                    files = inventory_local(target_dir)
+                else:
+                    files = scan_dir_rmt(None, target_dir)
+            target['files'] = dict(((file.rel_path, file.file_name), file) for file in files)
+        except Exception as x:
+            print_log('E', 0, msg="L'inspection de la cible a échoué: ", val=str(x), dotted=False)
+            stop.set()
+        finally:
+            target_ready.set()
+
+    def diff_file(diff_h, file):
+        if target['files'] is None:
+            tgt = db_get_target(diff_h, target_dir, file.rel_path, file.file_name)
+        else:
+            tgt_file = target['files'].get((file.rel_path, file.file_name))
+            tgt = None
+            if tgt_file is not None:
+                tgt = (tgt_file.file_md5, tgt_file.file_mtime, tgt_file.file_algo, tgt_file.dir_name)
+        if tgt is None:
+            diff = 'N'
+        elif tgt[2] != file.file_algo:
+            deferred.append((file, tgt))
+            return
+        elif file.file_md5 is not None and file.file_md5 == tgt[0]:
+            diff = 'S'
+        elif file.file_mtime > tgt[1]:
+            diff = 'U'
+        else:
+            diff = 'O'
+        if diff == 'S':
+            counts['compare'] += 1
+            counts['kept'] += 1
+            return
+        if diff == 'O':
+            counts['compare'] += 1
+            counts['older'] += 1
+            return
+        if file.rel_path == '.':
+            dir_name_tgt = target_dir
+        else:
+            dir_name_tgt = target_dir + os.sep + file.rel_path
+        new_file = File(file.file_name, file.file_md5, file.file_mtime, file.file_size, dir_name_tgt,
+                        target_dir, file.rel_path, local_rmt)
+        if diff == 'N':
+            copy_file(file.dir_name, file.file_name, target_dir, file.rel_path, new_file, 'copy')
+        else:
+            counts['compare'] += 1
+            if target['files'] is not None:
+                # The inventory stored at the end must not replace the copied file
+                del target['files'][(file.rel_path, file.file_name)]
+            copy_file(file.dir_name, file.file_name, target_dir, file.rel_path, new_file, 'newer', delta=True)
+
+    def diff():
+        diff_h = None
+        try:
+            if parm['scan_target']:
+                target_ready.wait()
+            else:
+                diff_h = db_connect(db_path)
+            with run_metrics.phase('diff'):
+                while not stop.is_set():
+                    # The timeout is only there to check stop
+                    try:
+                        file = files_queue.get(timeout=PIPELINE_WAIT_SEC)
+                    except queue.Empty:
+                        continue
+                    if file is None:
+                        break
+                    run_metrics.add('files')
+                    diff_file(diff_h, file)
+        except Exception as x:
+            print_log('E', 0, msg="La comparaison a échoué: ", val=str(x), dotted=False)
+            stop.set()
+        finally:
+            if diff_h is not None:
+                diff_h.close()
+
+    def send(file):
+        # Store the finished copies, then wait for room in the queue of the diff thread
+        while not stop.is_set():
+            copy_done(db_h, counts)
+            try:
+                files_queue.put(file, timeout=PIPELINE_WAIT_SEC)
+                return
+            except queue.Full:
+                continue
+        raise IOError("Une étape de la synchronisation a échoué.")
+
+    threads = []
+    if parm['scan_target']:
+        threads.append(threading.Thread(target=scan_target, name="scan-target", daemon=True))
+    threads.append(threading.Thread(target=diff, name="diff", daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        with run_metrics.phase('scan_source'):
+            scan_dir(db_h, source_dir, on_file=send)
+        send(None)
+    except Exception as x:
+        print_log('E', 0, msg="L'inspection de la source est arrêtée: ", val=str(x), dotted=False)
+        stop.set()
+    for thread in threads:
+        thread.join()
+
+    if not stop.is_set():
+        # The checksum of the target is migrated to the algorithm of the source, then compared
+        for file, tgt in deferred:
+            counts['compare'] += 1
+            if rehash_target(db_h, tgt[3], file.file_name) == file.file_md5:
+                counts['kept'] += 1
+            elif file.file_mtime <= tgt[1]:
+                counts['older'] += 1
+            else:
+                new_file = File(file.file_name, file.file_md5, file.file_mtime, file.file_size, tgt[3],
+                                target_dir, file.rel_path, local_rmt)
+                if copy_file(file.dir_name, file.file_name, target_dir, file.rel_path, new_file, 'newer',
+                             delta=True) == 0:
+                    db_store_file(db_h, new_file)
+                    counts['newer'] += 1
+    if target['files'] is not None:
+        for file in target['files'].values():
+            db_store_file(db_h, file)
+    copy_done(db_h, counts, wait=True)
+    db_flush(db_h)
+
+    print_log('I', 0, msg="Statistiques pour les copies:")
+    print_log('I', 1, msg="Fichiers copiés", val=str(counts['copy']))
+    print_log('I', 1, msg="Comparaison requises", val=str(counts['compare']))
+    print_log('I', 2, msg="Copies évitées (même checksum)", val=str(counts['kept']))
+    print_log('I', 2, msg="Fichiers remplacés par un plus récent", val=str(counts['newer']))
+    print_log('I', 2, msg="Fichiers cibles plus récents conservés", val=str(counts['older']))
+    print_log('I', 1, msg="Checksums de la cible recalculés (" + parm['algo'] + ")", val=str(hash_counts['migrated']))
+    print_log('I', 0)
+    if stop.is_set():
+        print_log('E', 0, msg="La synchronisation a été arrêtée par une erreur.")
+        return 8
+    return 0
+
+
+def rehash_target(db_h, dir_name, file_name):
+    """
+    Compute again, with the algorithm of the run, the checksum of a target file stored with another algorithm.
+    The file table is updated, the other attributes of the file are kept.
+    :return: the checksum, or None if it could not be computed
+    """
+    update = \
+        '''
+        update file
+           set file_md5  = ?,
+               file_algo = ?
+         where dir_name  = ?
+           and file_name = ?
+        '''
+
+    try:
+        if parm['remote'] is None:
+            file_md5 = file_digest(os.path.join(dir_name, file_name), parm['algo'], parm['mmap'])
+        else:
+            file_md5 = get_md5_rmt(dir_name, file_name)
+    except Exception as x:
+        print_log('W', 1, msg="Le checksum de la cible ne peut pas être calculé: ", val=str(x), dotted=False)
+        return None
+    if file_md5 is None:
+        return None
+    hash_counts['migrated'] += 1
+    try:
+        cur = db_h.cursor()
+        cur.execute(update, [file_md5, parm['algo'], dir_name, file_name])
+        run_metrics.add('db_rows', max(cur.rowcount, 0))
+    except sqlite3.Error as x:
+        print_log('E', 0, msg="SQL Error: ", val=str(x), dotted=False)
+    return file_md5
+
+
+def copy_file(dir_name, file_name, target_dir, rel_path, file=None, kind=None, delta=False):
+    """
+    Copy a file to the target directory.
+    With delta, the target is an older version of the file and only the differences are sent.
+    With the transfer pool, the copy is queued and the function returns 2. The file is stored
+    and the kind counter incremented by copy_done when the copy is finished.
+    :return: 0 when copied, 1 in simulation mode, 2 when queued, 4 or 8 on error
+    """
     global ssh_client, ftp_client
     rc = 0
     print_log('D', 0, msg="Entrée dans copy_file")
@@ -466,109 +1792,553 @@ def copy_file(dir_name, file_name, target_dir, rel_path):
     print_log('D', 1, msg="Target Dir", val=target_dir)
     print_log('D', 1, msg="Relative path", val=rel_path)
     source_path = dir_name + os.sep + file_name
-    print_log('I', 0, msg="Copie de", val=source_path)
+    print_log('F', 0, msg="Copie de", val=source_path)
     if parm['remote'] is None:
         if rel_path == '.':
             tgt_dir = target_dir
         else:
             tgt_dir = target_dir + os.sep + rel_path
         target_path = os.path.join(tgt_dir, file_name)
-        print_log('I', 1, msg="vers", val=target_path)
+        print_log('F', 1, msg="vers", val=target_path)
         if parm['copy']:
-            os.makedirs(tgt_dir, exist_ok=True)
-            shutil.copy2(source_path, target_path)
+            job = CopyJob(source_path, target_path, file, kind)
+            if xfer_pool is not None:
+                xfer_pool.submit(job)
+                rc = 2
+            else:
+                with run_metrics.phase('copy'):
+                    put_local(job)
         else:
-            print_log('I', 0, msg="Mode simulation: Fichier ne sera pas copié.")
+            print_log('F', 0, msg="Mode simulation: Fichier ne sera pas copié.")
             rc = 1
     else:
-        if os.sep in rel_path:
-            rel_path = rel_path.replace(os.sep, os_sep_rmt)
-        if rel_path == '.':
-            tgt_dir = target_dir
-        else:
-            tgt_dir = target_dir + os_sep_rmt + rel_path
+        tgt_dir = target_dir_rmt(target_dir, rel_path)
         target_path = tgt_dir + os_sep_rmt + file_name.replace("'", "\'")
-        print_log('I', 1, "vers", val="%s:%s" % (cred['host'], target_path))
+        print_log('F', 1, "vers", val="%s:%s" % (cred['host'], target_path))
         if parm['copy']:
             dir_rc = check_target_dir_rmt(tgt_dir)
-            if dir_rc == 0:
-                ftp_success = False
-                ftp_attempts = 1
-                while not ftp_success and ftp_attempts <= 3:
+            if dir_rc == 0 and xfer_pool is not None:
+                xfer_pool.submit(CopyJob(source_path, target_path, file, kind, delta and parm['delta']))
+                rc = 2
+            elif dir_rc == 0:
+                job = CopyJob(source_path, target_path, file, kind, delta and parm['delta'])
+                job.rc = 8
+                for attempt in range(XFER_ATTEMPTS):
                     try:
-                        ftp_client.put(source_path, target_path)
-                        ftp_success = True
+                        with run_metrics.phase('copy'):
+                            put_file(ftp_client, job, agent)
+                        job.rc = 0
+                        break
                     except Exception as x:
                         print_log('E', 0, msg="SSH Error: ", val=str(x), dotted=False)
+                        job.error = str(x)
+                        agent_stop()
                         disconnect_ssh()
                         connect_ssh()
-                    # TODO stat the file and compare with expected size, md5
-                    ftp_attempts += 1
-                if ftp_attempts == 3:
-                    print_log('E', 1, "La copie a échoué 3 fois.")
+                        agent_start()
+                if job.rc != 0:
+                    print_log('E', 1, "La copie a échoué %i fois." % XFER_ATTEMPTS)
                     rc = 8
+                xfer_done.append(job)
             else:
                 print_log('E', 0, msg="Remote mkdir failed", val="RC=%i" % dir_rc)
                 rc = 4
         else:
-            print_log('I', 0, msg="Mode simulation: Fichier ne sera pas copié.")
+            print_log('F', 0, msg="Mode simulation: Fichier ne sera pas copié.")
             rc = 1
     return rc
 
 
-def get_metadata(db_h, root_dir, dir_name, file_name):
-    file_path = os.path.join(dir_name, file_name)
-    (mode, ino, dev, nlink, uid, gid, file_size, atime, mtime, ctime) = os.stat(file_path)
-    lastmod_date = time.localtime(mtime)
-    file_mtime = time.strftime("%Y-%m-%d-%H.%M.%S", lastmod_date)
-
-    # Open,close, read file and calculate MD5 on its contents
-    with open(file_path, "rb") as file_to_check:
-        # read contents of the file
-        data = file_to_check.read()
-        # pipe contents of the file through
-        file_md5 = hashlib.md5(data).hexdigest()
-    rel_path = os.path.relpath(dir_name, root_dir)
-    print_log('I', 0, msg="Fichier: ", val=file_path, dotted=False)
-    print_log('D', 1, msg="Date modification (formatté)", val=file_mtime)
-    print_log('D', 1, msg="Grosseur en bytes", val=str(file_size))
-    print_log('D', 1, msg="Checksum", val=file_md5)
-    file = File(file_name, file_md5, file_mtime, file_size, dir_name, root_dir, rel_path, "L")
-    db_store_file(db_h, file)
-    return file
+def put_local(job):
+    """
+    Copy a file to the local target. The directory of the target is created if needed.
+    :param job: CopyJob
+    """
+    os.makedirs(os.path.dirname(job.target_path), exist_ok=True)
+    shutil.copy2(job.source_path, job.target_path)
+    job.size = os.path.getsize(job.target_path)
+    job.sent = job.size
+    run_metrics.add('files')
+    run_metrics.add('bytes_read', job.size)
+    run_metrics.add('bytes_sent', job.size)
 
 
-def get_metadata_rmt(db_h, target_dir, rel_path, file_name):
-    if os.sep in rel_path:
-        rel_path = rel_path.replace(os.sep, os_sep_rmt)
-    if rel_path == '.':
-        tgt_dir = target_dir
+def put_file(sftp, job, rmt_agent=None):
+    """
+    Upload a file by chunks under a temporary name, then rename it.
+    If the temporary file is already on the remote host, from an interrupted copy, the upload
+    resumes at its size. The size, and the md5 when the agent is available, are verified
+    before the rename. With --compress, the agent receives the files chosen by compress_choice
+    compressed with zlib. An exception is raised when the copy fails.
+    :param sftp: The SFTP client
+    :param job: CopyJob
+    :param rmt_agent: AgentSession on the same host, used to verify the md5
+    """
+    part_path = job.target_path + PART_SFX
+    source_stat = os.stat(job.source_path)
+    job.size = source_stat.st_size
+    job.mtime = source_stat.st_mtime
+    if job.delta and rmt_agent is not None and job.size >= DELTA_MIN_SZ:
+        try:
+            put_delta(job, rmt_agent)
+        except ValueError as x:
+            print_log('I', 1, msg="Trop de différences, copie complète: ", val=str(x), dotted=False)
+            job.delta = False
+        except Exception as x:
+            print_log('W', 1, msg="Transfert différentiel impossible, copie complète: ", val=str(x), dotted=False)
+            job.delta = False
     else:
-        tgt_dir = target_dir + os_sep_rmt + rel_path
-    target_path = tgt_dir + os_sep_rmt + file_name
+        job.delta = False
+    if not job.delta and parm['compress'] and rmt_agent is not None:
+        job.compress = compress_choice(job.source_path, job.size)
+        if job.compress == 'compressed':
+            try:
+                put_compressed(job, sftp, rmt_agent, part_offset(sftp, job, part_path))
+            except Exception as x:
+                print_log('W', 1, msg="Transfert compressé impossible, copie sans compression: ", val=str(x),
+                          dotted=False)
+                job.compress = None
+    if not job.delta and job.compress != 'compressed':
+        offset = part_offset(sftp, job, part_path)
+        with open(job.source_path, "rb") as src:
+            src.seek(offset)
+            run_metrics.add('round_trips')
+            with sftp.open(part_path, 'ab' if offset > 0 else 'wb') as dst:
+                dst.set_pipelined(True)
+                while True:
+                    chunk = src.read(XFER_CHUNK_SZ)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+        job.sent = job.size - offset
+    run_metrics.add('round_trips')
+    rmt_size = sftp.stat(part_path).st_size
+    if rmt_size != job.size:
+        raise IOError("Remote size %i, expected %i" % (rmt_size, job.size))
+    if rmt_agent is not None and job.file is not None:
+        rmt_md5 = rmt_agent.call('hash', path=part_path)
+        if rmt_md5 != job.file.file_md5:
+            sftp.remove(part_path)
+            raise IOError("Remote md5 %s, expected %s" % (rmt_md5, job.file.file_md5))
+    sftp.posix_rename(part_path, job.target_path)
+    run_metrics.add('round_trips')
+    xfer_resume.pop(job.source_path, None)
+    # The remote file keeps the date of the source, compared by the progressive mode
+    sftp.utime(job.target_path, (source_stat.st_atime, source_stat.st_mtime))
+    run_metrics.add('round_trips')
+    run_metrics.add('files')
+    run_metrics.add('bytes_read', job.size if job.delta else job.size - job.resumed)
+    run_metrics.add('bytes_sent', job.sent)
+
+
+def part_offset(sftp, job, part_path):
+    """
+    The temporary file left on the remote host by an interrupted copy is only resumed when it was written
+    from the same version of the source, with the same size and date, as noted by xfer_resume.
+    Otherwise it is deleted.
+    :return: the size of the temporary file, where the copy resumes. 0 when there is none.
+    """
+    try:
+        run_metrics.add('round_trips')
+        offset = sftp.stat(part_path).st_size
+    except IOError:
+        offset = 0
+    if offset > 0 and (offset > job.size or xfer_resume.get(job.source_path) != (job.size, job.mtime)):
+        print_log('W', 1, msg="Copie partielle d'une autre version de la source effacée: ", val=part_path,
+                  dotted=False)
+        run_metrics.add('round_trips')
+        sftp.remove(part_path)
+        offset = 0
+    # From now on, the temporary file holds this version of the source
+    xfer_resume[job.source_path] = (job.size, job.mtime)
+    job.resumed = offset
+    if offset > 0:
+        print_log('I', 1, msg="Reprise de la copie à", val=str(offset))
+    return offset
+
+
+def compress_choice(source_path, file_size):
+    """
+    Decide if a file is compressed during its copy. The files with an extension of STORE_EXT,
+    already compressed, are not. For the others, a sample of the start and the middle of the file
+    is compressed quickly, the file is compressed when the sample shrinks enough.
+    :return: compressed, stored_ext or stored_sample
+    """
+    if os.path.splitext(source_path)[1].lower() in config['store_list']:
+        return 'stored_ext'
+    if file_size < COMPRESS_MIN_SZ:
+        return 'stored_sample'
+    half = COMPRESS_SAMPLE_SZ // 2
+    with open(source_path, 'rb') as src:
+        sample = src.read(half)
+        src.seek(max(file_size // 2, len(sample)))
+        sample += src.read(half)
+    # The compressed data is sent in base64, 4 bytes for 3
+    wire_sz = len(zlib.compress(sample, 1)) * 4 / 3
+    if wire_sz > len(sample) * config['compress_ratio']:
+        return 'stored_sample'
+    return 'compressed'
+
+
+def put_compressed(job, sftp, rmt_agent, offset):
+    """
+    Send a file to the agent by chunks compressed with zlib, written to the temporary file from offset.
+    At most AGENT_WINDOW requests are sent before reading the responses. When a request fails, the
+    requests sent after it are still applied and leave a gap in the temporary file: it is deleted
+    once they are answered, and the exception is raised again.
+    :param job: CopyJob, job.sent is the number of bytes of the requests
+    :param sftp: The SFTP client, to delete the temporary file after a failure
+    :param rmt_agent: AgentSession
+    :param offset: The size of the temporary file already on the remote host
+    """
+    part_path = job.target_path + PART_SFX
+    pending = deque()
+    append = offset > 0
+    job.sent = 0
     try:
-        sftp_stat = ftp_client.stat(target_path)
-        file_size = sftp_stat.st_size
-        mtime = sftp_stat.st_mtime
-        lastmod_date = time.localtime(mtime)
-        file_mtime = time.strftime("%Y-%m-%d-%H.%M.%S", lastmod_date)
-        file_md5 = get_md5_rmt(tgt_dir, file_name)
-        print_log('I', 0, msg="Fichier remote: ", val=target_path, dotted=False)
-        print_log('D', 1, msg="Remote Date modification (formatté)", val=file_mtime)
-        print_log('D', 1, msg="Remote Grosseur en bytes", val=str(file_size))
-        print_log('D', 1, msg="Remote Checksum", val=file_md5)
-        file = File(file_name, file_md5, file_mtime, file_size, tgt_dir, target_dir, rel_path, "R")
+        with open(job.source_path, "rb") as src:
+            src.seek(offset)
+            while True:
+                chunk = src.read(COMPRESS_REQUEST_SZ)
+                if not chunk:
+                    break
+                data = base64.b64encode(zlib.compress(chunk, COMPRESS_LEVEL)).decode('ascii')
+                if len(pending) >= AGENT_WINDOW:
+                    if rmt_agent.recv(pending.popleft()) is None:
+                        raise IOError("Compressed write failed for " + part_path)
+                pending.append(rmt_agent.send('zwrite', path=part_path, data=data, append=append))
+                job.sent += len(data)
+                append = True
+        while pending:
+            if rmt_agent.recv(pending.popleft()) is None:
+                raise IOError("Compressed write failed for " + part_path)
+    except Exception:
+        try:
+            while pending:
+                rmt_agent.recv(pending.popleft())
+        except (IOError, OSError):
+            pass
+        try:
+            run_metrics.add('round_trips')
+            sftp.remove(part_path)
+        except IOError:
+            pass
+        raise
+
+
+def put_delta(job, rmt_agent):
+    """
+    Rebuild the new version of a file on the remote host from its current version.
+    The agent sends the signatures of the blocks of the remote file, then receives the indexes
+    of the blocks to reuse and the literal data, written to the temporary file.
+    :param job: CopyJob
+    :param rmt_agent: AgentSession
+    """
+    part_path = job.target_path + PART_SFX
+    block_sz = block_size(job.size)
+    # The temporary file is rewritten by the patches, it cannot be resumed by a full copy
+    xfer_resume.pop(job.source_path, None)
+    signatures = rmt_agent.call('signature', path=job.target_path, block_sz=block_sz)
+    if signatures is None:
+        raise IOError("No signature for " + job.target_path)
+    job.received = len(signatures) * 40
+    job.sent = 0
+    ops = []
+    ops_sz = 0
+    append = False
+    for op in compute_delta(job.source_path, signatures, block_sz):
+        if isinstance(op, bytes):
+            op = base64.b64encode(op).decode('ascii')
+            ops_sz += len(op)
+        else:
+            ops_sz += 8
+        ops.append(op)
+        if ops_sz >= DELTA_REQUEST_SZ:
+            if rmt_agent.call('patch', path=part_path, base=job.target_path, block_sz=block_sz, ops=ops,
+                              append=append) is None:
+                raise IOError("Patch failed for " + part_path)
+            job.sent += ops_sz
+            ops = []
+            ops_sz = 0
+            append = True
+    if rmt_agent.call('patch', path=part_path, base=job.target_path, block_sz=block_sz, ops=ops,
+                      append=append) is None:
+        raise IOError("Patch failed for " + part_path)
+    job.sent += ops_sz
+
+
+def delta_report():
+    print_log('I', 0, msg="Statistiques pour les transferts différentiels:")
+    print_log('I', 1, msg="Fichiers", val=str(delta_stats['files']))
+    print_log('I', 1, msg="Bytes des fichiers", val=str(delta_stats['bytes']))
+    print_log('I', 1, msg="Bytes envoyés", val=str(delta_stats['sent']))
+    print_log('I', 1, msg="Bytes économisés", val=str(delta_stats['bytes'] - delta_stats['sent']))
+    print_log('I', 1, msg="Bytes des signatures reçus", val=str(delta_stats['received']))
+    print_log('I', 0)
+
+
+def compress_report():
+    print_log('I', 0, msg="Statistiques pour la compression des copies:")
+    print_log('I', 1, msg="Fichiers compressés", val=str(compress_stats['compressed']))
+    print_log('I', 1, msg="Fichiers non compressés, par extension", val=str(compress_stats['stored_ext']))
+    print_log('I', 1, msg="Fichiers non compressés, par échantillon", val=str(compress_stats['stored_sample']))
+    print_log('I', 1, msg="Bytes des fichiers", val=str(compress_stats['bytes']))
+    print_log('I', 1, msg="Bytes envoyés", val=str(compress_stats['wire']))
+    if compress_stats['bytes'] > 0:
+        print_log('I', 1, msg="Ratio envoyés / fichiers",
+                  val="%.3f" % (compress_stats['wire'] / compress_stats['bytes']))
+    print_log('I', 0)
+
+
+def metrics_report(source_dir, target_dir):
+    """
+    Log the time and the counters of each phase, and write the json run report with --report.
+    """
+    report = run_metrics.report(source=source_dir, target=target_dir, host=cred['host'],
+                                parms=dict(parm), hash=dict(hash_counts), delta=dict(delta_stats),
+                                compress=dict(compress_stats))
+    print_log('I', 0, msg="Statistiques de performance:")
+    for name, phase in report['phases'].items():
+        print_log('I', 1, msg="Phase " + name)
+        print_log('I', 2, msg="Secondes", val="%.3f" % phase['seconds'])
+        print_log('I', 2, msg="Fichiers", val=str(phase['files']))
+        print_log('I', 2, msg="Bytes lus", val=str(phase['bytes_read']))
+        print_log('I', 2, msg="Bytes des checksums", val=str(phase['bytes_hashed']))
+        print_log('I', 2, msg="Bytes transférés", val=str(phase['bytes_sent']))
+        print_log('I', 2, msg="Rangées écrites dans la BD", val=str(phase['db_rows']))
+        print_log('I', 2, msg="Appels distants", val=str(phase['round_trips']))
+    print_log('I', 1, msg="Durée totale (secondes)", val="%.3f" % report['seconds'])
+    print_log('I', 0)
+    if parm['report'] is not None:
+        try:
+            with open(parm['report'], 'w', encoding='utf-8') as report_file:
+                json.dump(report, report_file, indent=2)
+                report_file.write('\n')
+            print_log('I', 0, msg="Rapport d'exécution", val=parm['report'])
+        except OSError as x:
+            print_log('E', 0, msg="Le rapport d'exécution ne peut pas être écrit: ", val=str(x), dotted=False)
+
+
+def copy_done(db_h, counts=None, wait=False):
+    """
+    Store the files copied by the transfer pool and note the copies in the xfer_failed table.
+    :param db_h: DB handle, None in manifest mode
+    :param counts: The counters of the caller
+    :param wait: Wait for all the queued copies
+    """
+    if xfer_pool is not None:
+        if wait:
+            xfer_pool.join()
+        for job in xfer_pool.completed():
+            if job.rc == 0:
+                if job.file is not None and db_h is not None:
+                    db_store_file(db_h, job.file)
+                if counts is not None and job.kind is not None:
+                    counts[job.kind] += 1
+            xfer_done.append(job)
+    while xfer_done:
+        job = xfer_done.popleft()
+        if job.rc == 0 and job.delta:
+            delta_stats['files'] += 1
+            delta_stats['bytes'] += job.size
+            delta_stats['sent'] += job.sent
+            delta_stats['received'] += job.received
+        if job.rc == 0 and job.compress is not None:
+            compress_stats[job.compress] += 1
+            compress_stats['bytes'] += job.size - job.resumed
+            compress_stats['wire'] += job.sent
+        if db_h is not None:
+            db_record_copy(db_h, job)
+
+
+def xfer_pool_start():
+    global xfer_pool
+    if parm['copy'] and parm['mode'] == 'C':
+        xfer_pool = TransferPool(parm['sessions'])
+    elif parm['remote'] is not None and parm['copy'] and parm['sessions'] > 1:
+        xfer_pool = TransferPool(parm['sessions'])
+
+
+def xfer_pool_stop():
+    global xfer_pool
+    if xfer_pool is not None:
+        xfer_pool.close()
+        xfer_pool.report()
+        xfer_pool = None
+
+
+def stat_metadata(db_h, root_dir, entry):
+    """
+    Build the File of a local file from the stat of its walker Entry. The checksum is left to None unless
+    the incremental mode finds the file unchanged in the DB.
+    """
+    dir_name = entry.dir_name
+    file_name = entry.file_name
+    file_size = entry.size
+    lastmod_date = time.localtime(entry.mtime)
+    file_mtime = time.strftime("%Y-%m-%d-%H.%M.%S", lastmod_date)
+    file_fprint = "%i-%i" % (entry.ino, entry.ctime)
+
+    file_md5 = None
+    if parm['incremental'] and db_h is not None:
+        # Le checksum de la BD est réutilisé si le fichier n'a pas changé depuis la dernière inspection
+        row = db_get_file(db_h, dir_name, file_name, "L")
+        if row is not None and row[1] == file_mtime and row[2] == file_size and row[3] == file_fprint \
+                and row[4] == parm['algo']:
+            file_md5 = row[0]
+            hash_counts['skipped'] += 1
+    return File(file_name, file_md5, file_mtime, file_size, dir_name, root_dir, entry.rel_path, "L", file_fprint)
+
+
+def store_metadata(db_h, file):
+    print_log('F', 0, msg="Fichier: ", val=os.path.join(file.dir_name, file.file_name), dotted=False)
+    print_log('D', 1, msg="Date modification (formatté)", val=file.file_mtime)
+    print_log('D', 1, msg="Grosseur en bytes", val=str(file.file_size))
+    print_log('D', 1, msg="Checksum", val=file.file_md5)
+    if db_h is not None:
         db_store_file(db_h, file)
-    except IOError as x:
-        print_log('I', 1, msg="Fichier non trouvé sur le serveur distant.")
-        file = File(file_name, 'no md5', '0001-01-01-00.00.00', -1, tgt_dir, target_dir, rel_path, "R")
+    return file
+
+
+def get_metadata(db_h, root_dir, entry):
+    file = stat_metadata(db_h, root_dir, entry)
+    if file.file_md5 is None:
+        # Read the file by chunks and calculate MD5 on its contents
+        file.file_md5 = file_digest(os.path.join(entry.dir_name, entry.file_name), parm['algo'], parm['mmap'])
+        hash_counts['computed'] += 1
+        run_metrics.add('bytes_read', file.file_size)
+        run_metrics.add('bytes_hashed', file.file_size)
+    return store_metadata(db_h, file)
+
+
+def get_metadata_pool(db_h, root_dir, items):
+    """
+    Hash the files produced by the walk with the worker pool.
+    The workers only compute the checksums. The calling thread is the only one writing to the DB,
+    and the files are returned in the order of the walk so the counts stay deterministic.
+    :param db_h: DB handle, None to leave the files out of the DB
+    :param root_dir: The root of the walk
+    :param items: iterable of walker Entry
+    :return: a generator of the stored File objects
+    """
+    if hash_pool is None:
+        for entry in items:
+            yield get_metadata(db_h, root_dir, entry)
+        return
+
+    pending = deque()
+    max_pending = parm['jobs'] * POOL_QUEUE_SZ
+    for entry in items:
+        file = stat_metadata(db_h, root_dir, entry)
+        future = None
+        if file.file_md5 is None:
+            future = hash_pool.submit(file_digest, os.path.join(entry.dir_name, entry.file_name), parm['algo'],
+                                      parm['mmap'])
+        pending.append((file, future))
+        # Release the files already hashed at the head of the queue, wait if too many are in flight
+        while pending and (len(pending) >= max_pending or pending[0][1] is None or pending[0][1].done()):
+            yield store_hashed(db_h, *pending.popleft())
+    while pending:
+        yield store_hashed(db_h, *pending.popleft())
+
+
+def store_hashed(db_h, file, future):
+    if future is not None:
+        file.file_md5 = future.result()
+        hash_counts['computed'] += 1
+        run_metrics.add('bytes_read', file.file_size)
+        run_metrics.add('bytes_hashed', file.file_size)
+    return store_metadata(db_h, file)
+
+
+def hash_pool_start():
+    global hash_pool
+    if parm['jobs'] > 1:
+        if parm['pool'] == 'P':
+            hash_pool = ProcessPoolExecutor(max_workers=parm['jobs'])
+        else:
+            hash_pool = ThreadPoolExecutor(max_workers=parm['jobs'])
+
+
+def hash_pool_stop():
+    global hash_pool
+    if hash_pool is not None:
+        hash_pool.shutdown()
+        hash_pool = None
+
+
+def walk_accepted(root_dir, accept_counts, reject_counts, others_counts):
+    """
+    Walk the directory structure, count the files by extension and produce the accepted files.
+    Only the accepted files are stated, once, by the walker. The excluded directories are not listed.
+    :return: a generator of walker Entry
+    """
+    path_filter = config['path_filter']
+
+    def prune(rel_dir, dir_name):
+        if path_filter.prune(rel_dir, dir_name):
+            filter_counts['pruned'] += 1
+            print_log('D', 0, msg="Dossier exclu: ", val=os.path.join(root_dir, rel_dir), dotted=False)
+            return True
+        return False
+
+    for entry in walk_tree(root_dir, path_filter.accept, prune):
+        file_ext = entry.ext
+        file_class = path_filter.classify(entry.rel_path, entry.file_name, file_ext)
+        if file_class == ACCEPTED:
+            accept_counts[file_ext] += 1
+            yield entry
+        elif file_class == EXCLUDED:
+            filter_counts['excluded'] += 1
+        elif file_class == REJECTED:
+            reject_counts[file_ext] += 1
+        else:
+            if file_ext in others_counts:
+                others_counts[file_ext] += 1
+            else:
+                others_counts[file_ext] = 1
+                print_log('I', 0, msg="Fichiers de type inconnu: ", val=os.path.join(entry.dir_name, entry.file_name),
+                          dotted=False)
+
+
+def list_dir_rmt(tgt_dir):
+    """
+    Read the attributes of the files of a remote directory with a single call: the agent listdir,
+    or SFTP listdir_attr.
+    :return: dict file_name: (file_size, file_mtime), empty if the directory does not exist
+    """
+    files = {}
+    try:
+        if agent is not None:
+            entries = agent.call('listdir', path=tgt_dir)
+            if entries is None:
+                # A new directory, not an error
+                print_log('F', 1, msg="Dossier non trouvé sur le serveur distant: ", val=tgt_dir, dotted=False)
+                return files
+            for item in entries:
+                if not item['is_dir']:
+                    files[item['name']] = (item['size'],
+                                           time.strftime("%Y-%m-%d-%H.%M.%S", time.localtime(item['epoch'])))
+        else:
+            run_metrics.add('round_trips')
+            for attr in ftp_client.listdir_attr(tgt_dir):
+                if not stat.S_ISDIR(attr.st_mode):
+                    files[attr.filename] = (attr.st_size,
+                                            time.strftime("%Y-%m-%d-%H.%M.%S", time.localtime(attr.st_mtime)))
+    except IOError:
+        print_log('F', 1, msg="Dossier non trouvé sur le serveur distant: ", val=tgt_dir, dotted=False)
     except Exception as x:
         print_log('E', 1, msg="SSH Error: ", val=str(x), dotted=False)
-        file = File(file_name, 'no md5', '0001-01-01-00.00.00', -1, tgt_dir, target_dir, rel_path, "R")
-    return file
+    return files
 
 
-def scan_dir(db_h, root_dir):
+def scan_dir(db_h, root_dir, manifest=None, on_file=None):
+    """
+    Inventory of the files of a local directory structure.
+    :param db_h: DB handle, None in manifest mode
+    :param manifest: ManifestWriter receiving the files, closed at the end of the scan
+    :param on_file: Function called with each File once stored, in the order of the walk
+    """
     print_log('D', 0, msg="Entrée dans scan_dir. Parm: ", val=root_dir, dotted=False)
     # Initialize counters
     accept_counts = {}
@@ -578,24 +2348,31 @@ def scan_dir(db_h, root_dir):
     for ext in config['reject_list']:
         reject_counts[ext] = 0
     others_counts = {}
+    hash_counts['computed'] = 0
+    hash_counts['skipped'] = 0
+    filter_counts['excluded'] = 0
+    filter_counts['pruned'] = 0
 
     # Scan the directory structure
     print_log('I', 0, msg="Inspection de ", val=root_dir, dotted=False)
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            filename, file_ext = os.path.splitext(file)
-            file_ext = file_ext.lower()
-            if file_ext in config['accept_list']:
-                accept_counts[file_ext] += 1
-                get_metadata(db_h, root_dir, root, file)
-            elif file_ext in config['reject_list']:
-                reject_counts[file_ext] += 1
-            else:
-                if file_ext in others_counts:
-                    others_counts[file_ext] += 1
-                else:
-                    others_counts[file_ext] = 1
-                    print_log('I', 0, msg="Fichiers de type inconnu: ", val=os.path.join(root, file), dotted=False)
+    progress_start("de l'inspection")
+    # The number of files of the previous run gives the estimated time to the end
+    total_files = None
+    if db_h is not None:
+        total_files = db_count_files(db_h, root_dir)
+    count_files = 0
+    for file in get_metadata_pool(db_h, root_dir,
+                                  walk_accepted(root_dir, accept_counts, reject_counts, others_counts)):
+        count_files += 1
+        run_metrics.add('files')
+        progress("de l'inspection", count_files, total_files)
+        if manifest is not None:
+            manifest.add(file.rel_path.replace(os.sep, '/'), file.file_name, file.file_size, file.file_mtime,
+                         file.file_md5)
+        if on_file is not None:
+            on_file(file)
+    if manifest is not None:
+        manifest.close()
 
     # Summary Report
     print_log('I', 0)
@@ -610,13 +2387,52 @@ def scan_dir(db_h, root_dir):
         print_log('I', 1, msg="Comptes par type de fichiers inattendus:")
         for ext in others_counts:
             print_log('I', 2, msg=ext, val=str(others_counts[ext]))
+    print_log('I', 1, msg="Fichiers exclus par les filtres", val=str(filter_counts['excluded']))
+    print_log('I', 1, msg="Dossiers exclus par les filtres", val=str(filter_counts['pruned']))
+    print_log('I', 1, msg="Checksums calculés", val=str(hash_counts['computed']))
+    print_log('I', 1, msg="Checksums réutilisés (fichiers inchangés)", val=str(hash_counts['skipped']))
+    if manifest is not None:
+        print_log('I', 1, msg="Manifeste", val=manifest.manifest_path)
     print_log('I', 0)
+    if db_h is not None:
+        db_flush(db_h)
     print_log('D', 0, "Sortie de scan_dir.")
 
 
+def inventory_local(root_dir):
+    """
+    Inventory of the files of a local directory structure, without the DB and the counters of scan_dir.
+    Used by the target thread of the pipeline.
+    :return: the list of File
+    """
+    path_filter = config['path_filter']
+    result = []
+    for entry in walk_tree(root_dir, path_filter.accept, path_filter.prune):
+        if path_filter.classify(entry.rel_path, entry.file_name, entry.ext) != ACCEPTED:
+            continue
+        file = stat_metadata(None, root_dir, entry)
+        try:
+            file.file_md5 = file_digest(os.path.join(entry.dir_name, entry.file_name), parm['algo'], parm['mmap'])
+        except OSError as x:
+            print_log('W', 1, msg="Le checksum ne peut pas être calculé: ", val=str(x), dotted=False)
+            continue
+        run_metrics.add('files')
+        run_metrics.add('bytes_read', file.file_size)
+        run_metrics.add('bytes_hashed', file.file_size)
+        result.append(file)
+    print_log('I', 0, msg="Statistiques pour " + root_dir + ": " + str(len(result)) + " fichiers.")
+    return result
+
+
 def scan_dir_rmt(db_h, root_dir):
+    """
+    Inventory of the files of the remote directory structure, with a single remote call.
+    :param db_h: DB handle, None to leave the files out of the DB
+    :return: the list of File
+    """
     print_log('D', 0, msg="Entrée dans scan_dir_rmt. Parm: ", val=root_dir, dotted=False)
 
+    result = []
     count_files = 0
     accept_list = ",".join(config['accept_list'])
     reject_list = ",".join(config['reject_list'])
@@ -624,31 +2440,84 @@ def scan_dir_rmt(db_h, root_dir):
     print_log('D', 0, msg="Reject list: ", val=reject_list, dotted=False)
 
     print_log('I', 0, msg="Inspection de ", val=root_dir, dotted=False)
-    command = '/home/jean/sync_rmt.py -s -d "' + root_dir.replace('"', '\\"') + '" -a "' + \
-              accept_list + '" -r "' + reject_list + '"'
-    stdin, stdout, stderr = ssh_client.exec_command(command)
-    data = stdout.read().decode('utf-8')
-    files = json.loads(data)
+    progress_start("de l'inspection distante")
+    # Le checksum est calculé pendant l'inspection: un seul appel au serveur pour tout l'inventaire
+    command = RMT_SCRIPT + ' -s -H -g %s -j %i' % (parm['algo'], parm['jobs']) + rmt_scan_args(root_dir)
+    if agent is not None:
+        files = agent.call('scan', dir=root_dir, accept=config['accept_list'], reject=config['reject_list'],
+                           filters=config['filters'], hash=True, jobs=parm['jobs'])
+    else:
+        stdin, stdout, stderr = ssh_client.exec_command(command)
+        run_metrics.add('round_trips')
+        data = stdout.read().decode('utf-8')
+        files = json.loads(data)
     for item in files:
         # dir_name, file_name, file_md5, file_mtime, file_size, root_dir, rel_path, local_rmt
         dir_name = item['dir']
         file_name = item['name']
-        file_md5 = get_md5_rmt(dir_name, file_name)
+        file_md5 = item.get('md5')
+        if file_md5 is None:
+            file_md5 = get_md5_rmt(dir_name, file_name)
         file_mtime = item['mtime']
         file_size = item['size']
         # root_dir from parm
         rel_path = item['rel_path']
         local_rmt = 'R'
         file = File(file_name, file_md5, file_mtime, file_size, dir_name, root_dir, rel_path, local_rmt)
-        print_log('I', 0, msg="Fichier: " + cred['host'] + ":" + dir_name + os_sep_rmt + file_name)
+        print_log('F', 0, msg="Fichier: " + cred['host'] + ":" + dir_name + os_sep_rmt + file_name)
         print_log('D', 0, msg=str(file))
-        db_store_file(db_h, file)
+        if db_h is not None:
+            db_store_file(db_h, file)
+        result.append(file)
         count_files += 1
+        run_metrics.add('files')
+        if 'md5' in item:
+            run_metrics.add('bytes_hashed', file_size)
+        progress("de l'inspection distante", count_files, len(files))
     # Summary Report
     print_log('I', 0)
     print_log('I', 0, msg="Statistiques pour " + root_dir + ": " + str(count_files) + " fichiers.")
     print_log('I', 0)
+    if db_h is not None:
+        db_flush(db_h)
     print_log('D', 0, "Sortie de scan_dir_rmt.")
+    return result
+
+
+def scan_manifest_rmt(root_dir, manifest_path):
+    """
+    Inventory of the files of the remote directory structure in a manifest.
+    sync_rmt.py sorts the manifest on the server and sends it on stdout, it is copied as is to manifest_path.
+    :return: 0, or 8 if the remote scan failed
+    """
+    print_log('D', 0, msg="Entrée dans scan_manifest_rmt. Parm: ", val=root_dir, dotted=False)
+    print_log('I', 0, msg="Inspection de ", val=root_dir, dotted=False)
+    progress_start("de l'inspection distante")
+    command = RMT_SCRIPT + ' -s -H -M - -g %s -j %i' % (parm['algo'], parm['jobs']) + rmt_scan_args(root_dir)
+    stdin, stdout, stderr = ssh_client.exec_command(command)
+    run_metrics.add('round_trips')
+    count_lines = 0
+    with open(manifest_path, 'wb') as manifest_file:
+        while True:
+            data = stdout.read(MANIFEST_CHUNK_SZ)
+            if not data:
+                break
+            manifest_file.write(data)
+            count_lines += data.count(b'\n')
+            progress("de l'inspection distante", max(count_lines - 1, 0))
+    rc = stdout.channel.recv_exit_status()
+    if rc != 0 or count_lines == 0:
+        print_log('E', 0, msg="L'inspection distante a échoué: ", val=stderr.read().decode('utf-8', 'replace'),
+                  dotted=False)
+        return 8
+    # The first line is the header
+    run_metrics.add('files', count_lines - 1)
+    print_log('I', 0)
+    print_log('I', 0, msg="Statistiques pour " + root_dir + ": " + str(count_lines - 1) + " fichiers.")
+    print_log('I', 1, msg="Manifeste", val=manifest_path)
+    print_log('I', 0)
+    print_log('D', 0, "Sortie de scan_manifest_rmt.")
+    return 0
 
 
 def scan_prog(db_h, source_dir, target_dir):
@@ -664,48 +2533,79 @@ def scan_prog(db_h, source_dir, target_dir):
     for ext in config['reject_list']:
         reject_counts[ext] = 0
     others_counts = {}
-    counts = {'found': 0, 'not_found': 0, '<>size': 0, '<>md5': 0}
+    counts = {'found': 0, 'not_found': 0, '<>size': 0, '<>mtime': 0, '<>md5': 0, 'dirs': 0, 'utime': 0}
+    hash_counts['computed'] = 0
+    hash_counts['skipped'] = 0
+    filter_counts['excluded'] = 0
+    filter_counts['pruned'] = 0
 
     # Scan the directory structure
     print_log('I', 0, msg="Inspection de ", val=source_dir, dotted=False)
-    for root, dirs, files in os.walk(source_dir):
-        for file in files:
-            filename, file_ext = os.path.splitext(file)
-            file_ext = file_ext.lower()
-            if file_ext in config['accept_list']:
-                accept_counts[file_ext] += 1
-                loc_file = get_metadata(db_h, source_dir, root, file)
-                rel_path = loc_file.rel_path
-                rmt_file = get_metadata_rmt(db_h, target_dir, rel_path, file)
-                print_log('D', 0, msg="Local and remote file size",
-                          val='%i/%i' % (loc_file.file_size, rmt_file.file_size))
-                print_log('D', 0, msg="Local and remote file md5",
-                          val='%s/%s' % (loc_file.file_md5, rmt_file.file_md5))
-                if rmt_file.file_size == -1:
-                    print_log('D', 0, msg="rmt file size == -1")
-                    copy_file(loc_file.dir_name, file, target_dir, rel_path)
-                    counts['not_found'] += 1
-                else:
-                    if rmt_file.file_size != loc_file.file_size:
-                        print_log('D', 0, msg="file size different")
-                        copy_file(loc_file.dir_name, file, target_dir, rel_path)
-                        counts['<>size'] += 1
-                    else:
-                        if rmt_file.file_md5 != loc_file.file_md5:
-                            print_log('D', 0, msg="file md5 different")
-                            copy_file(loc_file.dir_name, file, target_dir, rel_path)
-                            counts['<>md5'] += 1
-                        else:
-                            counts['found'] += 1
-                print_log('I', 0)
-            elif file_ext in config['reject_list']:
-                reject_counts[file_ext] += 1
+    progress_start("de l'inspection")
+    total_files = db_count_files(db_h, source_dir)
+    # The hashes of the target directories, rebuilt from the file table after db_remove_deleted so that
+    # the files deleted from the target since the previous run change them. The files of a source
+    # directory with the same hash are not verified one by one on the target.
+    db_update_dirs(db_h, target_dir, os_sep_rmt)
+    tgt_dirs = db_get_dirs(db_h, target_dir)
+    for dir_name, dir_files in groupby(get_metadata_pool(db_h, source_dir,
+                                                         walk_accepted(source_dir, accept_counts, reject_counts,
+                                                                       others_counts)),
+                                       key=attrgetter('dir_name')):
+        dir_files = list(dir_files)
+        tgt = tgt_dirs.get(dir_files[0].rel_path.replace(os.sep, '/'))
+        if tgt is not None and tgt[0] is not None and \
+                tgt[0] == dir_files_hash(sorted((file.file_name, file.file_size, file.file_md5, file.file_algo)
+                                                for file in dir_files)):
+            print_log('D', 0, msg="Dossier inchangé: ", val=dir_name, dotted=False)
+            run_metrics.add('files', len(dir_files))
+            progress("de l'inspection", sum(accept_counts.values()), total_files)
+            counts['found'] += len(dir_files)
+            counts['dirs'] += 1
+            continue
+        # The attributes of the target files are read once for the directory. The remote checksum is
+        # only computed when the size and the date are the same, or with --fix-dates when the size is the same.
+        tgt_dir = target_dir_rmt(target_dir, dir_files[0].rel_path)
+        rmt_files = list_dir_rmt(tgt_dir)
+        for loc_file in dir_files:
+            file = loc_file.file_name
+            rel_path = loc_file.rel_path
+            run_metrics.add('files')
+            progress("de l'inspection", sum(accept_counts.values()), total_files)
+            # The target file after the copy, or as verified
+            new_file = File(file, loc_file.file_md5, loc_file.file_mtime, loc_file.file_size, tgt_dir, target_dir,
+                            rel_path.replace(os.sep, os_sep_rmt), "R")
+            rmt_attr = rmt_files.get(file)
+            print_log('D', 0, msg="Local and remote file size and date",
+                      val='%i %s/%s' % (loc_file.file_size, loc_file.file_mtime, rmt_attr))
+            if rmt_attr is None:
+                print_log('D', 0, msg="rmt file not found")
+                kind = 'not_found'
+            elif rmt_attr[0] != loc_file.file_size:
+                print_log('D', 0, msg="file size different")
+                kind = '<>size'
+            elif rmt_attr[1] != loc_file.file_mtime and not parm['fix_dates']:
+                print_log('D', 0, msg="file date different")
+                kind = '<>mtime'
+            elif get_md5_rmt(tgt_dir, file) != loc_file.file_md5:
+                print_log('D', 0, msg="file md5 different")
+                kind = '<>mtime' if rmt_attr[1] != loc_file.file_mtime else '<>md5'
             else:
-                if file_ext in others_counts:
-                    others_counts[file_ext] += 1
-                else:
-                    others_counts[file_ext] = 1
-                    print_log('I', 0, msg="Fichiers de type inconnu: ", val=os.path.join(root, file), dotted=False)
+                kind = 'found'
+                if rmt_attr[1] != loc_file.file_mtime:
+                    # Copied by a version that did not keep the date of the source: the date is set once
+                    # with --fix-dates, the next runs compare the dates without the checksum
+                    print_log('D', 0, msg="file date different, same md5")
+                    set_mtime_rmt(os.path.join(loc_file.dir_name, file), tgt_dir + os_sep_rmt + file)
+                    counts['utime'] += 1
+            counts[kind] += 1
+            if kind == 'found':
+                db_store_file(db_h, new_file)
+            elif copy_file(loc_file.dir_name, file, target_dir, rel_path, new_file, delta=kind != 'not_found') == 0:
+                db_store_file(db_h, new_file)
+            print_log('F', 0)
+        copy_done(db_h)
+    copy_done(db_h, wait=True)
 
     # Summary Report
     print_log('I', 0)
@@ -720,30 +2620,75 @@ def scan_prog(db_h, source_dir, target_dir):
         print_log('I', 1, msg="Comptes par type de fichiers inattendus:")
         for ext in others_counts:
             print_log('I', 2, msg=ext, val=str(others_counts[ext]))
+    print_log('I', 1, msg="Fichiers exclus par les filtres", val=str(filter_counts['excluded']))
+    print_log('I', 1, msg="Dossiers exclus par les filtres", val=str(filter_counts['pruned']))
     print_log('I', 0)
     print_log('I', 1, msg="Copies évitées", val=str(counts['found']))
+    print_log('I', 1, msg="Dossiers inchangés non vérifiés", val=str(counts['dirs']))
     print_log('I', 1, msg="Fichiers non trouvés sur la cible copiés", val=str(counts['not_found']))
     print_log('I', 1, msg="Fichiers de grandeurs différentes copiés", val=str(counts['<>size']))
+    print_log('I', 1, msg="Fichiers de dates différentes copiés", val=str(counts['<>mtime']))
+    print_log('I', 1, msg="Dates de la cible corrigées (même MD5)", val=str(counts['utime']))
     print_log('I', 1, msg="Fichiers avec des MD5 différents copiés", val=str(counts['<>md5']))
+    print_log('I', 1, msg="Checksums calculés", val=str(hash_counts['computed']))
+    print_log('I', 1, msg="Checksums réutilisés (fichiers inchangés)", val=str(hash_counts['skipped']))
     print_log('I', 0)
+    db_flush(db_h)
+    db_update_dirs(db_h, target_dir, os_sep_rmt)
     print_log('D', 0, "Sortie de scan_dir.")
 
 
+def set_mtime_rmt(source_path, target_path):
+    """
+    Give to the remote file the date of the source, like put_file after a copy.
+    """
+    source_stat = os.stat(source_path)
+    try:
+        if parm['remote'] is None:
+            os.utime(target_path, (source_stat.st_atime, source_stat.st_mtime))
+        else:
+            ftp_client.utime(target_path, (source_stat.st_atime, source_stat.st_mtime))
+            run_metrics.add('round_trips')
+    except (IOError, OSError) as x:
+        print_log('W', 1, msg="La date ne peut pas être changée: ", val=str(x), dotted=False)
+
+
 def get_md5_rmt(dir_name, file_name):
-    command = '/home/jean/sync_rmt.py -m -d "' + dir_name.replace('"', '\\"') + \
+    if agent is not None:
+        return agent.call('hash', path=dir_name + os_sep_rmt + file_name)
+    command = RMT_SCRIPT + ' -m -g ' + parm['algo'] + ' -d "' + dir_name.replace('"', '\\"') + \
               '" -f "' + file_name.replace('"', '\\"') + '"'
     stdin, stdout, stderr = ssh_client.exec_command(command)
+    run_metrics.add('round_trips')
     md5 = stdout.read().decode('utf-8').rstrip('\n')
     return md5
 
 
+def connect_session():
+    """
+    Open a SSH session and its SFTP channel with the credentials of the run.
+    :return: (ssh, sftp). The exceptions are left to the caller.
+    """
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(cred['host'], port=cred['port'], username=cred['user'], password=cred['pswd'])
+    return ssh, ssh.open_sftp()
+
+
+def disconnect_session(ssh, sftp):
+    try:
+        if sftp is not None:
+            sftp.close()
+        if ssh is not None:
+            ssh.close()
+    except Exception as x:
+        print_log('D', 0, msg="SSH Error: ", val=str(x), dotted=False)
+
+
 def connect_ssh():
     global ssh_client, ftp_client
     try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(cred['host'], port=cred['port'], username=cred['user'], password=cred['pswd'])
-        ftp_client = ssh_client.open_sftp()
+        ssh_client, ftp_client = connect_session()
     except Exception as x:
         print_log('E', 0, msg="SSH Error: ", val=str(x), dotted=False)
         ssh_client = None
@@ -751,6 +2696,62 @@ def connect_ssh():
     return
 
 
+def agent_open(ssh):
+    """
+    Start sync_rmt.py -A on the remote host of a SSH session.
+    :return: AgentSession or None if the agent is not available
+    """
+    try:
+        stdin, stdout, stderr = ssh.exec_command(RMT_SCRIPT + " -A")
+        session = AgentSession(stdin, stdout)
+        session.call('os_sep')
+        session.algo = negotiate_algo(session)
+        return session
+    except Exception as x:
+        print_log('W', 0, msg="L'agent distant n'est pas disponible: ", val=str(x), dotted=False)
+    return None
+
+
+def negotiate_algo(session):
+    """
+    Agree with the agent on the checksum algorithm: the one of the run if the remote host supports it,
+    md5 otherwise.
+    :return: the algorithm used by the agent
+    """
+    algo = session.call('algo', algos=[parm['algo'], 'md5'])
+    if algo is None:
+        # Agent older than the negotiation, its checksums are md5
+        return 'md5'
+    return algo
+
+
+def agent_start():
+    """
+    Start the agent on the main SSH session. The session is kept for the whole run.
+    """
+    global agent
+    agent = None
+    if ssh_client is not None:
+        agent = agent_open(ssh_client)
+
+
+def agent_start_local(script='sync_rmt.py'):
+    """
+    Start the agent in a local subprocess, in place of the SSH channel. Used by test_sync.py.
+    :return: AgentSession
+    """
+    process = subprocess.Popen([sys.executable, script, '-A'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               universal_newlines=True, encoding='utf-8')
+    return AgentSession(process.stdin, process.stdout, process)
+
+
+def agent_stop():
+    global agent
+    if agent is not None:
+        agent.close()
+        agent = None
+
+
 def disconnect_ssh():
     global ssh_client, ftp_client
     if ftp_client is not None:
@@ -763,6 +2764,7 @@ def ssh_command_with_rc(command):
     channel = ssh_client.get_transport().open_session()
     channel.exec_command(command)
     rc = channel.recv_exit_status()
+    run_metrics.add('round_trips')
     return rc
 
 
@@ -777,18 +2779,24 @@ def main():
     parm['dup'] = options.dup.upper()
     parm['mode'] = options.mode.upper()
     parm['scan_target'] = options.scan_target
+    parm['incremental'] = options.incremental
+    parm['mmap'] = options.mmap
+    parm['jobs'] = options.jobs
+    parm['pool'] = options.pool.upper()
+    parm['sessions'] = options.sessions
+    parm['delta'] = options.delta
+    parm['compress'] = options.compress
+    parm['fast_dup'] = options.fast_dup or options.verify_dup
+    parm['verify_dup'] = options.verify_dup
+    parm['dup_report'] = options.dup_report
+    parm['verbose'] = options.verbose
+    parm['progress'] = options.progress
+    parm['report'] = options.report
+    parm['manifest_dir'] = options.manifest_dir or tempfile.gettempdir()
+    parm['fix_dates'] = options.fix_dates
     source_dir = args[0]
     target_dir = args[1]
-    if parm['log'] == 'CRITICAL':
-        logging.basicConfig(level=logging.CRITICAL, format=' %(asctime)s - %(levelname)s - %(message)s')
-    elif parm['log'] == 'ERROR':
-        logging.basicConfig(level=logging.ERROR, format=' %(asctime)s - %(levelname)s - %(message)s')
-    elif parm['log'] == 'WARNING':
-        logging.basicConfig(level=logging.WARNING, format=' %(asctime)s - %(levelname)s - %(message)s')
-    elif parm['log'] == 'DEBUG':
-        logging.basicConfig(level=logging.DEBUG, format=' %(asctime)s - %(levelname)s - %(message)s')
-    else:
-        logging.basicConfig(level=logging.INFO, format=' %(asctime)s - %(levelname)s - %(message)s')
+    setup_logging(parm['log'])
 
     print_log('I', 0, msg='Début du programme ', val=sys.argv[0], dotted=False)
     print_log('I', 0, msg='Paramètres:')
@@ -807,6 +2815,7 @@ def main():
         print_log('I', 2, msg="Port", val=str(cred['port']))
         print_log('I', 2, msg="User", val=str(cred['user']))
         connect_ssh()
+        agent_start()
         os_sep_rmt = get_os_sep_rmt()
         print_log('I', 2, msg="Séparateur OS", val=os_sep_rmt)
         if check_target_dir_rmt(target_dir) > 0:
@@ -821,11 +2830,27 @@ def main():
     else:
         print_log('I', 1, msg="Option de copie", val="Non")
 
-    if parm['scan_target']:
+    if parm['mode'] == 'M':
+        print_log('I', 1, msg="Mode manifeste, sans BD", val="Oui")
+        print_log('I', 2, msg="Dossier des manifestes", val=parm['manifest_dir'])
+        if not os.path.isdir(parm['manifest_dir']):
+            print_log('E', 0, msg="Le dossier des manifestes n'existe pas.")
+            return 8
+    if parm['fix_dates']:
+        print_log('I', 1, msg="Correction des dates de la cible", val="Oui")
+
+    if parm['scan_target'] or parm['mode'] == 'M':
         print_log('I', 1, msg="Inspection de la destination", val="Oui")
     else:
         print_log('I', 1, msg="Inspection de la destination", val="Non")
 
+    if parm['incremental']:
+        print_log('I', 1, msg="Mode incrémental", val="Oui")
+    else:
+        print_log('I', 1, msg="Mode incrémental", val="Non")
+
+    print_log('I', 1, msg="Processus de calcul des checksums", val=str(parm['jobs']))
+
     if parm['dup'] == 'S':
         print_log('I', 1, msg="Option de vérification de doublons", val="Source")
     elif parm['dup'] == 'C':
@@ -846,43 +2871,121 @@ def main():
         print_log('I', 1, msg="Accepted extension", val=ext)
     for ext in config['reject_list']:
         print_log('I', 1, msg="Rejected extension", val=ext)
+    parm['algo'] = config['hash_algo']
+    if agent is not None:
+        algo = negotiate_algo(agent)
+        agent.algo = algo
+        if algo != parm['algo']:
+            print_log('W', 1, msg="L'agent distant ne supporte pas %s, l'algorithme utilisé est: " % parm['algo'],
+                      val=algo, dotted=False)
+            parm['algo'] = algo
+    print_log('I', 1, msg="Algorithme des checksums", val=parm['algo'])
+    for key, patterns in config['filters'].items():
+        for pattern in patterns:
+            print_log('I', 1, msg="Filter " + key, val=pattern)
 
     db_name = db_get_name(source_dir, target_dir, cred['host'])
     db_path = source_dir + os.sep + db_name
-    print_log('I', 1, msg="Database file", val=db_name)
+    if parm['mode'] == 'M':
+        # The manifests are named like the DB, outside of the source, which can be read-only
+        source_manifest = os.path.join(parm['manifest_dir'], os.path.splitext(db_name)[0] + '.source.manifest')
+        target_manifest = os.path.join(parm['manifest_dir'], os.path.splitext(db_name)[0] + '.target.manifest')
+        print_log('I', 1, msg="Manifeste de la source", val=source_manifest)
+        print_log('I', 1, msg="Manifeste de la cible", val=target_manifest)
+    else:
+        print_log('I', 1, msg="Database file", val=db_name)
     print_log('I', 0, msg=" ")
 
-    conn = sqlite3.connect(db_path)
-    db_create_tables(conn)               # Create the DB objects
-    db_remove_deleted(conn)  # Remove deleted files from db
+    dup_report = None
+    if parm['dup_report'] is not None and parm['dup'] in 'SCT':
+        dup_report = DupReport(parm['dup_report'])
+
+    if parm['mode'] != 'M':
+        conn = db_connect(db_path)
+        db_create_tables(conn)               # Create the DB objects
+        with run_metrics.phase('deleted'):
+            db_remove_deleted(conn, [source_dir, target_dir])  # Remove deleted files from db
+        db_list_failed(conn)
+    rc = 0
+    hash_pool_start()
+    xfer_pool_start()
     if parm['mode'] == 'S':
-        scan_dir(conn, source_dir)           # Create inventory of the files in the source directory structure
-        conn.commit()
+        with run_metrics.phase('scan_source'):
+            scan_dir(conn, source_dir)           # Create inventory of the files in the source directory structure
+            conn.commit()
         if parm['dup'] in 'ST':
-            list_dup(conn, source_dir)
+            with run_metrics.phase('dup_source'):
+                list_dup_db(conn, source_dir, dup_report)
         if parm['scan_target']:
-            if parm['remote'] is None:
-                scan_dir(conn, target_dir)      # Create inventory of the files in the target directory structure
-            else:
-                scan_dir_rmt(conn, target_dir)
-            conn.commit()
+            with run_metrics.phase('scan_target'):
+                if parm['remote'] is None:
+                    scan_dir(conn, target_dir)      # Create inventory of the files in the target directory structure
+                else:
+                    scan_dir_rmt(conn, target_dir)
+                conn.commit()
         else:
             print_log('I', 0, msg="Le destination ne sera pas inspectée. Seule la BD est consultée."
                                   "")
-        find_missing_files(conn, source_dir, target_dir)  # Identify files that need to be copied
-    else:  # Mode progressif
-        scan_prog(conn, source_dir, target_dir)
+        with run_metrics.phase('diff'):
+            find_missing_files(conn, source_dir, target_dir)  # Identify files that need to be copied
+    elif parm['mode'] == 'C':
+        rc = sync_pipeline(conn, db_path, source_dir, target_dir)
         conn.commit()
+        if parm['dup'] in 'ST':
+            with run_metrics.phase('dup_source'):
+                list_dup_db(conn, source_dir, dup_report)
+    elif parm['mode'] == 'M':
+        with run_metrics.phase('scan_source'):
+            scan_dir(None, source_dir, ManifestWriter(source_manifest, parm['algo'], source_dir))
+        if parm['dup'] in 'ST':
+            with run_metrics.phase('dup_source'):
+                list_dup_fast(source_dir, dup_report)
+        with run_metrics.phase('scan_target'):
+            if parm['remote'] is None:
+                scan_dir(None, target_dir, ManifestWriter(target_manifest, parm['algo'], target_dir))
+                rc = 0
+            else:
+                rc = scan_manifest_rmt(target_dir, target_manifest)
+        if rc == 0:
+            with run_metrics.phase('diff'):
+                find_missing_manifest(source_manifest, target_manifest, source_dir, target_dir)
+    else:  # Mode progressif
+        with run_metrics.phase('scan_prog'):
+            scan_prog(conn, source_dir, target_dir)
+            conn.commit()
+    hash_pool_stop()
+    xfer_pool_stop()
+    if parm['delta']:
+        delta_report()
+    if parm['compress'] and parm['remote'] is not None:
+        compress_report()
     if parm['dup'] in 'CT':
-        list_dup(conn, target_dir)
-
-    conn.commit()
-    conn.close()
+        with run_metrics.phase('dup_target'):
+            if parm['mode'] == 'M' and parm['remote'] is None:
+                list_dup_fast(target_dir, dup_report)
+            elif parm['mode'] == 'M':
+                print_log('W', 0, msg="Sans BD, les doublons de la cible distante ne sont pas listés.")
+            elif parm['fast_dup'] and parm['remote'] is None and not (parm['scan_target'] and parm['mode'] in 'SC'):
+                # Without -t, the DB only has the target files copied or seen by the previous runs
+                list_dup_fast(target_dir, dup_report)
+            else:
+                list_dup_db(conn, target_dir, dup_report)
+    if dup_report is not None:
+        dup_report.close()
+        print_log('I', 0, msg="Rapport des doublons", val=parm['dup_report'])
+        print_log('I', 1, msg="Groupes de doublons", val=str(dup_report.groups))
+        print_log('I', 1, msg="Bytes récupérables", val=str(dup_report.reclaimable))
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
 
+    agent_stop()
     disconnect_ssh()
+    metrics_report(source_dir, target_dir)
 
     print_log('I', 0, msg="Fin du programme", val=sys.argv[0], dotted=False)
-    return 0
+    return rc
 
 
 if __name__ == "__main__":
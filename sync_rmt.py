@@ -2,17 +2,29 @@
 
 import os
 import sys
+import stat
 import time
 import logging
-import hashlib
 import json
+import base64
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
+from hashing import file_digest, supported_algo
+from delta import block_signatures, apply_delta
+from walker import walk_tree
+from pathfilter import PathFilter, ACCEPTED, REJECTED, EXCLUDED
+from manifest import ManifestWriter
 
 logging.basicConfig(level=logging.ERROR, format=' %(asctime)s - %(levelname)s - %(message)s')
 
 
+# Global constant
+PENDING_SZ = 64  # Nombre de fichiers en attente de leur md5 par thread
+
 # parms
-parm = {'scan': False, 'md5': False}
+parm = {'scan': False, 'md5': False, 'algo': 'md5'}
 
 
 def parse_options():
@@ -31,34 +43,54 @@ def parse_options():
                       help="The directory name.")
     parser.add_option("-f", "--file", dest="file_name", action="store", default=False,
                       help="The file name.")
+    parser.add_option("-H", "--hash", dest="hash", action="store_true", default=False,
+                      help="With -s, compute the md5 of each file during the scan.")
+    parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+                      help="With -s and -H, the number of threads computing the md5.")
+    parser.add_option("-F", "--filters", dest="filters", action="store", default=None,
+                      help="With -s, the filters of the [filters] section of sync.cfg, json encoded in base64.")
+    parser.add_option("-M", "--manifest", dest="manifest", action="store", default=None,
+                      help="With -s, write a sorted manifest to this file instead of the json, - for stdout.")
+    parser.add_option("-A", "--agent", dest="agent", action="store_true", default=False,
+                      help="Run as an agent answering json requests, one per line, on stdin.")
+    parser.add_option("-g", "--algo", dest="algo", action="store", default='md5',
+                      help="The checksum algorithm of -m and -H: md5, sha1, sha256, sha512, blake2b, ...")
     parser.add_option("-o", "--ossep", dest="os_sep", action="store_true", default=False,
                       help="Return the os.sep")
     (options, args) = parser.parse_args()
     return options, args  # options: scan, md5; args(None)
 
 
-def get_metadata(root_dir, dir_name, file_name):
-    file_path = os.path.join(dir_name, file_name)
-    (mode, ino, dev, nlink, uid, gid, file_size, atime, mtime, ctime) = os.stat(file_path)
-    lastmod_date = time.localtime(mtime)
+def get_metadata(entry):
+    lastmod_date = time.localtime(entry.mtime)
     file_mtime = time.strftime("%Y-%m-%d-%H.%M.%S", lastmod_date)
-    rel_path = os.path.relpath(dir_name, root_dir)
-    return rel_path, file_size, file_mtime
+    return entry.rel_path, entry.size, file_mtime
 
 
 def get_md5(dir_name, file_name):
-    # Open,close, read file and calculate MD5 on its contents
+    # Read the file by chunks and calculate MD5 on its contents
     file_path = os.path.join(dir_name, file_name)
-    with open(file_path, "rb") as file_to_check:
-        # read contents of the file
-        data = file_to_check.read()
-        # pipe contents of the file through
-        file_md5 = hashlib.md5(data).hexdigest()
+    file_md5 = file_digest(file_path, parm['algo'])
     return file_md5
 
 
-def scan_dir(root_dir, accept_list, reject_list):
+def get_md5_safe(file_path):
+    try:
+        return file_digest(file_path, parm['algo'])
+    except OSError as x:
+        logging.error("Checksum impossible pour " + file_path + ": " + str(x))
+        return None
+
+
+def scan_dir(root_dir, accept_list, reject_list, with_md5=False, jobs=1, filters=None, manifest=None):
+    """
+    :param manifest: ManifestWriter receiving the files. The result is then empty and the manifest is closed.
+    """
     result = []
+    pending = deque()
+    pool = None
+    if with_md5 and jobs > 1:
+        pool = ThreadPoolExecutor(max_workers=jobs)
     # Initialize counters
     accept_counts = {}
     for ext in accept_list:
@@ -67,26 +99,55 @@ def scan_dir(root_dir, accept_list, reject_list):
     for ext in reject_list:
         reject_counts[ext] = 0
     others_counts = {}
+    excluded_count = 0
+    path_filter = PathFilter(accept_list, reject_list, filters)
+
+    def keep(file_item, future=None):
+        if future is not None:
+            file_item['md5'] = future.result()
+        if manifest is None:
+            result.append(file_item)
+        else:
+            manifest.add(file_item['rel_path'].replace(os.sep, '/'), file_item['name'], file_item['size'],
+                         file_item['mtime'], file_item.get('md5'))
 
     # Scan the directory structure
     logging.debug("Inspection de " + root_dir)
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            filename, file_ext = os.path.splitext(file)
-            file_ext = file_ext.lower()
-            if file_ext in accept_list:
-                accept_counts[file_ext] += 1
-                rel_path, file_size, file_mtime = get_metadata(root_dir, root, file)
-                file_item = {'dir': root, 'name': file, 'rel_path': rel_path, 'size': file_size, 'mtime': file_mtime}
-                result.append(file_item)
-            elif file_ext in reject_list:
-                reject_counts[file_ext] += 1
+    for entry in walk_tree(root_dir, path_filter.accept, path_filter.prune):
+        root = entry.dir_name
+        file = entry.file_name
+        file_ext = entry.ext
+        file_class = path_filter.classify(entry.rel_path, file, file_ext)
+        if file_class == EXCLUDED:
+            excluded_count += 1
+        elif file_class == ACCEPTED:
+            accept_counts[file_ext] += 1
+            rel_path, file_size, file_mtime = get_metadata(entry)
+            file_item = {'dir': root, 'name': file, 'rel_path': rel_path, 'size': file_size, 'mtime': file_mtime}
+            if pool is not None:
+                pending.append((file_item, pool.submit(get_md5_safe, os.path.join(root, file))))
+                # The files are kept in the order of the walk, with a bounded number in flight
+                while pending and (len(pending) >= jobs * PENDING_SZ or pending[0][1].done()):
+                    keep(*pending.popleft())
+                continue
+            if with_md5:
+                file_item['md5'] = get_md5_safe(os.path.join(root, file))
+            keep(file_item)
+        elif file_class == REJECTED:
+            reject_counts[file_ext] += 1
+        else:
+            if file_ext in others_counts:
+                others_counts[file_ext] += 1
             else:
-                if file_ext in others_counts:
-                    others_counts[file_ext] += 1
-                else:
-                    others_counts[file_ext] = 1
-                    logging.debug("Fichiers de type inconnu: " + os.path.join(root, file))
+                others_counts[file_ext] = 1
+                logging.debug("Fichiers de type inconnu: " + os.path.join(root, file))
+
+    if pool is not None:
+        while pending:
+            keep(*pending.popleft())
+        pool.shutdown()
+    if manifest is not None:
+        manifest.close()
 
     # Summary Report
     logging.debug(" ")
@@ -101,18 +162,157 @@ def scan_dir(root_dir, accept_list, reject_list):
         logging.debug("    Comptes par type de fichiers inattendus:")
         for ext in others_counts:
             logging.debug(("        " + ext).ljust(49, '.') + ": %i" % others_counts[ext])
+    logging.debug("    Fichiers exclus par les filtres".ljust(49, '.') + ": %i" % excluded_count)
     logging.debug(" ")
     logging.debug("Sortie de scan_dir.")
     return result
-  
-    
+
+
+def agent_stat(path):
+    try:
+        (mode, ino, dev, nlink, uid, gid, file_size, atime, mtime, ctime) = os.stat(path)
+    except FileNotFoundError:
+        return None
+    lastmod_date = time.localtime(mtime)
+    file_mtime = time.strftime("%Y-%m-%d-%H.%M.%S", lastmod_date)
+    return {'size': file_size, 'mtime': file_mtime, 'epoch': mtime, 'is_dir': stat.S_ISDIR(mode)}
+
+
+def agent_hash(path):
+    return file_digest(path, parm['algo'])
+
+
+def agent_algo(algos):
+    # Use the first algorithm of the list supported here, for the rest of the session
+    for algo in algos:
+        if supported_algo(algo):
+            parm['algo'] = algo
+            return algo
+    raise ValueError("No supported algorithm in %s" % ",".join(algos))
+
+
+def agent_mkdir(path):
+    # Return True if the directory was created, False if it already existed
+    if os.path.isdir(path):
+        return False
+    os.makedirs(path, mode=0o750, exist_ok=True)
+    return True
+
+
+def agent_exists(path):
+    return os.path.isfile(path)
+
+
+def agent_listdir(path):
+    result = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                st = entry.stat()
+                lastmod_date = time.localtime(st.st_mtime)
+                result.append({'name': entry.name, 'is_dir': entry.is_dir(), 'size': st.st_size,
+                               'mtime': time.strftime("%Y-%m-%d-%H.%M.%S", lastmod_date), 'epoch': int(st.st_mtime)})
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return result
+
+
+# Requests taking a path. A request can also give a list of paths, the result is then a list.
+AGENT_OPS = {'stat': agent_stat, 'hash': agent_hash, 'mkdir': agent_mkdir, 'exists': agent_exists,
+             'listdir': agent_listdir}
+
+
+def agent_patch(request):
+    """
+    Write a part of the new version of a file, from the blocks of the base file and literal data.
+    The ops are block indexes (int) or literal data (str, base64).
+    The first request of a file has append set to false.
+    :return: the size of the new file
+    """
+    ops = [op if isinstance(op, int) else base64.b64decode(op) for op in request['ops']]
+    mode = 'ab' if request.get('append', False) else 'wb'
+    with open(request['path'], mode) as out_file:
+        apply_delta(request['base'], out_file, ops, request['block_sz'])
+        return out_file.tell()
+
+
+def agent_zwrite(request):
+    """
+    Write a part of a file from data compressed with zlib (str, base64).
+    The first request of a file has append set to false.
+    :return: the size of the file
+    """
+    data = zlib.decompress(base64.b64decode(request['data']))
+    mode = 'ab' if request.get('append', False) else 'wb'
+    with open(request['path'], mode) as out_file:
+        out_file.write(data)
+        return out_file.tell()
+
+
+def agent_request(request):
+    op = request.get('op')
+    if op == 'os_sep':
+        return os.sep
+    if op == 'algo':
+        return agent_algo(request['algos'])
+    if op == 'scan':
+        return scan_dir(request['dir'], request['accept'], request['reject'], request.get('hash', False),
+                        request.get('jobs', 1), request.get('filters'))
+    if op == 'signature':
+        return block_signatures(request['path'], request['block_sz'])
+    if op == 'patch':
+        return agent_patch(request)
+    if op == 'zwrite':
+        return agent_zwrite(request)
+    if op not in AGENT_OPS:
+        raise ValueError("Invalid op: %s" % op)
+    if 'paths' in request:
+        result = []
+        for path in request['paths']:
+            try:
+                result.append(AGENT_OPS[op](path))
+            except OSError as x:
+                logging.error(op + " " + path + ": " + str(x))
+                result.append(None)
+        return result
+    return AGENT_OPS[op](request['path'])
+
+
+def agent():
+    """
+    Answer the requests of sync.py on a single channel.
+    Each line of stdin is a json request: {"id": 1, "op": "stat", "path": "..."} or {..., "paths": [...]}.
+    Each response is a json line written in the same order: {"id": 1, "ok": true, "result": ...}
+    or {"id": 1, "ok": false, "error": "..."}. The agent ends on the quit op or at the end of stdin.
+    """
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if request.get('op') == 'quit':
+            break
+        try:
+            response = {'id': request.get('id'), 'ok': True, 'result': agent_request(request)}
+        except Exception as x:
+            response = {'id': request.get('id'), 'ok': False, 'error': str(x)}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
 def main():
     # Get parameters and validate them
     (options, args) = parse_options()
     parm["scan"] = options.scan
     parm["md5"] = options.md5
     parm["os_sep"] = options.os_sep
-    if parm["scan"]:
+    parm["agent"] = options.agent
+    if not supported_algo(options.algo):
+        logging.error("Invalid algorithm: " + options.algo)
+        return 8
+    parm["algo"] = options.algo
+    if parm["agent"]:
+        agent()
+    elif parm["scan"]:
         if not options.dir_name:
             logging.error("-d is required for the scan option")
         dir_name = options.dir_name
@@ -122,8 +322,15 @@ def main():
         if not options.reject:
             logging.error("-r is required for the scan option")
         reject_list = options.reject.split(',')
-        result = scan_dir(dir_name, accept_list, reject_list)
-        print(json.dumps(result, indent=4))
+        filters = None
+        if options.filters:
+            filters = json.loads(base64.b64decode(options.filters).decode('utf-8'))
+        if options.manifest:
+            scan_dir(dir_name, accept_list, reject_list, options.hash, options.jobs, filters,
+                     manifest=ManifestWriter(options.manifest, parm['algo'], dir_name))
+        else:
+            result = scan_dir(dir_name, accept_list, reject_list, options.hash, options.jobs, filters)
+            print(json.dumps(result, indent=4))
     elif parm["md5"]:
         if not options.dir_name:
             logging.error("-d is required for the md5 option")
@@ -0,0 +1,351 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import zlib
+import unittest
+from unittest import mock
+import sync
+import delta
+import manifest
+
+# Tests de sync.py sur des arborescences temporaires locales.
+# Le serveur distant est remplacé par l'agent sync_rmt.py -A démarré dans un sous-processus.
+# Exécution: python -m unittest test_sync, à partir du dossier de sync.py.
+
+# Global constant
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def setUpModule():
+    os.chdir(REPO_DIR)
+    sync.setup_logging('WARNING')
+    sync.config = sync.parse_configs()
+    sync.parm.update({'algo': sync.config['hash_algo'], 'progress': 0, 'verbose': False})
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(data)
+
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sync-test-')
+        self.paths = []
+        for i in range(5):
+            self.paths.append(os.path.join(self.work_dir, 'f%i.txt' % i))
+            write_file(self.paths[-1], 'fichier %i' % i)
+        self.agent = sync.agent_start_local()
+
+    def tearDown(self):
+        if self.agent.process.returncode is None:
+            self.agent.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_requests(self):
+        self.assertEqual(self.agent.call('os_sep'), os.sep)
+        self.assertEqual(self.agent.call('hash', path=self.paths[0]),
+                         sync.file_digest(self.paths[0], sync.parm['algo']))
+        names = sorted(item['name'] for item in self.agent.call('listdir', path=self.work_dir))
+        self.assertEqual(names, ['f%i.txt' % i for i in range(5)])
+        self.assertIsNone(self.agent.call('listdir', path=os.path.join(self.work_dir, 'missing')))
+
+    def test_call_many(self):
+        # Many batches, more than AGENT_WINDOW in flight, with a missing file in the middle
+        paths = self.paths[:2] + [os.path.join(self.work_dir, 'missing.txt')] + self.paths[2:]
+        with mock.patch.object(sync, 'AGENT_BATCH_SZ', 1), mock.patch.object(sync, 'AGENT_WINDOW', 2):
+            results = self.agent.call_many('hash', paths)
+        self.assertEqual(results[2], None)
+        self.assertEqual(results[:2] + results[3:], [sync.file_digest(path, sync.parm['algo'])
+                                                     for path in self.paths])
+        self.assertEqual(self.agent.call_many('exists', paths), [True, True, False, True, True, True])
+
+    def test_quit(self):
+        self.agent.close()
+        self.assertEqual(self.agent.process.returncode, 0)
+
+
+class StandardTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sync-test-')
+        self.source_dir = os.path.join(self.work_dir, 'source')
+        for name in ['f1.txt', 'f2.txt']:
+            write_file(os.path.join(self.source_dir, name), name * 100)
+            write_file(os.path.join(self.source_dir, 'a', 'b', name), name * 200)
+        sync.parm.update({'copy': True, 'remote': None, 'mode': 'S', 'incremental': False, 'delta': False,
+                          'compress': False})
+        self.conn = sync.db_connect(os.path.join(self.work_dir, 'sync.db'))
+        sync.db_create_tables(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def run_sync(self, target_dir):
+        sync.db_remove_deleted(self.conn, [self.source_dir, target_dir])
+        sync.scan_dir(self.conn, self.source_dir)
+        self.conn.commit()
+        return sync.find_missing_files(self.conn, self.source_dir, target_dir)
+
+    def test_target_with_trailing_separator(self):
+        # The stored target paths have a doubled separator, they must still be found by the next run
+        target_dir = os.path.join(self.work_dir, 'target') + os.sep
+        os.makedirs(target_dir)
+        self.assertEqual(self.run_sync(target_dir), 4)
+        self.assertEqual(self.run_sync(target_dir), 0)
+
+    def test_dirs_updated_from_changes(self):
+        target_dir = os.path.join(self.work_dir, 'target')
+        os.makedirs(target_dir)
+        self.run_sync(target_dir)
+        os.remove(os.path.join(self.source_dir, 'a', 'b', 'f1.txt'))
+        os.remove(os.path.join(self.source_dir, 'a', 'b', 'f2.txt'))
+        write_file(os.path.join(self.source_dir, 'c', 'd', 'f3.txt'), 'f3' * 100)
+        write_file(os.path.join(self.source_dir, 'f1.txt'), 'f1 modifié')
+        self.run_sync(target_dir)
+        dirs = sync.db_get_dirs(self.conn, self.source_dir)
+        self.assertNotIn('a/b', dirs)
+        self.assertEqual(dirs['.'][3], 3)
+        # The same hashes as a computation of all the directories
+        self.conn.execute("delete from dir where root_dir = ?", [self.source_dir])
+        sync.db_update_dirs(self.conn, self.source_dir, os.sep)
+        self.assertEqual(sync.db_get_dirs(self.conn, self.source_dir), dirs)
+
+
+class ManifestTest(unittest.TestCase):
+    # The names with a tab, a newline or a backslash are escaped in the manifests
+    NAMES = {('.', 'new.txt'): 'N', ('.', 'same.txt'): 'S', ('a', 'tab\tname.txt'): 'U', ('a', 'same.txt'): 'S',
+             ('a', 'new\nline.txt'): 'N', ('a\\b', 'back\\slash.txt'): 'O', ('a\\b', 'new.txt'): 'N',
+             ('c\td', 'same.txt'): 'S', ('c\td', 'older.txt'): 'O'}
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sync-test-')
+        self.source_dir = os.path.join(self.work_dir, 'source')
+        self.target_dir = os.path.join(self.work_dir, 'target')
+        for (rel_path, file_name), diff in self.NAMES.items():
+            source_path = os.path.join(self.source_dir, rel_path, file_name)
+            target_path = os.path.join(self.target_dir, rel_path, file_name)
+            write_file(source_path, 'source ' + file_name)
+            if diff == 'N':
+                continue
+            write_file(target_path, 'source ' + file_name if diff == 'S' else 'target ' + file_name)
+            # U: the source is newer, O: the target is newer
+            os.utime(source_path, (1500000000, 1500000000 if diff == 'O' else 1600000000))
+            os.utime(target_path, (1500000000, 1600000000 if diff == 'O' else 1500000000))
+        sync.parm.update({'copy': False, 'remote': None, 'mode': 'S', 'incremental': False, 'delta': False,
+                          'compress': False})
+        self.conn = sync.db_connect(os.path.join(self.work_dir, 'sync.db'))
+        sync.db_create_tables(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_manifest(self, root_dir):
+        manifest_path = os.path.join(self.work_dir, os.path.basename(root_dir) + '.manifest')
+        write_run = manifest.ManifestWriter.write_run
+        with mock.patch.object(manifest, 'RUN_LINES', 2), \
+                mock.patch.object(manifest.ManifestWriter, 'write_run', autospec=True,
+                                  side_effect=write_run) as mock_write_run:
+            sync.scan_dir(None, root_dir, manifest.ManifestWriter(manifest_path, sync.parm['algo'], root_dir))
+        self.assertGreater(mock_write_run.call_count, 1)
+        return manifest_path
+
+    def test_runs_sorted(self):
+        manifest_path = self.write_manifest(self.source_dir)
+        with open(manifest_path, encoding=manifest.ENCODING, errors=manifest.ERRORS) as manifest_file:
+            self.assertEqual(manifest.read_header(manifest_file), (sync.parm['algo'], self.source_dir))
+            records = list(manifest.read_records(manifest_file))
+        keys = [record[0] for record in records]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(sorted(record[1:3] for record in records),
+                         sorted((rel_path.replace(os.sep, '/'), file_name) for rel_path, file_name in self.NAMES))
+
+    def test_merge_join(self):
+        plan = dict((source[1:3], diff) for diff, source, target in
+                    manifest.join_manifests(self.write_manifest(self.source_dir),
+                                            self.write_manifest(self.target_dir)))
+        self.assertEqual(plan, self.NAMES)
+
+    def test_same_plan_as_db(self):
+        source_manifest = self.write_manifest(self.source_dir)
+        target_manifest = self.write_manifest(self.target_dir)
+        with mock.patch.object(sync, 'copy_file', return_value=1) as mock_copy:
+            sync.find_missing_manifest(source_manifest, target_manifest, self.source_dir, self.target_dir)
+        manifest_copies = sorted((args[3], args[1], args[5]) for args, kwargs in mock_copy.call_args_list)
+        sync.scan_dir(self.conn, self.source_dir)
+        sync.scan_dir(self.conn, self.target_dir)
+        self.conn.commit()
+        with mock.patch.object(sync, 'copy_file', return_value=1) as mock_copy:
+            sync.find_missing_files(self.conn, self.source_dir, self.target_dir)
+        db_copies = sorted((args[3], args[1], args[5]) for args, kwargs in mock_copy.call_args_list)
+        self.assertEqual(manifest_copies, db_copies)
+        self.assertEqual(db_copies, sorted((rel_path, file_name, 'copy' if diff == 'N' else 'newer')
+                                           for (rel_path, file_name), diff in self.NAMES.items() if diff in 'NU'))
+
+
+class ProgressiveTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sync-test-')
+        self.source_dir = os.path.join(self.work_dir, 'source')
+        self.target_dir = os.path.join(self.work_dir, 'target')
+        os.makedirs(self.target_dir)
+        for name in ['f1.txt', 'f2.txt']:
+            write_file(os.path.join(self.source_dir, 'a', name), name * 100)
+        sync.parm.update({'copy': True, 'remote': None, 'mode': 'P', 'incremental': False, 'delta': False,
+                          'compress': False})
+        sync.os_sep_rmt = os.sep
+        sync.rmt_dirs.clear()
+        sync.agent = sync.agent_start_local(os.path.join(REPO_DIR, 'sync_rmt.py'))
+        self.conn = sync.db_connect(os.path.join(self.work_dir, 'sync.db'))
+        sync.db_create_tables(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        sync.agent_stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def run_prog(self):
+        sync.db_remove_deleted(self.conn, [self.source_dir, self.target_dir])
+        sync.scan_prog(self.conn, self.source_dir, self.target_dir)
+        self.conn.commit()
+
+    def test_target_deleted_between_runs(self):
+        self.run_prog()
+        target_path = os.path.join(self.target_dir, 'a', 'f1.txt')
+        self.assertTrue(os.path.isfile(target_path))
+        os.remove(target_path)
+        self.run_prog()
+        self.assertTrue(os.path.isfile(target_path))
+
+    def test_target_date_set_without_copy(self):
+        self.run_prog()
+        target_path = os.path.join(self.target_dir, 'a', 'f1.txt')
+        source_mtime = os.stat(os.path.join(self.source_dir, 'a', 'f1.txt')).st_mtime
+        # A target copied by a version that did not keep the date of the source, and not in the DB
+        os.utime(target_path, (source_mtime + 3600, source_mtime + 3600))
+        self.conn.execute("delete from file where root_dir = ?", [self.target_dir])
+        self.conn.commit()
+        sync.run_metrics = sync.RunMetrics()
+        with mock.patch.dict(sync.parm, {'fix_dates': True}):
+            self.run_prog()
+        self.assertNotIn('copy', sync.run_metrics.report()['phases'])
+        self.assertEqual(int(os.stat(target_path).st_mtime), int(source_mtime))
+
+    def test_target_date_copied_without_checksum(self):
+        self.run_prog()
+        target_path = os.path.join(self.target_dir, 'a', 'f1.txt')
+        source_mtime = os.stat(os.path.join(self.source_dir, 'a', 'f1.txt')).st_mtime
+        os.utime(target_path, (source_mtime + 3600, source_mtime + 3600))
+        self.conn.execute("delete from file where root_dir = ?", [self.target_dir])
+        self.conn.commit()
+        with mock.patch.object(sync, 'get_md5_rmt') as mock_md5:
+            self.run_prog()
+        self.assertEqual([args[1] for args, kwargs in mock_md5.call_args_list], ['f2.txt'])
+        self.assertEqual(int(os.stat(target_path).st_mtime), int(source_mtime))
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sync-test-')
+        self.old_path = os.path.join(self.work_dir, 'old.bin')
+        self.new_path = os.path.join(self.work_dir, 'new.bin')
+        self.old_data = random.Random(1).randbytes(5 * delta.BLOCK_MIN_SZ + 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def roundtrip(self, old_data, new_data, probe_sz=delta.PROBE_SZ):
+        """
+        :return: the ops of the delta from old_data to new_data, after checking that they rebuild new_data
+        """
+        for path, data in [(self.old_path, old_data), (self.new_path, new_data)]:
+            with open(path, 'wb') as file:
+                file.write(data)
+        block_sz = delta.block_size(len(new_data))
+        ops = list(delta.compute_delta(self.new_path, delta.block_signatures(self.old_path, block_sz), block_sz,
+                                       probe_sz))
+        out_file = io.BytesIO()
+        delta.apply_delta(self.old_path, out_file, ops, block_sz)
+        self.assertEqual(out_file.getvalue(), new_data)
+        return ops
+
+    def test_empty(self):
+        self.assertEqual(self.roundtrip(b'', b''), [])
+        self.assertEqual(self.roundtrip(self.old_data, b''), [])
+
+    def test_smaller_than_block(self):
+        self.assertEqual(self.roundtrip(self.old_data, b'abc'), [b'abc'])
+        self.assertEqual(self.roundtrip(b'abc', b'abc'), [0])
+
+    def test_insert(self):
+        ops = self.roundtrip(self.old_data, self.old_data[:1000] + b'insertion' + self.old_data[1000:])
+        self.assertEqual(ops[-5:], [1, 2, 3, 4, 5])
+
+    def test_change(self):
+        offset = 2 * delta.BLOCK_MIN_SZ + 10
+        ops = self.roundtrip(self.old_data, self.old_data[:offset] + b'X' + self.old_data[offset + 1:])
+        self.assertEqual([op for op in ops if isinstance(op, int)], [0, 1, 3, 4, 5])
+
+    def test_tail(self):
+        ops = self.roundtrip(self.old_data, self.old_data + b'fin du fichier')
+        self.assertEqual(ops[:5], [0, 1, 2, 3, 4])
+
+    def test_few_matches(self):
+        new_data = random.Random(2).randbytes(len(self.old_data))
+        with self.assertRaises(ValueError):
+            self.roundtrip(self.old_data, new_data, probe_sz=2 * delta.BLOCK_MIN_SZ)
+        self.roundtrip(self.old_data, new_data)
+
+
+class LocalSFTP(object):
+    """
+    The SFTP calls of put_file, on the local file system.
+    """
+    def stat(self, path):
+        return os.stat(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+
+class CompressTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sync-test-')
+        self.source_path = os.path.join(self.work_dir, 'source.txt')
+        write_file(self.source_path, 'fichier copie ' * 300000)
+        self.job = sync.CopyJob(self.source_path, os.path.join(self.work_dir, 'target.txt'))
+        self.job.size = os.path.getsize(self.source_path)
+        self.agent = sync.agent_start_local(os.path.join(REPO_DIR, 'sync_rmt.py'))
+
+    def tearDown(self):
+        self.agent.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_put_compressed(self):
+        sync.put_compressed(self.job, LocalSFTP(), self.agent, 0)
+        with open(self.source_path, 'rb') as source, open(self.job.target_path + sync.PART_SFX, 'rb') as part:
+            self.assertEqual(source.read(), part.read())
+        self.assertLess(self.job.sent, self.job.size)
+
+    def test_failed_zwrite_deletes_part(self):
+        # The second chunk is not valid zlib data, the chunks sent after it are still written by the agent
+        calls = []
+        zlib_compress = zlib.compress
+
+        def compress(data, level):
+            calls.append(data)
+            return b'invalid' if len(calls) == 2 else zlib_compress(data, level)
+
+        with mock.patch.object(sync.zlib, 'compress', side_effect=compress):
+            with self.assertRaises(IOError):
+                sync.put_compressed(self.job, LocalSFTP(), self.agent, 0)
+        self.assertFalse(os.path.exists(self.job.target_path + sync.PART_SFX))
+        self.assertEqual(self.agent.call('os_sep'), os.sep)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+from collections import namedtuple
+
+# Parcours d'une arborescence avec os.scandir, utilisé par sync.py, dupfind.py et sync_rmt.py.
+# Il doit être copié à côté de sync_rmt.py sur le serveur distant.
+# Chaque fichier retenu a un seul stat, celui de son DirEntry, et le chemin relatif est calculé
+# une fois par dossier. Sous Windows, où ce stat n'a pas d'inode, un os.stat est ajouté.
+# Comme os.walk, les liens vers des dossiers ne sont pas suivis et les dossiers illisibles sont ignorés.
+
+# One record per file. size, mtime, ino and ctime are None when the file was not stated.
+Entry = namedtuple('Entry', ['dir_name', 'file_name', 'rel_path', 'ext', 'size', 'mtime', 'ino', 'ctime'])
+
+
+def walk_tree(root_dir, stat_exts=None, prune=None):
+    """
+    Walk a directory structure top-down, in the order of os.walk.
+    :param root_dir: The root of the walk
+    :param stat_exts: The extensions, in lower case, of the files to stat. None to stat all the files,
+                      an empty list to stat none of them.
+    :param prune: Function called with the relative path and the name of each sub directory.
+                  When it returns True, the sub directory is not listed.
+    :return: a generator of Entry. A file that disappears before its stat is skipped.
+    """
+    stack = [(root_dir, '.')]
+    while stack:
+        dir_name, rel_path = stack.pop()
+        try:
+            with os.scandir(dir_name) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        sub_dirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    sub_dirs.append(entry)
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if stat_exts is not None and ext not in stat_exts:
+                yield Entry(dir_name, entry.name, rel_path, ext, None, None, None, None)
+                continue
+            try:
+                st = entry.stat()
+                # On Windows, the stat of a DirEntry has no inode, needed by the fingerprint of the
+                # incremental mode: the file is stated again, like before the walker
+                if st.st_ino == 0:
+                    st = os.stat(entry.path)
+            except OSError:
+                continue
+            yield Entry(dir_name, entry.name, rel_path, ext, st.st_size, st.st_mtime, st.st_ino, st.st_ctime)
+        # Pushed in reverse, the sub directories are walked in the order of the listing
+        for entry in reversed(sub_dirs):
+            if rel_path == '.':
+                sub_rel_path = entry.name
+            else:
+                sub_rel_path = rel_path + os.sep + entry.name
+            if prune is not None and prune(sub_rel_path, entry.name):
+                continue
+            stack.append((entry.path, sub_rel_path))